@@ -3,6 +3,9 @@ import json, argparse
 from collections import defaultdict
 from tqdm import tqdm 
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+from Recorder import iter_records
+
 def scene_iter(path, level="level1", scene_count=10, round_id=1, model=None):
     level_dirs = [os.path.join(path, f"{level}-{i}") for i in range(1, scene_count+1)]
 
@@ -26,8 +29,16 @@ def scene_iter(path, level="level1", scene_count=10, round_id=1, model=None):
                 models.append(model_name)
                 rst[model_name] = defaultdict(dict)
 
-            record_file = os.path.join(level_scene, model_dir, 'records.json')
-            if not os.path.exists(record_file):
+            record_dir = os.path.join(level_scene, model_dir)
+            # one pass over the records, only the last two are kept
+            record_len, grab_attempts, last_record, second_last_record = 0, 0, None, None
+            for _r in iter_records(record_dir):
+                second_last_record, last_record = last_record, _r
+                record_len += 1
+                if not "info" in _r:
+                    grab_attempts += _r['response'].get('grab', False)
+
+            if last_record is None:
                 #import pdb; pdb.set_trace()
                 rst[model_name][scene_id]['success'] = 0
                 rst[model_name][scene_id]['grab'] = 0
@@ -35,32 +46,27 @@ def scene_iter(path, level="level1", scene_count=10, round_id=1, model=None):
                 rst[model_name][scene_id]['grab_success'] = 0
                 rst[model_name][scene_id]['step'] = 50 if level == "level1" else 100
             else:
-                with open(record_file) as fr:
-                    record = json.loads(fr.read())
-
                 escaped = False
 
                 # for success
-                if record[-1].get('info', None) is not None:
-                    rst[model_name][scene_id]['step'] = record[-2]['step'] + 1
-                    if 'Escaped succesfully!' in record[-1]['info']:
+                if last_record.get('info', None) is not None:
+                    rst[model_name][scene_id]['step'] = second_last_record['step'] + 1
+                    if 'Escaped succesfully!' in last_record['info']:
                         rst[model_name][scene_id]['success'] = 1
                         escaped = True
                     else:
                         rst[model_name][scene_id]['success'] = 0
-                    record_len = len(record) - 1
-                    last_inter = record[-2]
+                    record_len = record_len - 1
+                    last_inter = second_last_record
                 else:
                     if level == "level1":
                         max_step = 50 
                     else:
                         max_step = 75 if level == "level2" else 100
-                    rst[model_name][scene_id]['step'] = min(max_step, record[-1]['step'] + 1)
+                    rst[model_name][scene_id]['step'] = min(max_step, last_record['step'] + 1)
                     rst[model_name][scene_id]['success'] = 0
-                    record_len = len(record)
-                    last_inter = record[-1]
+                    last_inter = last_record
         
-                grab_attempts = sum([_r['response'].get('grab', False) for _r in record if not "info" in _r])
                 # For successful trials:
                 if level == "level1":
                     grab_tp = 1.
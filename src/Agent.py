@@ -1,11 +1,13 @@
 import os
-import io, base64, httpx, copy, time, requests, re, json
+import io, base64, httpx, copy, time, requests, re, json, math
 
-from openai import OpenAI,AzureOpenAI
+from openai import OpenAI,AzureOpenAI,AsyncOpenAI,AsyncAzureOpenAI
 from PIL import Image
+import numpy as np
 
 from log_config import configure_logger
 from config import *
+from legent import encode_image, NULL_PROFILER
 from tokencost import count_message_tokens, count_string_tokens
 import traceback,sys
 logger = configure_logger(__name__)
@@ -16,10 +18,21 @@ retry_flag = True
 
 
 
+def get_offline_test_image():
+    """A small image as a data url, for the startup test of endpoints without internet access"""
+    image = Image.new("RGB", (64, 64), (255, 255, 255))
+    buffered = io.BytesIO()
+    image.save(buffered, format="JPEG")
+    return f"data:image/jpeg;base64,{base64.b64encode(buffered.getvalue()).decode('utf-8')}"
+
+
 def get_answer_img_test(client, model):
     logger.debug(f'tested model: {model}')
     
     image_url_duck = "https://upload.wikimedia.org/wikipedia/commons/d/da/2015_Kaczka_krzy%C5%BCowka_w_wodzie_%28samiec%29.jpg"
+    if LLM_BASE_URL:
+        # the local endpoints may be offline
+        image_url_duck = get_offline_test_image()
     image_url_lion = "https://upload.wikimedia.org/wikipedia/commons/7/77/002_The_lion_king_Snyggve_in_the_Serengeti_National_Park_Photo_by_Giles_Laurent.jpg"
 
     completion = client.chat.completions.create(
@@ -38,35 +51,92 @@ def get_answer_img_test(client, model):
     print(completion.usage.completion_tokens)
 
 
+def create_client(model, use_async=False):
+    """gpt-* models are served by azure openai, the others by a vllm openai-compatible server. LLM_BASE_URL serves all of them if set"""
+    if LLM_BASE_URL:
+        client_cls = AsyncOpenAI if use_async else OpenAI
+        return client_cls(base_url=LLM_BASE_URL, api_key=API_KEY or "none")
+    if model.startswith('gpt-'):
+        client_cls = AsyncAzureOpenAI if use_async else AzureOpenAI
+        return client_cls(
+                        azure_endpoint = os.environ['AZURE_ENDPOINT'],  
+                        api_version= "2024-10-01-preview",
+                        api_key = os.environ['AZURE_OPENAI_API_KEY_41']
+                        )
+    client_cls = AsyncOpenAI if use_async else OpenAI
+    return client_cls(
+            base_url=f"http://{os.environ['GPUIP']}:1703/v1",# localhost
+            api_key="yyy",
+        )
+
+
+def get_encoding_profile(model):
+    """The profile in ENCODING_PROFILES with the longest prefix of the model name, the default one otherwise"""
+    prefixes = [prefix for prefix in ENCODING_PROFILES if prefix != "default" and model.lower().startswith(prefix.lower())]
+    profile = dict(ENCODING_PROFILES["default"])
+    if prefixes:
+        profile.update(ENCODING_PROFILES[max(prefixes, key=len)])
+    return profile
+
+
+def get_render_resolution(profile):
+    """(width, height) the game client renders at for an encoding profile: its resolution if it renders at it, CAMERA_RESOLUTION otherwise"""
+    return tuple(profile["resolution"]) if profile["render"] and profile["resolution"] else tuple(CAMERA_RESOLUTION)
+
+
+def estimate_image_tokens(model, width, height, detail="high"):
+    """
+    Rough number of prompt tokens of an image, only for logging.
+    The openai models count 512 px tiles after fitting the image in 2048x2048 and its short side in 768,
+    the others are taken as one token per 28x28 patch (e.g. Qwen2-VL).
+    """
+    if model.startswith('gpt-'):
+        if detail == "low":
+            return 85
+        scale = min(1, 2048 / max(width, height))
+        width, height = width * scale, height * scale
+        scale = min(1, 768 / min(width, height))
+        width, height = width * scale, height * scale
+        return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+    return math.ceil(width / 28) * math.ceil(height / 28)
+
+
 class AgentPlayer:
-    def __init__(self, system_prompt, model, max_history=None, max_retry=3, history_type="full"):
+    def __init__(self, system_prompt, model, max_history=None, max_retry=3, history_type="full", max_images=None, cache=None, cache_namespace=""):
         """
         arg:
         :history_type: str, default 'full', choose from 'full', 'max', 'key'
+            'full': all the former rounds are sent
+            'max': only the last max_history rounds are sent
+            'key': only the rounds with a first interaction with an item (and the results they got) are sent, the last max_history of them
+                   (and the first prompt) if it is set
         :max_history: int, default None, if history_type is 'max', max_history must to set to a number
+        :max_images: int, default None, the screenshots of the rounds older than the last max_images rounds are replaced by a short text. None keeps all of them
+        :cache: ResponseCache, default None, answer identical requests from this cache rather than the endpoint
+        :cache_namespace: str, default '', agents with different namespaces (e.g. the trials of a setting) do not share cached responses
         """
 
+        assert history_type in ["full", "max", "key"]
         if history_type == "max":
             assert max_history is not None
 
         logger.info("Initializing the agent.")
         
         # base params for the game
-        if model.startswith('gpt-'):
-            self.client = AzureOpenAI(
-                            azure_endpoint = os.environ['AZURE_ENDPOINT'],  
-                            api_version= "2024-10-01-preview",
-                            api_key = os.environ['AZURE_OPENAI_API_KEY_41']
-                            )
-        else:
-            self.client = OpenAI(
-                    base_url=f"http://{os.environ['GPUIP']}:1703/v1",# localhost
-                    api_key="yyy",
-                )           
         self.model = model
+        self.client = self._create_client()
         self.max_retry = max_retry
         self.history_type = history_type
         self.max_history = max_history
+        self.max_images = max_images
+        # how the screenshots are encoded, see ENCODING_PROFILES in config.py
+        self.encoding_profile = get_encoding_profile(model)
+        # set by the game to profile the LLM calls and the image encoding
+        self.profiler = NULL_PROFILER
+        self.cache = cache
+        self.cache_namespace = cache_namespace
+        self.cache_hits = 0
+        self.cache_misses = 0
 
         # for 'key' history type, when some steps are skipped, there will be a disconsistency between  
         # the current view and the last view sent to the agent
@@ -74,6 +144,7 @@ class AgentPlayer:
         # for 'key' history_type, step 0 is always a key step
         # format: {"key_step": bool, "step_prompt": str, "response": str}
         self.step_meta_info = [{"key_step": True, "step_prompt": "", "response": ""}] # create a placeholder here
+        # number of finished rounds already checked for the key interactions
         self.last_pos  = 0
 
         # params for story recovery
@@ -84,24 +155,75 @@ class AgentPlayer:
         ]
         self.interactions = []
         self.key_interactions = []
+        # system_messages + interactions, kept up to date by appending, for the 'full' history type
+        self.full_message = list(self.system_messages)
+        # the screenshots still sent to the agent, oldest first
+        self.screenshots = []
+        # image url -> its response cache digest, hashed once when the image is added rather than at every lookup
+        self.image_digests = {}
 
         self.img_str_pattern = r"data:image\/[a-zA-Z]+;base64,([A-Za-z0-9+/=]+)"
 
         self.prompt_tokens = 0
         self.completion_tokens = 0
+        # usage of the answers taken from the response cache, not paid for in this episode
+        self.cached_prompt_tokens = 0
+        self.cached_completion_tokens = 0
+        # usage of the last call, 0 if it was answered from the cache
+        self.last_prompt_tokens = 0
+        self.last_completion_tokens = 0
+        # size of the screenshots sent: the encoded bytes and the estimated tokens of the last one, and their sums
+        self.last_image_bytes = 0
+        self.last_image_tokens = 0
+        self.image_bytes = 0
+        self.image_tokens = 0
         self.message = []
+        self._test_client()
+
+    def _test_client(self):
         get_answer_img_test(self.client, self.model)
 
-    def add_problem(self, problem, image_path=None):
+    def _create_client(self):
+        return create_client(self.model)
+
+    def __add_interaction(self, interaction):
+        self.interactions.append(interaction)
+        self.full_message.append(interaction)
+
+    def add_problem(self, problem, image_path=None, image=None):
+        """
+        arg:
+        :image_path: str, the screenshot of the scene saved with the center mark
+        :image: np.ndarray, the frame of the scene, used instead of image_path and encoded with the center mark
+        """
         content = "" if self.model.startswith('phi') else []
-        self.interactions.append({"role": "user", "content": content})
+        self.__add_interaction({"role": "user", "content": content})
 
         self.__add_problem(problem)
-        if image_path:
-            self.__add_image(image_path)
+        if image is not None or image_path:
+            self.__add_image(image_path, image)
+            self.__evict_images()
 
-    def __add_image(self, image_path):
-        image = Image.open(image_path)
+    def __evict_images(self):
+        """
+        Replace the screenshots older than max_images rounds by a text, in place, so every message list holding the round sees it.
+        The images from the interactions (e.g. image puzzles) are clues rather than views and are kept.
+        """
+        if self.max_images is None:
+            return
+        while len(self.screenshots) > self.max_images:
+            content, image = self.screenshots.pop(0)
+            for idx, part in enumerate(content):
+                if part is image:
+                    content[idx] = {"type": "text", "text": "(The view of this round is omitted.)"}
+                    break
+            self.image_digests.pop(image["image_url"]["url"], None)
+
+    def __digest_image(self, url):
+        if self.cache is not None:
+            self.image_digests[url] = self.cache.image_digest(url)
+
+    def __add_image(self, image_path, image=None):
         if self.show_tranist_prompt and len(self.step_meta_info) > 2:
             round_id = len(self.step_meta_info) - 1 
             transition_prompt = f'After {round_id} rounds, the view has become:'
@@ -113,19 +235,36 @@ class AgentPlayer:
                     }
                 )
 
-        buffered = io.BytesIO()
-        image.save(buffered, format="JPEG")
-        base64_image = base64.b64encode(buffered.getvalue()).decode("utf-8")
-
-        self.interactions[-1]["content"].append(
-            {
-                "type": "image_url",
-                "image_url": {
-                    "url": f"data:image/jpeg;base64,{base64_image}",
-                    "detail": "high",
-                },
-            }
-        )
+        profile = self.encoding_profile
+        if image is None:
+            image = np.asarray(Image.open(image_path).convert("RGB"))
+            # the saved screenshot already has the center mark
+            center_mark = False
+        else:
+            # straight from the renderer, the red center mark is drawn while encoding
+            center_mark = True
+        size = profile["resolution"] or (image.shape[1], image.shape[0])
+        with self.profiler.span("agent.encode_image"):
+            encoded = encode_image(image, format="JPEG", center_mark=center_mark, size=size, quality=profile["jpeg_quality"])
+            base64_image = base64.b64encode(encoded).decode("utf-8")
+        self.profiler.add("agent.image_bytes", len(encoded))
+
+        self.last_image_bytes = len(encoded)
+        self.last_image_tokens = estimate_image_tokens(self.model, size[0], size[1], profile["detail"])
+        self.image_bytes += self.last_image_bytes
+        self.image_tokens += self.last_image_tokens
+        logger.debug(f"Screenshot encoded at {size[0]}x{size[1]}: {self.last_image_bytes} bytes, ~{self.last_image_tokens} tokens")
+
+        image = {
+            "type": "image_url",
+            "image_url": {
+                "url": f"data:image/jpeg;base64,{base64_image}",
+                "detail": profile["detail"],
+            },
+        }
+        self.interactions[-1]["content"].append(image)
+        self.screenshots.append((self.interactions[-1]["content"], image))
+        self.__digest_image(image["image_url"]["url"])
 
     def add_response(self, response):
         if self.show_tranist_prompt and len(self.step_meta_info) > 1:
@@ -141,7 +280,7 @@ class AgentPlayer:
         else:
             content = [{"type": "text", "text": response}]
 
-        self.interactions.append(
+        self.__add_interaction(
                 {"role": "assistant", "content": content}
             )
 
@@ -157,10 +296,12 @@ class AgentPlayer:
                 logger.debug("found a img str in desc")
                 text_split = text.split(f"<img src='data:image/jpeg;base64,{img_strs}'></img>")
                 self.interactions[-1]["content"].append({"type": "text", "text": text_split[0]})
+                url = f"data:image/jpeg;base64,{img_strs}"
                 self.interactions[-1]["content"].append(
                     {"type": "image_url", 
-                     "image_url": {"url": f"data:image/jpeg;base64,{img_strs}", "detail": "auto" }}
+                     "image_url": {"url": url, "detail": "auto" }}
                 )
+                self.__digest_image(url)
                 self.interactions[-1]["content"].append({"type": "text", "text": text_split[1]})
             else:
                 self.interactions[-1]["content"].append({"type": "text", "text": text})
@@ -180,36 +321,137 @@ class AgentPlayer:
 
         
     def get_key_interactions(self):
-        if self.last_pos == 0:
-            self.key_interactions = copy.deepcopy(self.interactions)
-
-        else: 
-            if self.step_meta_info[self.last_pos - 1]['key_step']: # check if the last step is a key step, if true, append the response
-                self.key_interactions.append(self.interactions[self.last_pos*2 - 1])
-            
-            if self.step_meta_info[self.last_pos]['key_step']: # check if the current step is a key step, if true, append the prompt
-                self.key_interactions.append(self.interactions[self.last_pos * 2])
-         
-        self.last_pos = len(self.step_meta_info)-1
+        """
+        Extend key_interactions with the rounds finished since the last call. interactions[2*i] is the prompt of round i and
+        interactions[2*i+1] the response, step_meta_info[i+1] the meta info of round i.
+        For a key round, its response and the next prompt (which tells what the interaction found) are kept.
+        """
+        if not self.key_interactions:
+            self.key_interactions.append(self.interactions[0])
+
+        current_round = (len(self.interactions) - 1) // 2
+        for round_id in range(self.last_pos, current_round):
+            if self.step_meta_info[round_id + 1]['key_step']:
+                self.key_interactions.append(self.interactions[round_id * 2 + 1])
+                self.key_interactions.append(self.interactions[round_id * 2 + 2])
+        self.last_pos = current_round
+
+    @staticmethod
+    def merge_user_turns(messages):
+        """
+        Join the consecutive user messages into one, so that the roles alternate, as some endpoints (e.g. gemini) require.
+        The merged messages are new ones, the interactions are not modified.
+        """
+        merged = []
+        for message in messages:
+            if merged and message["role"] == "user" and merged[-1]["role"] == "user":
+                content, previous = message["content"], merged[-1]["content"]
+                if isinstance(content, str):
+                    content = f"{previous}\n{content}" if isinstance(previous, str) else previous + [{"type": "text", "text": content}]
+                elif isinstance(previous, str):
+                    content = [{"type": "text", "text": previous}] + content
+                else:
+                    content = previous + content
+                merged[-1] = {"role": "user", "content": content}
+            else:
+                merged.append(message)
+        return merged
 
-    # def get_interactions(self):
+    def get_interactions(self):
         # history settings
-        # if self.history_type == 'full':
-        # message = self.system_messages + self.interactions
-        # elif self.history_type == 'key':
-        #     self.get_key_interactions()
-        #     if self.max_history:
-        #         message = self.system_messages + self.key_interactions[-2*self.max_history:]
-        #     else:
-        #         message = self.system_messages + self.key_interactions
-        # elif self.history_type == 'max':
-        #     message = self.system_messages + self.interactions[-self.max_history * 2:]
-        # else:
-        #     raise NotImplementedError   
-        # return message
+        if self.history_type == 'full':
+            return self.full_message
+        elif self.history_type == 'key':
+            self.get_key_interactions()
+            # [prompt 0, response, prompt, ..., response, prompt]: a prompt and the response that follows are a round
+            key_interactions = self.key_interactions
+            if self.max_history and len(key_interactions) > 2 * self.max_history + 1:
+                # whole rounds, and the first prompt with the task and the first view
+                key_interactions = key_interactions[:1] + key_interactions[-(2 * self.max_history + 1):]
+            # the current prompt is always sent
+            if key_interactions[-1] is not self.interactions[-1]:
+                key_interactions = key_interactions + [self.interactions[-1]]
+            # the prompt after an older key round and the current one are consecutive user turns
+            return self.system_messages + self.merge_user_turns(key_interactions)
+        elif self.history_type == 'max':
+            # the last max_history rounds and the current prompt
+            return self.system_messages + self.interactions[-(self.max_history * 2 + 1):]
+        else:
+            raise NotImplementedError   
+
+    def _get_completion_kwargs(self):
+        return dict(
+            model=self.model,
+            messages=self.message,
+            temperature=0,
+            max_tokens = 256
+        )
+
+    @staticmethod
+    def _get_answer(completion):
+        """The part of a completion the game uses, also what the response cache stores"""
+        return {
+            "content": completion.choices[0].message.content,
+            "prompt_tokens": completion.usage.prompt_tokens,
+            "completion_tokens": completion.usage.completion_tokens,
+        }
+
+    def _read_answer(self, answer, cached=False):
+        logger.debug("Got answer from agent!")
+
+        if cached:
+            self.last_prompt_tokens = self.last_completion_tokens = 0
+            self.cached_prompt_tokens += answer["prompt_tokens"]
+            self.cached_completion_tokens += answer["completion_tokens"]
+            return answer["content"].strip()
+        self.last_prompt_tokens = answer["prompt_tokens"]
+        self.last_completion_tokens = answer["completion_tokens"]
+        self.prompt_tokens += self.last_prompt_tokens
+        self.completion_tokens += self.last_completion_tokens
+        self.profiler.add("agent.prompt_tokens", self.last_prompt_tokens)
+        self.profiler.add("agent.completion_tokens", self.last_completion_tokens)
+        return answer["content"].strip()
+
+    def _lookup_cache(self, kwargs):
+        """The cache key of the request and its cached answer (None on a miss). The key is None without a cache"""
+        if self.cache is None:
+            return None, None
+        with self.profiler.span("agent.cache_lookup"):
+            key = self.cache.key(self.cache_namespace, image_digests=self.image_digests, **kwargs)
+            answer = self.cache.get(key)
+        if answer is None:
+            self.cache_misses += 1
+        else:
+            self.cache_hits += 1
+            self.profiler.add("agent.cache_hits", 1)
+            logger.debug("Got answer from the response cache.")
+        return key, answer
+
+    def _store_cache(self, key, answer):
+        if key is not None:
+            self.cache.put(key, answer)
+
+    def _measure_request(self, kwargs):
+        with self.profiler.span("agent.serialize"):
+            # the client encodes the request again, this gets its size and a comparable encoding time
+            self.profiler.add("agent.request_bytes", len(json.dumps(kwargs)))
+
+    def _create_completion(self, kwargs):
+        """The chat completion. When profiling, the network time and the parse of the response are timed apart"""
+        if not self.profiler.enabled:
+            return self.client.chat.completions.create(**kwargs)
+        self._measure_request(kwargs)
+        with self.profiler.span("agent.network"):
+            raw_response = self.client.chat.completions.with_raw_response.create(**kwargs)
+        with self.profiler.span("agent.parse"):
+            return raw_response.parse()
 
     def ask(self):
-        self.message = self.system_messages + self.interactions
+        with self.profiler.span("agent.ask"):
+            return self.__ask()
+
+    def __ask(self):
+        self.message = self.get_interactions()
             
         # retry = 0
         # token_usage = count_message_tokens(message, model="gpt-4-0613")
@@ -219,23 +461,21 @@ class AgentPlayer:
         # while retry < self.max_retry:
         #     try:  
           
+        kwargs = self._get_completion_kwargs()
+        key, answer = self._lookup_cache(kwargs)
+        if answer is not None:
+            return self._read_answer(answer, cached=True)
+
         try:         
-            completion = self.client.chat.completions.create(
-                model=self.model,
-                messages=self.message,
-                temperature=0,
-                max_tokens = 256
-            )
+            completion = self._create_completion(kwargs)
         except Exception as e:
             traceback.format_exc()
             print('client_call_error==>', completion)
             os.system('pkill -f "main.py"')
 
-        logger.debug("Got answer from agent!")
-
-        self.prompt_tokens += completion.usage.prompt_tokens
-        self.completion_tokens += completion.usage.completion_tokens
-        return completion.choices[0].message.content.strip()
+        answer = self._get_answer(completion)
+        self._store_cache(key, answer)
+        return self._read_answer(answer)
 
     def _save_cur_state(self):
         state = {
@@ -244,3 +484,74 @@ class AgentPlayer:
             "key_interactions": self.key_interactions,
             "interactions": self.interactions,
         }
+
+
+class AsyncAgentPlayer(AgentPlayer):
+    """AgentPlayer whose ask() is a coroutine, so that one process can wait on many LLM calls at once"""
+    def __init__(self, *args, **kwargs):
+        # the startup test is run with the sync client, then the async one is used for the game
+        super().__init__(*args, **kwargs)
+        self.client = create_client(self.model, use_async=True)
+
+    async def ask(self):
+        with self.profiler.span("agent.ask"):
+            return await self.__ask()
+
+    async def _create_completion(self, kwargs):
+        if not self.profiler.enabled:
+            return await self.client.chat.completions.create(**kwargs)
+        self._measure_request(kwargs)
+        with self.profiler.span("agent.network"):
+            raw_response = await self.client.chat.completions.with_raw_response.create(**kwargs)
+        with self.profiler.span("agent.parse"):
+            return raw_response.parse()
+
+    async def __ask(self):
+        self.message = self.get_interactions()
+
+        logger.debug(f"Trying to get answer from agent. msg length:{len(self.message)}")
+        kwargs = self._get_completion_kwargs()
+        key, answer = self._lookup_cache(kwargs)
+        if answer is not None:
+            return self._read_answer(answer, cached=True)
+
+        try:
+            completion = await self._create_completion(kwargs)
+        except Exception:
+            # other episodes share this process, only this one fails
+            logger.error(f"client_call_error==>\n{traceback.format_exc()}")
+            raise
+
+        answer = self._get_answer(completion)
+        # sqlite in the loop thread, it is a single small write
+        self._store_cache(key, answer)
+        return self._read_answer(answer)
+
+
+class ReplayAgentPlayer(AgentPlayer):
+    """Stands for the agent of a recorded episode. The responses come from the record, no model is queried"""
+    def __init__(self, model, resolution=None):
+        """
+        arg:
+        :model: str, the model of the record, the replay is recorded under its name
+        :resolution: (width, height), default None, render the replay at this camera resolution. None uses the one of the model's encoding profile
+        """
+        super().__init__(system_prompt="", model=model)
+        if resolution:
+            self.encoding_profile.update(resolution=tuple(resolution), render=True)
+
+    def _create_client(self):
+        return None
+
+    def _test_client(self):
+        pass
+
+    def replay(self, record):
+        """Take the token usage of a recorded step, so the replay record matches the original one"""
+        self.last_prompt_tokens = record.get("prompt_tokens", 0)
+        self.last_completion_tokens = record.get("completion_tokens", 0)
+        self.prompt_tokens += self.last_prompt_tokens
+        self.completion_tokens += self.last_completion_tokens
+
+    def ask(self):
+        raise RuntimeError("A replayed agent has no model to ask.")
@@ -135,6 +135,22 @@ class BaseGame:
     def ori_data(self):
         return self.__ori_data
 
+    @property
+    def passwords(self):
+        """The passwords of the combination locks, {lock item id: password}"""
+        return {
+            item_id: item["check_func"].password
+            for item_id, item in self.items.items()
+            if isinstance(item.get("check_func", None), ConbinationLock)
+        }
+
+    def set_passwords(self, passwords):
+        """Set the passwords of the combination locks (and the papers carrying them), e.g. to replay a recorded game"""
+        for item_id, password in passwords.items():
+            self.items[item_id]["check_func"] = ConbinationLock(item_id, password=password)
+            if self.items[item_id].get("carried_on", None):
+                self.items[self.items[item_id]["carried_on"]]["password"] = password
+
     def open_box(self, box_id):
         if "box" not in box_id:
             raise ValueError(f"{box_id} is not a box!")
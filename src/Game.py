@@ -3,23 +3,31 @@ import json, re
 from copy import deepcopy
 import traceback
 import time
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 import jsonschema
+import numpy as np
 from jsonschema import validate
 from legent import (
     Environment,
     ResetInfo,
-    save_image,
+    ImageWriter,
     Action,
+    Profiler,
+    NULL_PROFILER,
 )
 from legent.action.api import (
     HideObject,
     ObjectInView,
 )
-from legent.utils.math import vec_xz, distance
+from legent.utils.math import vec, vec_xz, in_view_frustum
 
 from BaseGame import BaseGame
-from Agent import AgentPlayer
+from Recorder import EpisodeRecorder, PROFILE_FILE, iter_records
+from SceneCache import CompiledScene, load_scene
+from Agent import AgentPlayer, get_render_resolution
 from prompt_config import *
 from utils import *
 from log_config import configure_logger, set_log_level
@@ -45,18 +53,65 @@ def print_msg(message):
             print('* ', 'image_url===>', content['image_url'].keys())
       print(Style.RESET_ALL)
 
+def get_record_level_name(level, scene_id, room_num=1, next_room_id=None, suffix_level=""):
+    """The directory name (under GAME_CACHE_DIR) holding all runs of a level-scene_id"""
+    if scene_id is None:
+        return level
+    if room_num > 1: # for multiroom settings
+        level = f"{level}_{suffix_level}" if suffix_level else level
+        if next_room_id:
+            return f"{room_num}rooms-{level}-{scene_id}-{next_room_id}"
+        return f"{room_num}rooms-{level}-{scene_id}"
+    # for single-room settings
+    return f"{level}-{scene_id}" if not suffix_level else f"{level}_{suffix_level}-{scene_id}"
+
+
 class LegentGame:
-    def __init__(self, scene, camera_resolution_width=2048, camera_resolution_height=1024):
+    def __init__(self, scene, camera_resolution_width=CAMERA_RESOLUTION[0], camera_resolution_height=CAMERA_RESOLUTION[1], port=None, env_path=ENV_PATH, env=None, mock_options=None):
+        """
+        arg:
+        :port: int, default None, the grpc port of the Unity client. Concurrent games in one machine must use distinct ports.
+        :env_path: str, default ENV_PATH, the game client to launch, "mock" for the python mock client
+        :mock_options: dict, default None, the options of the mock client, e.g. {"step_latency": 0.05}
+        :env: Environment, default None, a running environment to play in (e.g. leased from an EnvironmentPool) instead of launching one.
+            It must have been launched with the same camera resolution, and stop() leaves it open for its owner.
+        """
         self.scene = scene
-        self.env = Environment(
-            env_path="auto", 
-            camera_resolution_width=camera_resolution_width, 
-            camera_field_of_view=120, 
-            camera_resolution_height=camera_resolution_height
-        )
-        self.scene["player"]["prefab"] = "null"
-        self.scene["player"]["position"] = [100, 0, 100]
-        self.obs = self.env.reset(ResetInfo(self.scene))
+        self.camera_field_of_view = 120
+        self.camera_aspect = camera_resolution_width / camera_resolution_height
+        self.owns_env = env is None
+        if env is None:
+            env = Environment(
+                env_path=env_path, 
+                run_options={"port": port} if port else {},
+                camera_resolution_width=camera_resolution_width, 
+                camera_field_of_view=self.camera_field_of_view, 
+                camera_resolution_height=camera_resolution_height,
+                mock_options=mock_options or {},
+            )
+        self.env = env
+        self.load_scene(scene)
+        # the frame of the last game_shot, handed to the agent without going through the disk
+        self.shot = None
+        self.image_writer = ImageWriter() if SAVE_SCREENSHOTS else None
+        # whether the game client returns one result per call when several api calls are sent in one step
+        self.batch_api_returns = None
+        self.profiler = NULL_PROFILER
+
+    def load_scene(self, scene):
+        """
+        Load a scene on the running game client, e.g. the next room. It costs one reset exchange
+        arg:
+        :scene: dict or CompiledScene, a compiled scene is sent without serializing it again
+        """
+        compiled = scene if isinstance(scene, CompiledScene) else None
+        self.scene = compiled.scene if compiled else scene
+        self.scene["player"] = dict(self.scene["player"], prefab="null", position=[100, 0, 100])
+        if compiled:
+            reset_info = compiled.reset_info(player=self.scene["player"])
+        else:
+            reset_info = ResetInfo(self.scene)
+        self.obs = self.env.reset(reset_info)
         self.__get_interaction_items()
 
         self.pop_items = []
@@ -72,6 +127,15 @@ class LegentGame:
                 self.first_interaction_items[idx] = False
 
     def game_shot(self, step, save_path=None, center_mark=True):
+        """Keep the current frame as the shot of the step. Returns the path it is saved to, None if screenshots are not saved"""
+        with self.profiler.span("game.game_shot"):
+            return self.__game_shot(step, save_path, center_mark)
+
+    def __game_shot(self, step, save_path, center_mark):
+        self.shot = self.obs.image
+        if self.image_writer is None:
+            return None
+
         if not save_path:
             __cache_dir = os.path.join(GAME_CACHE_DIR, "steps")
             if not os.path.exists(__cache_dir):
@@ -81,7 +145,8 @@ class LegentGame:
             
         save_path = os.path.join(__cache_dir, f"{step}.png")
 
-        save_image(self.obs.image, save_path, center_mark=center_mark)
+        # written in the background, the agent gets the frame from memory
+        self.image_writer.save(self.shot, save_path, center_mark=center_mark)
 
         return save_path
 
@@ -91,36 +156,77 @@ class LegentGame:
         else:
             self.obs = self.env.step()
 
+    async def step_async(self, action: Action = None):
+        self.obs = await self.env.step_async(action)
+
     def stop(self):
-        self.env.close()
+        if self.image_writer is not None:
+            self.image_writer.close()
+        if self.owns_env:
+            self.env.close()
 
     def hide(self, id):
-        api_calls = [HideObject(id)]
-        self.obs = self.env.step(Action(api_calls=api_calls))
+        # sent with the next action, the object disappears in the screenshot of that step
+        self.env.queue_api_call(HideObject(id))
         self.interaction_items.pop(self.scene["instances"][id]["item_id"])
 
+    def objects_in_view(self, object_ids):
+        """Ask the game client whether each object is in view, with all the ObjectInView calls in one step"""
+        if not object_ids:
+            return []
+        if len(object_ids) == 1 or self.batch_api_returns is not False:
+            self.obs = self.env.step(Action(api_calls=[ObjectInView(object_id) for object_id in object_ids]))
+            api_returns = self.obs.api_returns
+            if len(object_ids) == 1:
+                return [api_returns["in_view"]]
+            self.batch_api_returns = isinstance(api_returns, list)
+            if self.batch_api_returns:
+                return [api_return["in_view"] for api_return in api_returns]
+            logger.warning("The game client returns only one result for batched api calls, the objects will be checked one by one.")
+
+        in_views = []
+        for object_id in object_ids:
+            self.obs = self.env.step(Action(api_calls=[ObjectInView(object_id)]))
+            in_views.append(self.obs.api_returns["in_view"])
+        return in_views
+
     def agent_grab_object_id(self):
+        with self.profiler.span("game.grab_object_id"):
+            return self.__agent_grab_object_id()
+
+    def __agent_grab_object_id(self):
         object_ids = []
         object_in_views = []
-        for item_id, object_id in self.interaction_items.items():
-            self.obs = self.env.step(Action(api_calls=[ObjectInView(object_id)]))
-            if self.obs.api_returns["in_view"]:
-                object_in_views.append(object_id)
-                if (
-                    distance(
-                        vec_xz(
-                            self.obs.game_states["instances"][object_id]["position"]
-                        ),
-                        vec_xz(self.obs.game_states["agent"]["position"]),
-                    )
-                    < MAX_INTERACTION_DISTANCE
-                ):
-                    object_ids.append(object_id)
+        if not self.interaction_items:
+            return object_ids, object_in_views
+
+        # Cull the objects out of the camera frustum in python, only the rest are checked by the game client (occlusion)
+        game_states = self.obs.game_states
+        camera = game_states["agent_camera"]
+        candidates = np.array(list(self.interaction_items.values()))
+        positions = np.array([vec(game_states["instances"][object_id]["position"]) for object_id in candidates])
+        in_frustum = in_view_frustum(
+            positions,
+            vec(camera["position"]),
+            vec(camera["forward"]),
+            self.camera_field_of_view,
+            self.camera_aspect,
+            margin=GRAB_FRUSTUM_MARGIN,
+        )
+        candidates, positions = candidates[in_frustum], positions[in_frustum]
+        distances = np.linalg.norm(positions[:, [0, 2]] - vec_xz(game_states["agent"]["position"]), axis=1)
+
+        in_views = self.objects_in_view([int(object_id) for object_id in candidates])
+        for object_id, in_view, object_distance in zip(candidates, in_views, distances):
+            if in_view:
+                object_in_views.append(int(object_id))
+                if object_distance < MAX_INTERACTION_DISTANCE:
+                    object_ids.append(int(object_id))
 
         return object_ids, object_in_views
 
     def get_agent_position(self):
-        return self.obs.game_states["agent"]["position"]
+        return self.obs.get_state("agent")["position"]
             
 
 class Game:
@@ -139,15 +245,42 @@ class Game:
         continue_game = False,
         suffix_level = "",
         next_room_id = None,
+        port = None,
+        trial = None,
+        env_path = ENV_PATH,
+        profile = False,
+        tracer = None,
+        env = None,
+        mock_options = None,
     ):
+        """
+        arg:
+        :port: int, default None, the grpc port of the Unity client, if None the default port is used
+        :trial: int, default None, the run_id of level-scene_id to record into. If None, a new run_id is picked automatically
+        :env_path: str, default ENV_PATH, the game client to launch, "mock" for the python mock client
+        :profile: bool, default False, record the timings and payload sizes of every step into [record dir]/profile.jsonl
+        :tracer: TraceWriter, default None, also add the timings to this chrome trace (which the caller saves), tagged with the record dir. Implies profile
+        :env: Environment, default None, play in this running environment (e.g. leased from an EnvironmentPool) instead of launching a Unity client.
+            It is left open when the game stops, and the camera is the one it was launched with
+        :mock_options: dict, default None, the options of the mock client when env_path is "mock", e.g. {"step_latency": 0.05}
+        """
         self.agent = agent
+        self.profiler = NULL_PROFILER
+        self.port = port
+        self.env_path = env_path
+        self.mock_options = mock_options
+        self.env = env
         self.level_data = level_data
         self.scene_path = scene_path
-        self.scene = format_scene(scene_path)
-        if self.scene.get("_password", None):
-            self.base_game = BaseGame(level_data, hint=hint, password=self.scene["_password"])
-        else:
-            self.base_game = BaseGame(level_data, hint=hint)
+        self.compiled_scene = load_scene(scene_path)
+        self.scene = self.compiled_scene.scene
+        self.hint = hint
+        self.base_game = self._create_base_game(level_data, self.scene)
+        # the passwords of the base game (kept for all the rooms), recorded to replay the episode
+        self.room_passwords = [self.base_game.passwords]
+        # the next room, formatted in the background while the current one is played
+        self.next_room = None
+        self.__room_loader = None
         self.__load_game()
         self.level = level
         self.scene_id = scene_id
@@ -163,34 +296,79 @@ class Game:
 
         self.steps = -1
         self.__add_steps()
+        self.exchanges_per_step = []
 
         if hint:
             self.Prompt = PromptTemplate_Hint
         else:
             self.Prompt = PromptTemplate_Base
 
-        if scene_id is not None:
-            if room_num > 1: # for multiroom settings
-                if next_room_id:
-                    level = f"{room_num}rooms-{level}-{scene_id}-{next_room_id}"
-                else:
-                    level = f"{room_num}rooms-{level}-{scene_id}"
-            else: # for single-room settings
-                level = f"{level}-{scene_id}" if not suffix_level else f"{level}_{suffix_level}-{scene_id}"
-                
-        self.record_save_path = os.path.join(GAME_CACHE_DIR, level, self.agent.model+"_t_1") 
+        level = get_record_level_name(level, scene_id, room_num, next_room_id, suffix_level)
+
+        self.record_save_path = os.path.join(GAME_CACHE_DIR, level, f"{self.agent.model}_t_{trial or 1}")
         # _t_i: the i-th run (run_id) of level-scene_id, if tested for multiple runs
         # the following lines automatically detect if a record for a scene exists, and will increase the run_id for multiple runs
-        if not os.path.exists(self.record_save_path):
+        if trial is not None:
+            os.makedirs(self.record_save_path, exist_ok=True)
+        elif not os.path.exists(self.record_save_path):
             os.makedirs(self.record_save_path)
         else:
             self.record_save_path = self.check_dirs(self.record_save_path)
+        # the run_id the record dir was resolved to
+        self.trial = int(self.record_save_path.rsplit("_t_", 1)[1])
+
+        self.recorder = EpisodeRecorder(self.record_save_path)
+        if profile or tracer is not None:
+            self.profiler = Profiler(
+                os.path.join(self.record_save_path, PROFILE_FILE), tracer=tracer,
+                episode=os.path.relpath(self.record_save_path, GAME_CACHE_DIR),
+            )
+            self.__set_profiler()
 
         self.story_only = story_only
         self.continue_game = continue_game
 
+    def _create_base_game(self, level_data, scene):
+        if scene.get("_password", None):
+            return BaseGame(level_data, hint=self.hint, password=scene["_password"])
+        return BaseGame(level_data, hint=self.hint)
+
+    def __load_room(self, scene_path, level_data):
+        return scene_path, level_data, load_scene(scene_path)
+
+    def _preload_next_room(self):
+        """Load the compiled scene of the next room in the background"""
+        if not self.scene_path_list:
+            self.next_room = None
+            return
+        if self.__room_loader is None:
+            self.__room_loader = ThreadPoolExecutor(max_workers=1)
+        self.next_room = self.__room_loader.submit(self.__load_room, self.scene_path_list.pop(0), self.level_data_list.pop(0))
+
+    def _enter_next_room(self):
+        """Swap the next room in on the running game client. The base game (and its bag) carries over, only its clear state is reset"""
+        scene_path, level_data, compiled = self.next_room.result()
+        logger.warning(f"In a new scene: {scene_path}\nnew level: {level_data}")
+        self.base_game.clear = False
+        self.compiled_scene = compiled
+        with self.profiler.span("game.load_scene"):
+            self.game.load_scene(compiled)
+        self.scene = self.game.scene
+        self._preload_next_room()
+
     def __load_game(self):
-        self.game = LegentGame(self.scene)
+        # models with a rendering profile get their images rendered at the resolution they are sent at
+        width, height = get_render_resolution(self.agent.encoding_profile)
+        self.game = LegentGame(self.compiled_scene, camera_resolution_width=width, camera_resolution_height=height,
+                               port=self.port, env_path=self.env_path, env=self.env, mock_options=self.mock_options)
+        self.__set_profiler()
+
+    def __set_profiler(self):
+        self.agent.profiler = self.profiler
+        self.game.profiler = self.profiler
+        self.game.env.set_profiler(self.profiler)
+        if self.game.image_writer is not None:
+            self.game.image_writer.profiler = self.profiler
 
     def check_dirs(self, path, i=10):
         _path, idx = path.split('_t_')
@@ -364,14 +542,23 @@ class Game:
         return Action(**action_list), desc, obj_interact, obj_interact_fail
 
     def step(self, response):
+        exchanges = self.game.env.exchanges
         action, desc, obj_interact, obj_interact_fail = self.get_action(response)
         self.game.step(action)
+        save_path = self._end_action(exchanges)
+
+        return desc, save_path, obj_interact, obj_interact_fail
+
+    def _end_action(self, exchanges):
+        """exchanges: the exchange count of the environment before the step"""
         self.__add_steps()
+        self.exchanges_per_step.append(self.game.env.exchanges - exchanges)
 
         save_path = self.game.game_shot(self.steps, save_path = self.record_save_path)
-        logger.info(f"step:{self.steps} --> moved and saved successfully!")
+        self.shot = self.game.shot
+        logger.info(f"step:{self.steps} --> moved and saved successfully! ({self.exchanges_per_step[-1]} exchanges with the game client)")
 
-        return desc, save_path, obj_interact, obj_interact_fail
+        return save_path
 
     def replace_base64_with_placeholder(self, text, placeholder="---image---"):
         if not isinstance(text, str):
@@ -381,7 +568,7 @@ class Game:
         replaced_text = re.sub(pattern, r"\1" + placeholder, text)
         return replaced_text
 
-    def ask_for_action(self, desc, save_path, obj_interact, obj_interact_fail):
+    def get_step_prompt(self, desc, obj_interact, obj_interact_fail):
         if desc:
             if obj_interact:
                 if not obj_interact_fail:
@@ -402,28 +589,34 @@ class Game:
             "The items in your bag usable include: " + self.base_game.bag_desc if self.base_game.bag_desc else "Nothing in your bag."
         )
 
-        step_prompt = self.Prompt.STEP_PROMPT.format(
+        return self.Prompt.STEP_PROMPT.format(
             interaction_result=interaction_desc, bag_desc=bag_desc
         )
 
-        self.agent.add_problem(step_prompt, save_path)
+    def ask_for_action(self, desc, save_path, obj_interact, obj_interact_fail):
+        step_prompt = self.get_step_prompt(desc, obj_interact, obj_interact_fail)
+        self.agent.add_problem(step_prompt, save_path, image=self.shot)
 
         # retry = 0
         # while retry < self.max_retry:
         ori_response = self.agent.ask()
+        return self._parse_response(ori_response), step_prompt
+
+    def _parse_response(self, ori_response):
         assert ori_response, 'response from client is null'
-        response = self.__format_repsonse(ori_response)
+        with self.profiler.span("game.format_response"):
+            response = self.__format_repsonse(ori_response)
         # if ori_response:
         #     response = self.__format_repsonse(ori_response)
         # else:
         #     response = None
 
         if response:
-            return response, step_prompt
+            return response
         else:
             print(ori_response)
             # retry += 1
-            return {}, step_prompt
+            return {}
 
     def read_note(self):
         return self.agent.notes
@@ -462,83 +655,279 @@ class Game:
             return desc
         return desc 
 
-    def main(self, args):
-        room_left_to_escape, escaped_rooms = self.room_num, 0
+    def _start_episode(self):
+        """Take the initial shot and prepare the rooms to play. Returns the inputs of the first step"""
+        self.room_left_to_escape, self.escaped_rooms = self.room_num, 0
 
-        logger.info(f"Start playing the game. There are {room_left_to_escape} rooms.")
+        logger.info(f"Start playing the game. There are {self.room_left_to_escape} rooms.")
 
         save_path = self.game.game_shot(self.steps, save_path = self.record_save_path)
+        # the last screenshot, kept here since a new room replaces self.game
+        self.shot = self.game.shot
         desc = "The initial scene is shown in the picture."
         obj_interact, obj_interact_fail = False, False
 
         # for multi-room
-        level_data_list = []
-        scene_path_list = []        
-        if room_left_to_escape > 1:
+        self.level_data_list = []
+        self.scene_path_list = []        
+        if self.room_left_to_escape > 1:
             if self.next_room_id:
-                level_data_list = [self.level_data, self.level_data.replace(f"1_1.json", f"1_{self.next_room_id}.json")]
-                scene_path_list = [self.scene_path, self.scene_path.replace(f"1_1.json", f"1_{self.next_room_id}.json")]
+                self.level_data_list = [self.level_data, self.level_data.replace(f"1_1.json", f"1_{self.next_room_id}.json")]
+                self.scene_path_list = [self.scene_path, self.scene_path.replace(f"1_1.json", f"1_{self.next_room_id}.json")]
             else:
-                for i in range(2,room_left_to_escape+1):
+                for i in range(2,self.room_left_to_escape+1):
                     new_level_data = re.sub(r"(\d+)(?=\.json$)", str(i), self.level_data)
                     new_scene_path = re.sub(r"(\d+)(?=\.json$)", str(i), self.scene_path)
-                    level_data_list.append(new_level_data)
-                    scene_path_list.append(new_scene_path)
+                    self.level_data_list.append(new_level_data)
+                    self.scene_path_list.append(new_scene_path)
+            self._preload_next_room()
 
-        grab_tp = 0
+        self.grab_tp = 0
 
-        while not self.base_game.clear:
-            bag_len = len(self.base_game.bag_desc)
-            response, step_prompt = self.ask_for_action(desc, save_path, obj_interact, obj_interact_fail)
-            self.agent.step_meta_info[-1]['step_prompt'] = step_prompt
-            self.agent.step_meta_info[-1]['response'] = response
-            
-            assert response
-            self.agent.add_response(json.dumps(response))
-            if len(self.base_game.bag_desc) > bag_len:
-                grab_tp += 1
-            
-            print('step===>', self.steps, 'interactions:', len(self.agent.interactions))
-            print('token usage===>', self.agent.prompt_tokens, self.agent.completion_tokens)
-            print('step_prompt===>', self.replace_base64_with_placeholder(step_prompt))
-            print('response===>\n', json.dumps(response, indent=2))
-            print('bag===>', self.base_game.bag_desc)
-            print('grab_tp===>', grab_tp)
+        return desc, save_path, obj_interact, obj_interact_fail
 
-            desc, save_path, obj_interact, obj_interact_fail = self.step(response)
-            desc = self.check_new_room_desc(desc, escaped_rooms, room_left_to_escape)
+    def _add_response(self, response, step_prompt, bag_len):
+        self.agent.step_meta_info[-1]['step_prompt'] = step_prompt
+        self.agent.step_meta_info[-1]['response'] = response
+        
+        assert response
+        self.agent.add_response(json.dumps(response))
+        if len(self.base_game.bag_desc) > bag_len:
+            self.grab_tp += 1
+        
+        print('step===>', self.steps, 'interactions:', len(self.agent.interactions))
+        print('token usage===>', self.agent.prompt_tokens, self.agent.completion_tokens)
+        print('step_prompt===>', self.replace_base64_with_placeholder(step_prompt))
+        print('response===>\n', json.dumps(response, indent=2))
+        print('bag===>', self.base_game.bag_desc)
+        print('grab_tp===>', self.grab_tp)
+
+    def _record_step(self, step, image_path, response, step_prompt, obj_interact, obj_interact_fail, timings):
+        """image_path: the screenshot the agent responded to"""
+        with self.profiler.span("game.record_step"):
+            self.__record_step(step, image_path, response, step_prompt, obj_interact, obj_interact_fail, timings)
+        self.profiler.end_step(step, exchanges=self.exchanges_per_step[-1], timings=timings)
+
+    def __record_step(self, step, image_path, response, step_prompt, obj_interact, obj_interact_fail, timings):
+        self.recorder.add_step(
+            step,
+            response,
+            list(self.base_game.bag.items),
+            obj_interact,
+            obj_interact_fail,
+            image_path,
+            step_prompt=self.replace_base64_with_placeholder(step_prompt),
+            prompt_tokens=self.agent.last_prompt_tokens,
+            completion_tokens=self.agent.last_completion_tokens,
+            exchanges=self.exchanges_per_step[-1],
+            image_bytes=self.agent.last_image_bytes,
+            image_tokens=self.agent.last_image_tokens,
+            timings=timings,
+        )
 
-            if self.steps > args.max_allowed_steps:
-                logger.info(f'\n\n{self.steps} steps, force exit!!!\n\n')
-                break
+    def _end_step(self, desc, args):
+        """Check the room state after a step. Returns the desc for the next step and whether the game is over"""
+        desc = self.check_new_room_desc(desc, self.escaped_rooms, self.room_left_to_escape)
+
+        if self.steps > args.max_allowed_steps:
+            logger.info(f'\n\n{self.steps} steps, force exit!!!\n\n')
+            return desc, True
 
-            if self.base_game.clear:
-                if room_left_to_escape > 1: 
-                    room_left_to_escape -= 1
-                    tmp_bag = self.base_game.bag
-                    self.base_game.clear = False
-                    self.game.stop()
+        if self.base_game.clear:
+            if self.room_left_to_escape > 1: 
+                self.room_left_to_escape -= 1
+                self._enter_next_room()
 
-                    scene_path = scene_path_list.pop(0)
-                    level_data = level_data_list.pop(0)
-                    logger.warning(f"In a new scene: {scene_path}\nnew level: {level_data}")
-                    self.scene = json.load(open(scene_path))      
-                    self.__load_game()
-                    self.base_game.bag = tmp_bag
+            else:
+                return desc, True
 
-                else:
-                    break
-                
+        return desc, False
+
+    def _end_episode(self):
         print('full msg===>\n')
         print_msg(self.agent.message)
 
         if self.base_game.clear:
-            print(f"Game stop at step {self.steps}. Escaped succesfully!")
-            # results.append({'info': f"Game stop at step {self.steps}. Escaped succesfully!"})
+            info = f"Game stop at step {self.steps}. Escaped succesfully!"
         else:
-            print(f"Game stop at step {self.steps}. Force exit!")
-            # results.append({'info': f"Game stop at step {self.steps}. Force exit!"})
+            info = f"Game stop at step {self.steps}. Force exit!"
+        print(info)
+        self.recorder.add_info(
+            info,
+            prompt_tokens=self.agent.prompt_tokens,
+            completion_tokens=self.agent.completion_tokens,
+            image_bytes=self.agent.image_bytes,
+            image_tokens=self.agent.image_tokens,
+            cached_prompt_tokens=self.agent.cached_prompt_tokens,
+            cached_completion_tokens=self.agent.cached_completion_tokens,
+            cache_hits=self.agent.cache_hits,
+            cache_misses=self.agent.cache_misses,
+            passwords=self.room_passwords,
+            puzzle_images={item_id: self.recorder.image_ref(path) for item_id, path in self.base_game.puzzle_images.items()},
+        )
+        summary = self.profiler.close()
+        if summary:
+            logger.info("Step profile (seconds):\n" + "\n".join(
+                f"{name:<24} count {span['count']:>4}  p50 {span['p50']:.4f}  p95 {span['p95']:.4f}  total {span['total']:.2f}"
+                for name, span in summary["spans"].items()
+            ))
+
+        self.close()
+
+        return {"steps": self.steps, "clear": self.base_game.clear, "bag": list(self.base_game.bag.items),
+                "prompt_tokens": self.agent.prompt_tokens, "completion_tokens": self.agent.completion_tokens,
+                "exchanges_per_step": self.exchanges_per_step,
+                "image_bytes": self.agent.image_bytes, "image_tokens": self.agent.image_tokens,
+                "cached_prompt_tokens": self.agent.cached_prompt_tokens,
+                "cached_completion_tokens": self.agent.cached_completion_tokens,
+                "cache_hits": self.agent.cache_hits, "cache_misses": self.agent.cache_misses}
+
+    def close(self):
+        """Close the record file, the room loader and the game, also when the episode failed. Can be called more than once"""
+        if getattr(self, "_closed", False):
+            return
+        self._closed = True
+        if getattr(self, "recorder", None) is not None:
+            self.recorder.close()
+        if self.__room_loader is not None:
+            self.__room_loader.shutdown(wait=False, cancel_futures=True)
+        if getattr(self, "game", None) is not None:
+            self.game.stop()
 
-        
+    def main(self, args):
+        desc, save_path, obj_interact, obj_interact_fail = self._start_episode()
 
-        self.game.stop()  
\ No newline at end of file
+        while not self.base_game.clear:
+            bag_len = len(self.base_game.bag_desc)
+            step, image_path, start = self.steps, save_path, time.time()
+            response, step_prompt = self.ask_for_action(desc, save_path, obj_interact, obj_interact_fail)
+            llm_time = time.time() - start
+            self._add_response(response, step_prompt, bag_len)
+
+            desc, save_path, obj_interact, obj_interact_fail = self.step(response)
+            self._record_step(step, image_path, response, step_prompt, obj_interact, obj_interact_fail,
+                              {"llm": llm_time, "env": time.time() - start - llm_time})
+            desc, game_over = self._end_step(desc, args)
+            if game_over:
+                break
+
+        return self._end_episode()
+
+
+class AsyncGame(Game):
+    """
+    Game whose main loop is a coroutine. The LLM calls are awaited and the environment work runs in the loop's
+    default executor, so one process can play many games (each with its own Unity client) at the same time.
+    """
+    async def step(self, response):
+        loop = asyncio.get_running_loop()
+        exchanges = self.game.env.exchanges
+        # the grab action queries the environment, so the whole action parsing is done in the executor
+        action, desc, obj_interact, obj_interact_fail = await loop.run_in_executor(None, self.get_action, response)
+        await self.game.step_async(action)
+        save_path = await loop.run_in_executor(None, self._end_action, exchanges)
+
+        return desc, save_path, obj_interact, obj_interact_fail
+
+    async def ask_for_action(self, desc, save_path, obj_interact, obj_interact_fail):
+        loop = asyncio.get_running_loop()
+        step_prompt = self.get_step_prompt(desc, obj_interact, obj_interact_fail)
+        # encoding the screenshot is cpu work
+        await loop.run_in_executor(None, lambda: self.agent.add_problem(step_prompt, save_path, image=self.shot))
+
+        ori_response = await self.agent.ask()
+        return self._parse_response(ori_response), step_prompt
+
+    async def main(self, args):
+        loop = asyncio.get_running_loop()
+        desc, save_path, obj_interact, obj_interact_fail = await loop.run_in_executor(None, self._start_episode)
+
+        while not self.base_game.clear:
+            bag_len = len(self.base_game.bag_desc)
+            step, image_path, start = self.steps, save_path, time.time()
+            response, step_prompt = await self.ask_for_action(desc, save_path, obj_interact, obj_interact_fail)
+            llm_time = time.time() - start
+            self._add_response(response, step_prompt, bag_len)
+
+            desc, save_path, obj_interact, obj_interact_fail = await self.step(response)
+            self._record_step(step, image_path, response, step_prompt, obj_interact, obj_interact_fail,
+                              {"llm": llm_time, "env": time.time() - start - llm_time})
+            # a room transition loads the next scene on the game client
+            desc, game_over = await loop.run_in_executor(None, self._end_step, desc, args)
+            if game_over:
+                break
+
+        return await loop.run_in_executor(None, self._end_episode)
+
+
+class ReplayGame(Game):
+    """
+    Game driven by the responses of a recorded episode (record_path) instead of a model, as fast as the game client allows.
+    The bag and the clear state are checked against the record after every step. Used to benchmark or regression-test
+    the game loop, and to render the screenshots of an episode again, e.g. at another resolution (see ReplayAgentPlayer).
+    """
+    def __init__(self, agent, *args, **kwargs):
+        record_path = kwargs.get("record_path", None)
+        if not record_path:
+            raise ValueError("ReplayGame needs the record_path of the episode to replay.")
+
+        records = list(iter_records(record_path))
+        self.replay_steps = [record for record in records if "step" in record]
+        self.replay_info = next((record for record in records if "info" in record), None)
+        if not self.replay_steps:
+            raise ValueError(f"No step is recorded in {record_path}.")
+        # the recorded passwords of every room, set on the base games as they are created
+        self.replay_passwords = (self.replay_info or {}).get("passwords", None) or []
+        self.__rooms = 0
+        # the differences with the record: {"step", "field", "recorded", "replayed"}
+        self.mismatches = []
+
+        super().__init__(agent, *args, **kwargs)
+
+    def _create_base_game(self, level_data, scene):
+        base_game = super()._create_base_game(level_data, scene)
+        room_id, self.__rooms = self.__rooms, self.__rooms + 1
+        if room_id < len(self.replay_passwords):
+            base_game.set_passwords(self.replay_passwords[room_id])
+        elif base_game.passwords:
+            logger.warning("The record has no passwords for this room, the password inputs may not get the recorded results.")
+        return base_game
+
+    def __check(self, step, field, recorded, replayed):
+        if recorded != replayed:
+            logger.error(f"Step {step}: the {field} differs from the record. recorded: {recorded}, replayed: {replayed}")
+            self.mismatches.append({"step": step, "field": field, "recorded": recorded, "replayed": replayed})
+
+    def main(self, args=None):
+        start_time = time.time()
+        desc, save_path, obj_interact, obj_interact_fail = self._start_episode()
+        # the recorded episode decided when to stop, the replay just runs out of records
+        no_limit = argparse.Namespace(max_allowed_steps=float("inf"))
+
+        for record in self.replay_steps:
+            step, image_path, start = self.steps, save_path, time.time()
+            self.__check(step, "step", record["step"], step)
+            response = record["response"]
+            self.agent.replay(record)
+
+            desc, save_path, obj_interact, obj_interact_fail = self.step(response)
+            self._record_step(step, image_path, response, "", obj_interact, obj_interact_fail,
+                              {"llm": 0, "env": time.time() - start})
+            self.__check(step, "bag", record["bag"], list(self.base_game.bag.items))
+            desc, game_over = self._end_step(desc, no_limit)
+            if game_over:
+                break
+
+        self.__check(self.steps, "steps", self.replay_steps[-1]["step"] + 1, self.steps)
+        if self.replay_info is not None:
+            self.__check(self.steps, "clear", "Escaped succesfully!" in self.replay_info["info"], self.base_game.clear)
+        result = self._end_episode()
+        result.update({
+            "replayed_steps": len(self.replay_steps), "time": time.time() - start_time,
+            "verified": not self.mismatches, "mismatches": self.mismatches,
+        })
+        logger.info(
+            f"Replayed {len(self.replay_steps)} steps of {self.record_path} in {result['time']:.2f}s, "
+            + ("matching the record." if result["verified"] else f"{len(self.mismatches)} differences with the record!")
+        )
+        return result
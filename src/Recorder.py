@@ -0,0 +1,81 @@
+import os
+import json
+
+RECORD_FILE = "records.jsonl"
+LEGACY_RECORD_FILE = "records.json"
+PROFILE_FILE = "profile.jsonl" # step timings and payload sizes, written when the game is profiled
+
+
+class EpisodeRecorder:
+    """
+    Append-only recorder of an episode, one json line per step in [record_dir]/records.jsonl.
+    Every line is flushed when written, so the steps played so far survive a crash.
+    The last line is {"info": ...} once the game stops, like the records.json read by eval_rst.py.
+    """
+    def __init__(self, record_dir):
+        self.record_dir = record_dir
+        self.path = os.path.join(record_dir, RECORD_FILE)
+        # a new episode in this dir starts a new record
+        self.__file = open(self.path, "w", encoding="utf-8")
+
+    def image_ref(self, image_path):
+        """Images are recorded by their path relative to the record dir rather than inline"""
+        if not image_path:
+            return None
+        return os.path.relpath(image_path, self.record_dir)
+
+    def write(self, record):
+        self.__file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.__file.flush()
+
+    def add_step(self, step, response, bag, obj_interact, obj_interact_fail, image_path=None, **kwargs):
+        """kwargs: anything else to record for the step, e.g. token usage and timings"""
+        record = {
+            "step": step,
+            "response": response,
+            "bag": bag,
+            "obj_interact": obj_interact,
+            "obj_interact_fail": obj_interact_fail,
+            "image": self.image_ref(image_path),
+        }
+        record.update(kwargs)
+        self.write(record)
+
+    def add_info(self, info, **kwargs):
+        record = {"info": info}
+        record.update(kwargs)
+        self.write(record)
+
+    def close(self):
+        if not self.__file.closed:
+            self.__file.close()
+
+
+def get_record_file(record_dir):
+    """The record of a run dir, records.jsonl or the legacy records.json. None if the run has no record"""
+    for name in [RECORD_FILE, LEGACY_RECORD_FILE]:
+        path = os.path.join(record_dir, name)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def iter_records(record_dir):
+    """Yield the records of a run one by one, without loading the whole file"""
+    path = get_record_file(record_dir)
+    if path is None:
+        return
+    if path.endswith(LEGACY_RECORD_FILE):
+        with open(path, encoding="utf-8") as f:
+            yield from json.load(f)
+        return
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # the last line of a crashed run may be cut
+                continue
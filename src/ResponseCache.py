@@ -0,0 +1,132 @@
+import os
+import re
+import json
+import time
+import base64
+import hashlib
+import sqlite3
+import threading
+
+from config import *
+from log_config import configure_logger
+
+logger = configure_logger(__name__)
+
+_image_pattern = re.compile(r"data:image\/[a-zA-Z]+;base64,([A-Za-z0-9+/=]+)")
+
+
+def _hash_image(match):
+    # the same image encoded (or wrapped) differently has the same key
+    return "image-sha256:" + hashlib.sha256(base64.b64decode(match.group(1))).hexdigest()
+
+
+def _strip_images(value, digests):
+    if isinstance(value, str):
+        digest = digests.get(value)
+        return digest if digest is not None else _image_pattern.sub(_hash_image, value)
+    if isinstance(value, list):
+        return [_strip_images(v, digests) for v in value]
+    if isinstance(value, dict):
+        return {k: _strip_images(v, digests) for k, v in value.items()}
+    return value
+
+
+# the size of the cache is only checked every EVICT_INTERVAL puts of a process, it may exceed max_size by that many responses
+EVICT_INTERVAL = 64
+
+
+class ResponseCache:
+    """
+    Disk cache of the LLM responses, shared by the processes playing on one machine.
+    The calls are made with temperature 0, so an identical request (model, parameters and messages) gets the cached
+    response instead of being paid for again, e.g. when a sweep is rerun after a crash.
+    The least recently used responses are evicted once the cache is larger than max_size MB.
+    """
+    def __init__(self, path=RESPONSE_CACHE_PATH, max_size=RESPONSE_CACHE_MAX_SIZE, bypass=False):
+        """
+        arg:
+        :path: str, the sqlite file of the cache
+        :max_size: int, MB of responses kept
+        :bypass: bool, never read from the cache, the responses are still stored
+        """
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.path = path
+        self.max_size = max_size * 1024 * 1024
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self.__puts = 0
+
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.__db.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT, size INTEGER, last_used REAL)"
+        )
+        self.__db.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.__db.commit()
+
+    @staticmethod
+    def image_digest(url):
+        """What an image url of a request is replaced by in its key, see key()"""
+        return _image_pattern.sub(_hash_image, url)
+
+    @staticmethod
+    def key(namespace="", image_digests=None, **request):
+        """
+        Stable hash of a chat completion request, the images are hashed by their decoded bytes.
+        namespace: requests in different namespaces never share responses, e.g. the trials of a setting
+        image_digests: dict, image url -> image_digest(url) of the images already hashed, e.g. when they were added to the history
+        """
+        request = _strip_images(request, image_digests or {})
+        data = json.dumps({"namespace": namespace, "request": request}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """The cached response of key, None on a miss"""
+        if self.bypass:
+            self.misses += 1
+            return None
+        with self.__lock:
+            row = self.__db.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.__db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+                self.__db.commit()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key, response):
+        """response: dict, anything json serializable"""
+        data = json.dumps(response, ensure_ascii=False)
+        with self.__lock:
+            self.__db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, data, len(data), time.time())
+            )
+            self.__puts += 1
+            if self.__puts % EVICT_INTERVAL == 1:
+                self.__evict()
+            self.__db.commit()
+
+    def __evict(self):
+        size = self.__db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if size <= self.max_size:
+            return
+        removed = 0
+        for key, item_size in self.__db.execute("SELECT key, size FROM responses ORDER BY last_used").fetchall():
+            if size <= self.max_size:
+                break
+            self.__db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            size -= item_size
+            removed += 1
+        logger.debug(f"{removed} responses evicted from the response cache.")
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        with self.__lock:
+            self.__db.close()
@@ -0,0 +1,231 @@
+"""
+Compiled scenes: the scene JSON with the prefab paths resolved, checked against the disk and the JSON of every top-level
+field dumped once, so that loading a scene on the game client costs no parsing and almost no serialization.
+
+The compiled scenes are kept as pickle snapshots in SCENE_CACHE_DIR, keyed by the source path and PREFAB_DIR and
+checked against the source mtime (and its hash if the mtime changed), and against the stats of the prefab files the
+scene references, so that the missing files are found again once a prefab is added or removed.
+To compile and check every scene of the levels:
+
+    python SceneCache.py ../levels/scene_data
+"""
+import os
+import sys
+import json
+import pickle
+import hashlib
+import argparse
+import threading
+
+from legent import ResetInfo
+
+from config import *
+from utils import resolve_prefab_paths
+from log_config import configure_logger
+
+logger = configure_logger(__name__)
+
+SNAPSHOT_VERSION = 3
+
+
+class CompiledScene:
+    def __init__(self, path, scene, missing, parts=None):
+        """
+        arg:
+        :path: str, the scene JSON
+        :scene: dict, the scene with the prefab paths resolved
+        :missing: list, the prefab (or material) files the scene references that do not exist
+        :parts: dict, the JSON of every top-level field of the scene, dumped here if None
+        """
+        self.path = path
+        self.scene = scene
+        self.missing = missing
+        # the reset payload is joined from them
+        self.parts = parts if parts is not None else {key: json.dumps(value) for key, value in scene.items()}
+
+    def to_json(self, **overrides):
+        """json.dumps(scene) with the top-level fields of overrides replaced (or added), only those are serialized"""
+        parts = [
+            f"{json.dumps(key)}: {json.dumps(overrides[key]) if key in overrides else part}"
+            for key, part in self.parts.items()
+        ]
+        parts += [f"{json.dumps(key)}: {json.dumps(value)}" for key, value in overrides.items() if key not in self.parts]
+        return "{" + ", ".join(parts) + "}"
+
+    def reset_info(self, **overrides):
+        return ResetInfo.from_json(self.to_json(**overrides))
+
+
+def _find_prefabs(value, prefab_dir, found):
+    if isinstance(value, str):
+        if value.startswith(prefab_dir):
+            found.append(value)
+    elif isinstance(value, list):
+        for v in value:
+            _find_prefabs(v, prefab_dir, found)
+    elif isinstance(value, dict):
+        for v in value.values():
+            _find_prefabs(v, prefab_dir, found)
+    return found
+
+
+def _prefab_stats(paths):
+    """(mtime, size) of every file in paths, None if it does not exist"""
+    stats = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            stats[path] = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            stats[path] = None
+    return stats
+
+
+def _is_fresh(prefab_stats):
+    return _prefab_stats(prefab_stats) == prefab_stats
+
+
+class SceneCache:
+    def __init__(self, cache_dir=SCENE_CACHE_DIR, strict=False):
+        """
+        arg:
+        :cache_dir: str, the dir of the snapshots, None to only compile in memory
+        :strict: bool, raise FileNotFoundError if a scene references a prefab file that does not exist, instead of a warning
+        """
+        self.cache_dir = cache_dir
+        self.strict = strict
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.prefab_dir = resolve_prefab_paths(PREFAB_DIR)
+        # snapshot bytes (and prefab stats) of the scenes loaded by the process, every load unpickles a copy the game can modify
+        self.__snapshots = {}
+        self.__lock = threading.Lock()
+        # a scene is compiled by one thread at a time, the others then read its snapshot
+        self.__compile_locks = {}
+
+    def __snapshot_path(self, path):
+        key = hashlib.sha1(f"{os.path.abspath(path)}\n{self.prefab_dir}".encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{key}.pkl")
+
+    def compile(self, path):
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        scene = json.loads(resolve_prefab_paths(text))
+        prefabs = _find_prefabs(scene, self.prefab_dir, [])
+        prefab_stats = _prefab_stats(dict.fromkeys(prefabs))
+        missing = [prefab for prefab in prefabs if prefab_stats[prefab] is None]
+        return CompiledScene(path, scene, missing), hashlib.sha256(text.encode("utf-8")).hexdigest(), prefab_stats
+
+    def __read_snapshot(self, path, stat):
+        """The snapshot bytes of path if they are up to date, None otherwise"""
+        with self.__lock:
+            cached = self.__snapshots.get(path)
+        # a prefab added or removed since changes the missing files of the scene
+        if cached and cached[0] == (stat.st_mtime_ns, stat.st_size) and _is_fresh(cached[1]):
+            return cached[2]
+        if not self.cache_dir or not os.path.exists(self.__snapshot_path(path)):
+            return None
+        with open(self.__snapshot_path(path), "rb") as f:
+            header, data = pickle.load(f)
+        if header["version"] != SNAPSHOT_VERSION or not _is_fresh(header["prefabs"]):
+            return None
+        if (header["mtime"], header["size"]) != (stat.st_mtime_ns, stat.st_size):
+            # touched but maybe not changed
+            with open(path, "rb") as f:
+                if hashlib.sha256(f.read()).hexdigest() != header["sha256"]:
+                    return None
+            self.__write_snapshot(path, stat, header["sha256"], header["prefabs"], data)
+        with self.__lock:
+            self.__snapshots[path] = ((stat.st_mtime_ns, stat.st_size), header["prefabs"], data)
+        return data
+
+    def __write_snapshot(self, path, stat, sha256, prefab_stats, data):
+        header = {
+            "version": SNAPSHOT_VERSION, "mtime": stat.st_mtime_ns, "size": stat.st_size, "sha256": sha256,
+            "prefabs": prefab_stats,
+        }
+        snapshot_path = self.__snapshot_path(path)
+        # written aside and renamed, the workers of a batch may read it at the same time
+        tmp_path = f"{snapshot_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump((header, data), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, snapshot_path)
+
+    def load(self, path):
+        """The compiled scene of the JSON at path, a new copy on every call"""
+        stat = os.stat(path)
+        data = self.__read_snapshot(path, stat)
+        if data is None:
+            with self.__lock:
+                compile_lock = self.__compile_locks.setdefault(path, threading.Lock())
+            with compile_lock:
+                # compiled by another thread meanwhile
+                data = self.__read_snapshot(path, stat)
+                if data is None:
+                    compiled, sha256, prefab_stats = self.compile(path)
+                    # plain data, the snapshots do not depend on the module the classes are loaded from
+                    data = pickle.dumps((compiled.scene, compiled.missing, compiled.parts), protocol=pickle.HIGHEST_PROTOCOL)
+                    if self.cache_dir:
+                        self.__write_snapshot(path, stat, sha256, prefab_stats, data)
+                    with self.__lock:
+                        self.__snapshots[path] = ((stat.st_mtime_ns, stat.st_size), prefab_stats, data)
+                    self.__check(compiled, warn=True)
+                    return compiled
+        compiled = CompiledScene(path, *pickle.loads(data))
+        self.__check(compiled, warn=False)
+        return compiled
+
+    def __check(self, compiled, warn):
+        if not compiled.missing:
+            return
+        message = f"{compiled.path} references {len(compiled.missing)} missing files: {compiled.missing}"
+        if self.strict:
+            raise FileNotFoundError(message)
+        # once, when the scene is compiled
+        if warn:
+            logger.warning(message)
+
+
+_default_cache = None
+# run_async loads the scenes from executor threads, they must share one cache
+_default_cache_lock = threading.Lock()
+
+
+def load_scene(path):
+    """The compiled scene of path, from the snapshots of SCENE_CACHE_DIR"""
+    global _default_cache
+    if _default_cache is None:
+        with _default_cache_lock:
+            if _default_cache is None:
+                _default_cache = SceneCache()
+    return _default_cache.load(path)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", type=str, nargs="+", help="scene JSONs, or dirs to compile all the scene JSONs of")
+    parser.add_argument("--strict", action="store_true", help="exit with an error if a scene references a missing file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    cache = SceneCache()
+    paths = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                paths += [os.path.join(root, name) for name in sorted(files) if name.endswith(".json")]
+        else:
+            paths.append(path)
+    missing = 0
+    for path in paths:
+        try:
+            compiled = cache.load(path)
+        except json.JSONDecodeError as e:
+            logger.warning(f"{path} is not a scene: {e}")
+            continue
+        missing += len(compiled.missing)
+    logger.info(f"{len(paths)} scenes compiled to {cache.cache_dir}, {missing} missing file references.")
+    if args.strict and missing:
+        sys.exit(1)
@@ -16,6 +16,9 @@ logger.debug(f"Default env path: {get_default_env_data_path()}")
 # openai config
 API_KEY = ""
 BASE_URL = "" # You **cannot** leave it blank even if you are using the official openai api.
+# If set, all the models are queried at this OpenAI-compatible endpoint, e.g. "http://localhost:8000/v1" for mock_llm_server.py.
+# The LLM_BASE_URL environment variable overrides it.
+LLM_BASE_URL = os.environ.get("LLM_BASE_URL", None)
 
 
 # Project configs
@@ -50,6 +53,39 @@ BOX_HEIGHT = 0.2
 
 # Game Configs
 GAME_CACHE_DIR = "./game_cache" # The path for saving the records
+# The game client to launch: "auto" for the downloaded Unity client, "mock" for the python mock client (no rendering, for load tests)
+ENV_PATH = "auto"
+# Whether to save the screenshot of every step into the record dir. They are written in a background thread, the agent gets the frames from memory.
+SAVE_SCREENSHOTS = True
+
+# Disk cache of the LLM responses. The calls are made with temperature 0, so an identical request is answered from the cache
+# instead of being paid for again, e.g. when a sweep is rerun after a crash. The trials of a setting do not share responses.
+# Set RESPONSE_CACHE_PATH to None to disable it. RESPONSE_CACHE_MAX_SIZE is in MB, the least recently used responses are evicted beyond it.
+RESPONSE_CACHE_PATH = os.path.join(GAME_CACHE_DIR, "response_cache.sqlite")
+RESPONSE_CACHE_MAX_SIZE = 1024
+
+# The compiled scenes (prefab paths resolved, JSON of the fields dumped), refreshed when the scene JSON changes
+SCENE_CACHE_DIR = os.path.join(GAME_CACHE_DIR, "scene_cache")
+
+# Default camera resolution of the game client
+CAMERA_RESOLUTION = (2048, 1024)
+
+# How the screenshots are encoded for each model, keyed by model name prefix, case-insensitive (the longest matching prefix is used, "default" otherwise).
+# resolution: (width, height) of the images sent to the model, None for the camera resolution. Keep the 2:1 aspect of the camera.
+# jpeg_quality: the JPEG quality of the images sent.
+# detail: the "detail" of the image_url sent to the model. Only the openai models use it.
+# render: True to render the scene at the resolution in the game client, False to render at CAMERA_RESOLUTION and downscale before encoding.
+#   The recorded screenshots are saved at the rendered resolution.
+# Most vLLM-served models resize the images to a few hundred pixels in their vision encoders, sending more only costs upload and tokens.
+ENCODING_PROFILES = {
+    "default": {"resolution": None, "jpeg_quality": 75, "detail": "high", "render": False},
+    # gpt-4o scales high detail images to 768 px on the short side anyway
+    "gpt-": {"resolution": (1536, 768), "jpeg_quality": 85, "detail": "high", "render": False},
+    "qwen": {"resolution": (896, 448), "jpeg_quality": 85, "detail": "auto", "render": True},
+    "llava": {"resolution": (672, 336), "jpeg_quality": 85, "detail": "auto", "render": True},
+    "phi": {"resolution": (672, 336), "jpeg_quality": 85, "detail": "auto", "render": True},
+    "llama": {"resolution": (1120, 560), "jpeg_quality": 85, "detail": "auto", "render": True},
+}
 
 # Prefab Configs
 # You can use your own prefabs here.
@@ -67,5 +103,9 @@ PREFABS_USED = {
 # This is the max distance for interaction. If you want to be strict to the model evaluation, you can set it smaller.
 MAX_INTERACTION_DISTANCE = 4
 
+# Degrees added to the half field of views of the camera when culling the grab targets out of view in python.
+# The culling only uses the object centers, the margin keeps the big objects partly in the image.
+GRAB_FRUSTUM_MARGIN = 10
+
 
 logger.info("All configs loaded.")
@@ -1,8 +1,11 @@
 from legent.server.server import serve_scene, launch
-from legent.utils.io import load_json, store_json, save_image, scene_string, time_string, get_latest_folder, get_latest_folder_with_suffix, pack_scenes, unpack_scenes, find_files_by_extension
+from legent.utils.io import load_json, store_json, save_image, encode_image, ImageWriter, scene_string, time_string, get_latest_folder, get_latest_folder_with_suffix, pack_scenes, unpack_scenes, find_files_by_extension
 from legent.environment.env import Environment
+from legent.environment.communicator import CommunicatorHub
+from legent.environment.env_pool import EnvironmentPool
 from legent.action.action import Action, ResetInfo, ActionFinish
 from legent.action.observation import Observation
+from legent.utils.profiler import Profiler, TraceWriter, NULL_PROFILER
 from legent.server.scene_generator import generate_scene
 import argparse
 from legent.environment.env_utils import download_env
@@ -15,6 +18,7 @@ from legent.dataset.eval import task_done
 from legent.action.action import parse_action
 from legent.action.api import SaveTopDownView, TakePhotoWithVisiblityInfo
 from legent.asset.utils import get_mesh_size, get_mesh_vertical_size, convert_obj_to_gltf
+from legent.asset.mesh_index import MeshIndex, get_mesh_index
 import time
 
 
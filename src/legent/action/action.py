@@ -88,6 +88,14 @@ class ResetInfo:
         self.json_actions = json.dumps(scene)
         self.api_calls = api_calls
 
+    @classmethod
+    def from_json(cls, json_actions: str, api_calls: List[str] = []) -> "ResetInfo":
+        """A ResetInfo of an already serialized scene"""
+        info = cls.__new__(cls)
+        info.json_actions = json_actions
+        info.api_calls = api_calls
+        return info
+
     def build(self) -> ActionProto:
         return ActionProto(type="RESET", json_actions=self.json_actions, api_calls=json.dumps({"calls": self.api_calls}))
 
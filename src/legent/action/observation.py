@@ -1,18 +1,107 @@
 from legent.protobuf.communicator_pb2 import ObservationProto
+from typing import Any, Optional, Tuple
+import numpy as np
 import json
+import re
 import io
 
+_decoder = json.JSONDecoder()
+_json_string = re.compile(r'"(?:[^"\\]|\\.)*"')
+
+
+def _depth(text: str, end: int) -> int:
+    """Nesting depth of the JSON text at end, which must not be inside a string"""
+    prefix = _json_string.sub("", text[:end])
+    return prefix.count("{") + prefix.count("[") - prefix.count("}") - prefix.count("]")
+
 
 class Observation:
-    def __init__(self, obs: ObservationProto):
-        import skimage  # TODO: use Pillow instead
+    """
+    The image and the game_states are decoded on first access, so the exchanges that only need the API returns
+    (e.g. ObjectInView) or a few fields of the game states do not pay for the full decoding.
+    """
 
+    def __init__(self, obs: ObservationProto, decode_size: Optional[Tuple[int, int]] = None):
+        """
+        Args:
+            decode_size (Tuple[int, int], optional): (width, height) the image is downscaled to when it is decoded.
+                JPEG images are decoded at the reduced scale directly.
+        """
         self.type = obs.type
-        image_stream = io.BytesIO(obs.image)
-        self.image = skimage.io.imread(image_stream, plugin="imageio")
         self.text = obs.text
-        self.game_states = json.loads(obs.game_states)
+        self.decode_size = decode_size
+        self._image_bytes = obs.image
+        self._image = None
+        self._game_states_json = obs.game_states
+        self._game_states = None
         if obs.api_returns:
             self.api_returns = json.loads(obs.api_returns)
         else:
             self.api_returns = None
+
+    @classmethod
+    def from_decoded(cls, type: str, image, text: str, game_states, api_returns) -> "Observation":
+        """An observation of already decoded fields, e.g. from another process"""
+        obs = cls.__new__(cls)
+        obs.type = type
+        obs.text = text
+        obs.decode_size = None
+        obs._image_bytes = b""
+        obs._image = image
+        obs._game_states_json = ""
+        obs._game_states = game_states
+        obs.api_returns = api_returns
+        return obs
+
+    @property
+    def image(self) -> np.ndarray:
+        """The decoded frame, read-only"""
+        if self._image is None:
+            self._image = self._decode_image()
+        return self._image
+
+    @image.setter
+    def image(self, image: np.ndarray) -> None:
+        self._image = image
+
+    def _decode_image(self) -> np.ndarray:
+        from PIL import Image
+
+        image = Image.open(io.BytesIO(self._image_bytes))
+        resize = self.decode_size is not None and image.size != tuple(self.decode_size)
+        if resize:
+            # JPEG: decode at the smallest DCT scale that is still larger than decode_size
+            image.draft(image.mode, tuple(self.decode_size))
+        if image.mode not in ("RGB", "RGBA", "L"):
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+        if resize:
+            image = image.resize(tuple(self.decode_size), Image.BILINEAR, reducing_gap=1.0)
+        return np.asarray(image)
+
+    @property
+    def game_states(self) -> Any:
+        if self._game_states is None:
+            self._game_states = json.loads(self._game_states_json) if self._game_states_json else {}
+        return self._game_states
+
+    @game_states.setter
+    def game_states(self, game_states: Any) -> None:
+        self._game_states = game_states
+
+    def get_state(self, key: str, default: Any = None) -> Any:
+        """
+        One top-level field of the game states, e.g. "agent" or "agent_camera", parsed without the others (the instances)
+        if the game states have not been parsed yet and it comes before any nested field of the same name.
+        """
+        if self._game_states is not None or not self._game_states_json:
+            return self.game_states.get(key, default)
+        text = self._game_states_json
+        match = re.search(rf'"{re.escape(key)}"\s*:\s*', text)
+        # the first occurrence may be the key of a nested object, the top-level fields are then parsed with the others
+        if match is None or _depth(text, match.start()) != 1:
+            return self.game_states.get(key, default)
+        try:
+            value, _ = _decoder.raw_decode(text, match.end())
+        except json.JSONDecodeError:
+            return self.game_states.get(key, default)
+        return value
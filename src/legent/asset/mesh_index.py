@@ -0,0 +1,208 @@
+import atexit
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+from legent.utils.config import MESH_INDEX_PATH
+from legent.utils.io import log
+
+MESH_EXTENSIONS = (".glb", ".gltf", ".obj", ".fbx", ".ply", ".stl")
+INDEX_VERSION = 1
+
+
+def file_hash(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def measure_mesh(path: str, surfaces: bool = False) -> Dict:
+    """Parse a mesh file and return its info: bounds, size, vertex and face counts (and placeable surfaces if surfaces)"""
+    import trimesh
+
+    mesh = trimesh.load(path)
+    geometries = mesh.geometry.values() if isinstance(mesh, trimesh.Scene) else [mesh]
+    bounds = mesh.bounds
+    info = {
+        "bounds": bounds.tolist(),
+        "size": (bounds[1] - bounds[0]).tolist(),
+        "vertices": int(sum(len(getattr(g, "vertices", [])) for g in geometries)),
+        "faces": int(sum(len(getattr(g, "faces", [])) for g in geometries)),
+        "placeable_surfaces": {},
+    }
+    if surfaces:
+        from legent.asset.utils import get_placable_surface
+
+        info["placeable_surfaces"]["true"] = get_placable_surface(path, True, False)
+    return info
+
+
+def _measure_entry(args) -> Optional[Dict]:
+    path, surfaces = args
+    try:
+        stat = os.stat(path)
+        entry = measure_mesh(path)
+        entry.update({"mtime": stat.st_mtime_ns, "file_size": stat.st_size, "sha256": file_hash(path)})
+    except Exception as e:
+        log(f"Failed to measure {path}: {e}")
+        return None
+    if surfaces:
+        # the size is indexed even if the ray casting fails
+        try:
+            from legent.asset.utils import get_placable_surface
+
+            entry["placeable_surfaces"]["true"] = get_placable_surface(path, True, False)
+        except Exception as e:
+            log(f"Failed to compute the placeable surfaces of {path}: {e}")
+    return entry
+
+
+class MeshIndex:
+    """
+    On-disk index of the mesh files measured so far, so that a mesh is parsed once and not every time its size is needed
+    (e.g. for every custom prefab and door of every generated scene).
+
+    The entries are keyed by the absolute path of the file. An entry is used as long as the file has the same mtime and size,
+    or the same content hash if those changed. A file with the content of a measured one (a copy) reuses its entry.
+    The index is only read when it is first queried. New entries are only marked dirty, and written by flush(),
+    which also runs at exit, so a scene with many unindexed meshes does not rewrite the whole index for each of them.
+    """
+
+    def __init__(self, path: str = MESH_INDEX_PATH):
+        """
+        Args:
+            path (str): the json file of the index.
+        """
+        self.path = path
+        self._entries: Optional[Dict[str, Dict]] = None
+        self._by_hash: Dict[str, Dict] = {}
+        self._dirty = False
+        self._lock = threading.RLock()
+        atexit.register(self.flush)
+
+    def _load(self) -> Dict[str, Dict]:
+        if self._entries is None:
+            entries = {}
+            if os.path.exists(self.path):
+                try:
+                    with open(self.path, "r", encoding="utf-8") as f:
+                        data = json.load(f)
+                    if data.get("version") == INDEX_VERSION:
+                        entries = data["entries"]
+                except (OSError, ValueError) as e:
+                    log(f"The mesh index {self.path} is unreadable and is rebuilt: {e}")
+            self._entries = entries
+            self._by_hash = {entry["sha256"]: entry for entry in entries.values()}
+        return self._entries
+
+    def save(self) -> None:
+        with self._lock:
+            entries = self._load()
+            # merge the entries other processes measured meanwhile
+            if os.path.exists(self.path):
+                try:
+                    with open(self.path, "r", encoding="utf-8") as f:
+                        data = json.load(f)
+                    if data.get("version") == INDEX_VERSION:
+                        entries = {**data["entries"], **entries}
+                except (OSError, ValueError):
+                    pass
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"version": INDEX_VERSION, "entries": entries}, f)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+
+    def flush(self) -> None:
+        """Save the index if entries were added since it was last saved"""
+        with self._lock:
+            if self._dirty:
+                self.save()
+
+    def _add(self, key: str, entry: Dict) -> None:
+        self._entries[key] = entry
+        self._by_hash[entry["sha256"]] = entry
+        self._dirty = True
+
+    def get(self, input_file: str, surfaces: bool = False) -> Dict:
+        """
+        The info of a mesh file, measured (and added to the index, saved on flush) if it is not indexed yet.
+
+        Args:
+            surfaces (bool): also make sure the placeable surfaces (with size_is_correct=True) are indexed.
+        """
+        key = os.path.abspath(input_file)
+        stat = os.stat(key)
+        with self._lock:
+            entries = self._load()
+            entry = entries.get(key)
+            if entry is not None and (entry["mtime"], entry["file_size"]) == (stat.st_mtime_ns, stat.st_size):
+                if not surfaces or "true" in entry["placeable_surfaces"]:
+                    return entry
+            sha256 = file_hash(key)
+            entry = self._by_hash.get(sha256)
+            if entry is not None and (not surfaces or "true" in entry["placeable_surfaces"]):
+                entry = dict(entry, mtime=stat.st_mtime_ns, file_size=stat.st_size)
+            else:
+                entry = measure_mesh(key, surfaces)
+                entry.update({"mtime": stat.st_mtime_ns, "file_size": stat.st_size, "sha256": sha256})
+            self._add(key, entry)
+            return entry
+
+    def get_placeable_surfaces(self, input_file: str, size_is_correct: bool = True) -> List[Dict]:
+        """get_placable_surface of the mesh, computed once per value of size_is_correct"""
+        entry = self.get(input_file)
+        flag = "true" if size_is_correct else "false"
+        if flag not in entry["placeable_surfaces"]:
+            from legent.asset.utils import get_placable_surface
+
+            with self._lock:
+                entry["placeable_surfaces"][flag] = get_placable_surface(input_file, size_is_correct, False)
+                self._dirty = True
+        return entry["placeable_surfaces"][flag]
+
+    def build(self, root: str, surfaces: bool = False, max_workers: Optional[int] = None) -> int:
+        """
+        Measure in parallel processes all the mesh files under root that are not indexed (or changed). Returns how many were measured.
+        The new entries are saved by flush() (or at exit).
+
+        Args:
+            surfaces (bool): also compute the placeable surfaces, which casts rays and is much slower than parsing.
+        """
+        paths = []
+        for dirpath, _, files in os.walk(root):
+            paths += [os.path.abspath(os.path.join(dirpath, name)) for name in files if name.lower().endswith(MESH_EXTENSIONS)]
+        with self._lock:
+            entries = self._load()
+            todo = []
+            for path in paths:
+                stat = os.stat(path)
+                entry = entries.get(path)
+                if entry is None or (entry["mtime"], entry["file_size"]) != (stat.st_mtime_ns, stat.st_size) or (surfaces and "true" not in entry["placeable_surfaces"]):
+                    todo.append(path)
+        if todo:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                measured = list(executor.map(_measure_entry, [(path, surfaces) for path in todo]))
+            with self._lock:
+                for path, entry in zip(todo, measured):
+                    if entry is not None:
+                        self._add(path, entry)
+        return len(todo)
+
+
+_default_index = None
+
+
+def get_mesh_index() -> MeshIndex:
+    """The index at MESH_INDEX_PATH, shared by the process"""
+    global _default_index
+    if _default_index is None:
+        _default_index = MeshIndex()
+    return _default_index
+
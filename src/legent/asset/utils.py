@@ -1,10 +1,16 @@
 def get_mesh_size(input_file, visualize=False):
-    """Get the bounding box of a mesh file.
+    """Get the bounding box of a mesh file. The file is only parsed if it is not in the mesh index yet.
     Args:
         input_file: str, the path of the mesh file.
     Returns:
         mesh_size: np.ndarray, the size of the mesh file.
     """
+    import numpy as np
+
+    if not visualize:
+        from legent.asset.mesh_index import get_mesh_index
+
+        return np.array(get_mesh_index().get(input_file)["size"])
 
     import trimesh
 
@@ -114,36 +120,20 @@ def get_placable_surface(input_file, size_is_correct, visualize):
         z = bounds_min_z + (bounds_max_z - bounds_min_z) * j / (rays_z - 1)
         return x, z
 
-    # STEP 1: Emit rays downward (perpendicular to the xz plane).
-    is_hit = np.zeros((rays_x, rays_z), dtype=int)  # Initialize to 0, indicating no hit.
-    hit_y = np.zeros((rays_x, rays_z))  # The y-coordinate of the hit point.
-
-    for i in range(rays_x):
-        for j in range(rays_z):
-            x, z = ij_to_pos(i, j)
-            # Start emitting from 0.3 meters above the bounding box.
-            ray_origin = np.array([x, mesh.bounds[1][1] + 0.3, z])
-
-            def ray_cast(ray_origin, ray_direction):
-                ray_origins = np.array([ray_origin])
-                ray_directions = np.array([ray_direction])
-
-                # https://github.com/mikedh/trimesh/blob/7853a5ebae3b35275f4d8d65cbc48bcd3a3c8a40/trimesh/ray/ray_pyembree.py#L83
-                locations, index_ray, index_tri = mesh.ray.intersects_location(ray_origins=ray_origins, ray_directions=ray_directions)
-
-                if len(locations) > 0:
-                    # Find the index of the maximum y-value
-                    max_y_index = np.argmax(locations[:, 1])
-                    # Get the maximum y-value
-                    max_y_value = locations[max_y_index][1]
-                    return True, max_y_value
-                else:
-                    return False, 0
-
-            hit, point_y = ray_cast(ray_origin, np.array([0, -1, 0]))
-            if hit:
-                is_hit[i, j] = 1
-                hit_y[i, j] = point_y
+    # STEP 1: Emit rays downward (perpendicular to the xz plane), all of them in one intersection call.
+    grid_i, grid_j = np.meshgrid(np.arange(rays_x), np.arange(rays_z), indexing="ij")
+    grid_x, grid_z = ij_to_pos(grid_i.ravel(), grid_j.ravel())
+    # Start emitting from 0.3 meters above the bounding box.
+    ray_origins = np.stack([grid_x, np.full(grid_x.shape, mesh.bounds[1][1] + 0.3), grid_z], axis=1)
+    ray_directions = np.tile([0.0, -1.0, 0.0], (len(ray_origins), 1))
+    # https://github.com/mikedh/trimesh/blob/7853a5ebae3b35275f4d8d65cbc48bcd3a3c8a40/trimesh/ray/ray_pyembree.py#L83
+    locations, index_ray, _ = mesh.ray.intersects_location(ray_origins=ray_origins, ray_directions=ray_directions)
+
+    # The highest hit of every ray
+    highest = np.full(len(ray_origins), -np.inf)
+    np.maximum.at(highest, index_ray, locations[:, 1])
+    is_hit = np.isfinite(highest).reshape(rays_x, rays_z).astype(int)  # 0 indicates no hit.
+    hit_y = np.where(np.isfinite(highest), highest, 0).reshape(rays_x, rays_z)  # The y-coordinate of the hit point.
 
     if visualize:
         points = []
@@ -157,40 +147,33 @@ def get_placable_surface(input_file, size_is_correct, visualize):
     same_plane_eps = (mesh.bounds[1][0] - mesh.bounds[0][0]) / 100
 
     def find_most_points_on_same_y():
-        planes = []  # planes[plane_i] is the i, j coordinates of all points on the plane
-
-        for i in range(rays_x):
-            for j in range(rays_z):
-                if is_hit[i, j] != 1:
-                    continue
-
-                # Check if the point can be incorporated into an existing plane
-                for plane_points in planes:
-                    if abs(hit_y[plane_points[0][0], plane_points[0][1]] - hit_y[i, j]) <= same_plane_eps:
-                        plane_points.append((i, j))
-                        break
-                else:
-                    # If the point cannot be incorporated into any existing plane, create a new plane.
-                    planes.append([(i, j)])
-
-        # Find the group with the most points.
-        if not planes:
+        # The points are grouped in (i, j) order: a point joins the first plane whose first point is within same_plane_eps, or starts a new one.
+        # That is one vectorized pass per plane: the first ungrouped point starts a plane, and takes all the ungrouped points close to it.
+        hit_i, hit_j = np.nonzero(is_hit == 1)
+        ys = hit_y[hit_i, hit_j]
+        ungrouped = np.ones(len(ys), dtype=bool)
+        placeable = np.zeros(0, dtype=int)
+        while ungrouped.any():
+            first = np.argmax(ungrouped)
+            members = np.nonzero(ungrouped & (np.abs(ys[first] - ys) <= same_plane_eps))[0]
+            ungrouped[members] = False
+            # Keep the group with the most points, the first one on ties.
+            if len(members) > len(placeable):
+                placeable = members
+        if not len(placeable):
             return []
-        placeable_points = max(planes, key=len)
+        placeable_i, placeable_j = hit_i[placeable], hit_j[placeable]
 
         # Check if there is a protrusion in the middle of the plane.
-        bounds_min_i, bounds_max_i = min(i for i, _ in placeable_points), max(i for i, _ in placeable_points)
-        bounds_min_j, bounds_max_j = min(j for _, j in placeable_points), max(j for _, j in placeable_points)
-        placeable_y = hit_y[placeable_points[0][0], placeable_points[0][1]]
-        for i in range(bounds_min_i, bounds_max_i + 1):
-            for j in range(bounds_min_j, bounds_max_j + 1):
-                if placeable_y - hit_y[i, j] > same_plane_eps * 2:
-                    return []
-
-        if len(placeable_points) < 16:
+        placeable_y = ys[placeable[0]]
+        box = hit_y[placeable_i.min() : placeable_i.max() + 1, placeable_j.min() : placeable_j.max() + 1]
+        if np.any(placeable_y - box > same_plane_eps * 2):
+            return []
+
+        if len(placeable) < 16:
             return []
 
-        return placeable_points
+        return list(zip(placeable_i.tolist(), placeable_j.tolist()))
 
     placeable_points = find_most_points_on_same_y()
 
@@ -203,9 +186,10 @@ def get_placable_surface(input_file, size_is_correct, visualize):
 
     # If a plane with sufficient points is found, determine the largest rectangular area on this plane.
     placeable_rects = []
+    unvisited = is_hit == 1
 
     for i, j in placeable_points:
-        if is_hit[i, j] != 1:
+        if not unvisited[i, j]:
             continue
 
         # Initialize boundaries for the rectangle
@@ -217,26 +201,24 @@ def get_placable_surface(input_file, size_is_correct, visualize):
             expanding = False
 
             # Expand to the top
-            if i_min > 0 and all(is_hit[i_min - 1, k] == 1 for k in range(j_min, j_max + 1)):
+            if i_min > 0 and unvisited[i_min - 1, j_min : j_max + 1].all():
                 i_min -= 1
                 expanding = True
             # Expand to the right
-            if i_max < rays_x - 1 and all(is_hit[i_max + 1, k] == 1 for k in range(j_min, j_max + 1)):
+            if i_max < rays_x - 1 and unvisited[i_max + 1, j_min : j_max + 1].all():
                 i_max += 1
                 expanding = True
             # Expand to the top
-            if j_min > 0 and all(is_hit[k, j_min - 1] == 1 for k in range(i_min, i_max + 1)):
+            if j_min > 0 and unvisited[i_min : i_max + 1, j_min - 1].all():
                 j_min -= 1
                 expanding = True
             # Expand to the bottom
-            if j_max < rays_z - 1 and all(is_hit[k, j_max + 1] == 1 for k in range(i_min, i_max + 1)):
+            if j_max < rays_z - 1 and unvisited[i_min : i_max + 1, j_max + 1].all():
                 j_max += 1
                 expanding = True
 
-        # After the rectangle is formed, set the included points to a value that marks them as processed.
-        for ii in range(i_min, i_max + 1):
-            for jj in range(j_min, j_max + 1):
-                is_hit[ii, jj] = 2
+        # After the rectangle is formed, mark the included points as processed.
+        unvisited[i_min : i_max + 1, j_min : j_max + 1] = False
 
         # The y-coordinate of the placement surface
         y = hit_y[i, j]
@@ -1,24 +1,95 @@
 import grpc
-from typing import Callable, Optional
-from multiprocessing import Pipe
+from typing import Any, Callable, Optional
+from collections import deque
+import threading
 import time
 from concurrent.futures import ThreadPoolExecutor
 from legent.protobuf.communicator_pb2_grpc import CommunicatorServicer, add_CommunicatorServicer_to_server
 from legent.protobuf.communicator_pb2 import ActionProto, ObservationProto
+from legent.utils.profiler import NULL_PROFILER, Profiler
 import json
 
 
+class Handoff:
+    """
+    One direction of the in-process handoff between the grpc server thread and the python side.
+    The messages are passed by reference, and a waiting get() wakes up as soon as one is put.
+    """
+
+    def __init__(self):
+        self._messages = deque()
+        self._condition = threading.Condition()
+        self._closed = False
+
+    def put(self, message: Any) -> None:
+        with self._condition:
+            self._messages.append(message)
+            self._condition.notify()
+
+    def poll(self, timeout: Optional[float] = None) -> bool:
+        """Wait up to timeout seconds for a message. Returns whether get() will not block"""
+        with self._condition:
+            return self._condition.wait_for(lambda: self._messages or self._closed, timeout)
+
+    def get(self) -> Any:
+        with self._condition:
+            self._condition.wait_for(lambda: self._messages or self._closed)
+            if not self._messages:
+                raise EOFError("The handoff is closed.")
+            return self._messages.popleft()
+
+    def close(self) -> None:
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
 class CommunicatorServicerImplementation(CommunicatorServicer):
     def __init__(self):
-        self.parent_conn, self.child_conn = Pipe()
+        # game client -> python, and python -> game client
+        self.observations = Handoff()
+        self.actions = Handoff()
+        self.profiler = NULL_PROFILER
 
     def Initialize(self, request, context):
-        self.child_conn.send(request)
-        return self.child_conn.recv()
+        self.observations.put(request)
+        return self.actions.get()
 
     def GetAction(self, request, context):
-        self.child_conn.send(request)
-        return self.child_conn.recv()
+        # runs in a grpc server thread, which waits here for the python side to send the next action
+        with self.profiler.span("grpc.get_action"):
+            self.observations.put(request)
+            return self.actions.get()
+
+
+class CommunicatorHub:
+    """
+    One thread pool shared by the grpc servers of the environments of a process, so that the number of grpc threads
+    is bounded by max_environments instead of growing by a 10-thread pool per environment.
+
+    Every environment still listens on its own port: the game client connects with a plain channel to its port and
+    does not tell which environment it belongs to, so the port is what routes its observations to its Environment.
+    A waiting GetAction holds a thread of the pool, hence at most max_environments environments can use the hub at once.
+    """
+
+    def __init__(self, max_environments: int = 32):
+        self.max_environments = max_environments
+        self.executor = ThreadPoolExecutor(max_workers=max_environments, thread_name_prefix="grpc_hub")
+        self._lock = threading.Lock()
+        self._attached = 0
+
+    def attach(self) -> None:
+        with self._lock:
+            if self._attached >= self.max_environments:
+                raise RuntimeError(f"The communicator hub is full, it serves at most {self.max_environments} environments.")
+            self._attached += 1
+
+    def detach(self) -> None:
+        with self._lock:
+            self._attached -= 1
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False)
 
 
 # Function to call while waiting for a connection timeout.
@@ -27,26 +98,35 @@ PollCallback = Callable[[], None]
 
 
 class RpcCommunicator:
-    def __init__(self, port: int):
+    def __init__(self, port: int, timeout: float = 600, poll_interval: float = 3, hub: Optional[CommunicatorHub] = None):
         """
         Python side of the grpc communication. Python is the server and game is the client
 
         :int port: Port number to communicate with game environment.
+        :float timeout: Seconds to wait for an observation before giving up.
+        :float poll_interval: Seconds between two checks of the poll callback while waiting. An observation wakes the wait up at once.
+        :CommunicatorHub hub: Serve with the thread pool of this hub instead of a pool of its own.
         """
         self.port = port
+        self.hub = hub
+        self.timeout = timeout
+        self.poll_interval = poll_interval
         self.server = None
         self.unity_to_external = None
         self.is_open = False
         self.create_server()
+        self.profiler = NULL_PROFILER
 
     def create_server(self):
         """
         Creates the GRPC server.
         """
+        if self.hub is not None:
+            self.hub.attach()
         try:
             # Establish communication grpc
             self.server = grpc.server(
-                thread_pool=ThreadPoolExecutor(max_workers=10),
+                thread_pool=self.hub.executor if self.hub is not None else ThreadPoolExecutor(max_workers=10),
                 options=(("grpc.so_reuseport", 1),),
             )
             self.unity_to_external = CommunicatorServicerImplementation()
@@ -59,6 +139,8 @@ class RpcCommunicator:
             self.server.start()
             self.is_open = True
         except Exception:
+            if self.hub is not None:
+                self.hub.detach()
             raise Exception(
                 "Worker In Use:\n"
                 f"Couldn't start communication because port {self.port} is still in use. "
@@ -66,6 +148,15 @@ class RpcCommunicator:
                 "or use a different port."
             )
 
+    @property
+    def profiler(self) -> Profiler:
+        return self._profiler
+
+    @profiler.setter
+    def profiler(self, profiler: Profiler) -> None:
+        self._profiler = profiler
+        self.unity_to_external.profiler = profiler
+
     def poll_for_timeout(self, poll_callback: Optional[PollCallback] = None) -> None:
         """
         Polls the GRPC parent connection for data, to be used before calling recv.  This prevents
@@ -76,12 +167,12 @@ class RpcCommunicator:
         This is used to detect the case when the environment dies without cleaning up the connection,
         so that we can stop sooner and raise a more appropriate error.
         """
-        # TODO: remove timeout 
-        timeout_wait = 600  # Timeout (in seconds) to wait for a response before exiting.
-        deadline = time.monotonic() + timeout_wait
-        callback_timeout_wait = timeout_wait // 200
-        while time.monotonic() < deadline:
-            if self.unity_to_external.parent_conn.poll(callback_timeout_wait):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if self.unity_to_external.observations.poll(min(self.poll_interval, remaining)):
                 # Got an acknowledgment from the connection
                 return
             if poll_callback:
@@ -95,18 +186,24 @@ class RpcCommunicator:
         self, poll_callback: Optional[PollCallback] = None, env_config={}
     ) -> ObservationProto:
         self.poll_for_timeout(poll_callback)
-        init_obs = self.unity_to_external.parent_conn.recv()
+        init_obs = self.unity_to_external.observations.get()
         inputs = ActionProto(type="INIT", json_actions=json.dumps(env_config))
-        self.unity_to_external.parent_conn.send(inputs)
-        self.unity_to_external.parent_conn.recv()
+        self.unity_to_external.actions.put(inputs)
+        self.poll_for_timeout(poll_callback)
+        self.unity_to_external.observations.get()
         return init_obs
 
     def exchange(
         self, inputs: ActionProto, poll_callback: Optional[PollCallback] = None
     ) -> Optional[ObservationProto]:
-        self.unity_to_external.parent_conn.send(inputs)
-        self.poll_for_timeout(poll_callback)
-        output = self.unity_to_external.parent_conn.recv()
+        with self.profiler.span("rpc.exchange"):
+            with self.profiler.span("rpc.send"):
+                self.unity_to_external.actions.put(inputs)
+            # the game client applies the action and renders in this time
+            with self.profiler.span("rpc.wait"):
+                with self.profiler.span("rpc.poll_for_timeout"):
+                    self.poll_for_timeout(poll_callback)
+                output = self.unity_to_external.observations.get()
         return output
 
     def close(self):
@@ -115,7 +212,9 @@ class RpcCommunicator:
         """
         if self.is_open:
             message_input = ActionProto(type="CLOSE")
-            self.unity_to_external.parent_conn.send(message_input)
-            self.unity_to_external.parent_conn.close()
+            self.unity_to_external.actions.put(message_input)
+            self.unity_to_external.observations.close()
             self.server.stop(False)
             self.is_open = False
+            if self.hub is not None:
+                self.hub.detach()
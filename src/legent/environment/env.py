@@ -1,30 +1,46 @@
-from typing import Optional, Dict
+from typing import Optional, Dict, Callable, Any, Tuple
+from concurrent.futures import Executor
+import asyncio
 import subprocess
-from legent.environment.env_utils import launch_executable, download_env, get_default_env_path
-from legent.environment.communicator import RpcCommunicator
+import json
+from legent.environment.env_utils import launch_executable, launch_mock_client, download_env, get_default_env_path
+from legent.environment.communicator import CommunicatorHub, RpcCommunicator
 from legent.action.action import Action, ResetInfo
 from legent.action.observation import Observation
 from legent.server.scene_generator import generate_scene
 from legent.utils.config import CLIENT_FOLDER, DEFAULT_GRPC_PORT
+from legent.utils.profiler import NULL_PROFILER, Profiler
 import os
 
 
 class Environment:
-    def __init__(self, env_path: Optional[str] = None, run_options: Dict = {}, use_animation=True, camera_resolution_width=448, camera_resolution_height=448, camera_field_of_view=120, rendering_options: Dict = {}, action_mode=0):
+    def __init__(self, env_path: Optional[str] = None, run_options: Dict = {}, use_animation=True, camera_resolution_width=448, camera_resolution_height=448, camera_field_of_view=120, rendering_options: Dict = {}, action_mode=0, timeout: float = 600, hub: Optional[CommunicatorHub] = None, decode_size: Optional[Tuple[int, int]] = None, mock_options: Dict = {}):
         """Initialize the environment.
 
         Args:
             action_mode (int, optional): 0 is low-level action mode, 1 is options-based action mode. Defaults to 0.
+            timeout (float, optional): seconds to wait for the game client to answer an action before giving up. Defaults to 600.
+            hub (CommunicatorHub, optional): share the grpc thread pool of this hub with the other environments of the process.
+            decode_size (Tuple[int, int], optional): (width, height) the observation images are downscaled to when they are decoded.
+            mock_options (Dict, optional): options of the mock client when env_path is "mock", e.g. {"step_latency": 0.05, "image_format": "JPEG"}.
         """
         self._process: Optional[subprocess.Popen] = None
+        # API calls waiting to be sent with the next step, and the callbacks their returns are routed to
+        self._queued_api_calls = []
+        # Number of exchanges with the game client, to check how many round-trips a step of the game costs
+        self.exchanges = 0
+        self.profiler = NULL_PROFILER
+        self.decode_size = decode_size
         # RPC is a one-to-one communication method, with each pair of python worker and game client using the same port.
         # If there are multiple environments, multiple different ports are required.
         port = run_options.get("port", DEFAULT_GRPC_PORT)
-        self._communicator = RpcCommunicator(port)
+        self.port = port
+        self._communicator = RpcCommunicator(port, timeout=timeout, hub=hub)
         welcome()
 
         # If the environment name is None, a new environment will not be launched
         # and the communicator will directly try to connect to an existing unity environment (Unity Editor, or an executable file manually open).
+        # If it is "mock", the python mock client (legent.environment.mock_client) is launched instead of the Unity one.
         if env_path == "auto":  # TODO: check if up to date
             if not os.path.exists(CLIENT_FOLDER):
                 download_env()
@@ -33,7 +49,11 @@ class Environment:
             try:
                 run_args = ["--width", str(run_options.get("width", 640)), "--height", str(run_options.get("width", 480)), "--port", str(port)]
                 rendering_args = ["--background", str(rendering_options.get("background", 1)), "--use_shadows", str(rendering_options.get("use_shadows", 1)),"--use_default_light", str(rendering_options.get("use_default_light", 1)), "--style", str(rendering_options.get("style", 1))]
-                self._process = launch_executable(file_name=env_path, args=run_args + rendering_args)
+                if env_path == "mock":
+                    mock_args = [arg for key, value in mock_options.items() for arg in (f"--{key}", str(value))]
+                    self._process = launch_mock_client(args=run_args + rendering_args + mock_args)
+                else:
+                    self._process = launch_executable(file_name=env_path, args=run_args + rendering_args)
             except Exception:
                 self.close()
                 raise
@@ -51,24 +71,84 @@ class Environment:
         if poll_res is not None:
             raise Exception("Game client exited")
 
+    def set_profiler(self, profiler: Profiler) -> None:
+        """Record the timings and payload sizes of the steps (send, wait for the game client, decode) in profiler"""
+        self.profiler = profiler
+        self._communicator.profiler = profiler
+
+    def queue_api_call(self, api_call: Dict, callback: Optional[Callable[[Any], None]] = None) -> None:
+        """
+        Queue an API call to be sent with the next step instead of costing an exchange of its own.
+        The API calls are executed after the actions of that step, and the queued ones before the step's own api_calls.
+
+        Args:
+            api_call (Dict): e.g. HideObject(object_id)
+            callback (Callable, optional): called with the return of the API call when the observation arrives.
+                It gets None if the game client does not return one result per call.
+        """
+        self._queued_api_calls.append((api_call, callback))
+
     def step(self, inputs: Optional[Action] = None) -> Observation:
         # TODO: refine code comments
         if inputs is None:
             inputs = Action()
         if isinstance(inputs, Action):
             inputs = inputs.build()
-        outputs = self._communicator.exchange(inputs, self._poll_process)
-        return Observation(outputs)
+        queued, own_calls = [], []
+        if self._queued_api_calls and inputs.type == "STEP":
+            queued, self._queued_api_calls = self._queued_api_calls, []
+            own_calls = json.loads(inputs.api_calls)["calls"] if inputs.api_calls else []
+            inputs.api_calls = json.dumps({"calls": [api_call for api_call, _ in queued] + own_calls})
+        with self.profiler.span("env.step"):
+            outputs = self._communicator.exchange(inputs, self._poll_process)
+            self.exchanges += 1
+            if self.profiler.enabled:
+                self.profiler.add("env.request_bytes", inputs.ByteSize())
+                self.profiler.add("env.response_bytes", outputs.ByteSize())
+                self.profiler.add("env.image_bytes", len(outputs.image))
+            with self.profiler.span("env.decode"):
+                obs = Observation(outputs, self.decode_size)
+            if queued:
+                self._route_api_returns(obs, queued, own_calls)
+        return obs
+
+    def _route_api_returns(self, obs: Observation, queued, own_calls) -> None:
+        """Give the returns of the queued API calls to their callbacks, and leave only the step's own returns in obs."""
+        api_returns = obs.api_returns
+        if isinstance(api_returns, list):
+            # One return per call, in the order of the calls
+            queued_returns, api_returns = api_returns[: len(queued)], api_returns[len(queued) :]
+            obs.api_returns = None if not api_returns else api_returns[0] if len(api_returns) == 1 else api_returns
+        else:
+            queued_returns = [None] * len(queued)
+            if not own_calls:
+                obs.api_returns = None
+        for (_, callback), api_return in zip(queued, queued_returns):
+            if callback:
+                callback(api_return)
 
     def reset(self, inputs: Optional[ResetInfo] = None) -> Observation:
         # NOTE: This design is different from most RL environments, as
         # all terminal decisions are made by the backend, allowing reset() and step() to be called in the same way.
         if inputs is None:
             inputs = ResetInfo(scene=generate_scene())
+        # The queued API calls refer to the objects of the previous scene
+        self._queued_api_calls = []
         if isinstance(inputs, Action) or isinstance(inputs, ResetInfo):
             inputs = inputs.build()
         return self.step(inputs)
 
+    async def step_async(self, inputs: Optional[Action] = None, executor: Optional[Executor] = None) -> Observation:
+        """
+        step() run in an executor (the loop's default one if None), so that the event loop can serve other environments while waiting for the game client.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, self.step, inputs)
+
+    async def reset_async(self, inputs: Optional[ResetInfo] = None, executor: Optional[Executor] = None) -> Observation:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, self.reset, inputs)
+
     def close(self) -> None:
         """
         Close the communicator and environment subprocess (if necessary).
@@ -0,0 +1,159 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from legent.environment.communicator import CommunicatorHub
+from legent.environment.env import Environment
+from legent.utils.config import DEFAULT_GRPC_PORT
+from legent.utils.io import log
+from legent.utils.profiler import NULL_PROFILER
+
+
+class PooledEnvironment:
+    """A slot of the pool: its port, its environment (None while it has to be relaunched) and its bookkeeping"""
+
+    def __init__(self, port: int, env: Optional[Environment]):
+        self.port = port
+        self.env = env
+        self.episodes = 0
+
+
+class EnvironmentPool:
+    """
+    Keeps `size` launched game clients, each on its own port, and leases them to episodes, so an episode pays one reset
+    exchange instead of the client launch, the gRPC server creation and the INIT handshake.
+
+    Usage:
+        pool = EnvironmentPool(4, env_path="auto", camera_resolution_width=2048, camera_resolution_height=1024)
+        with pool.lease() as env:
+            obs = env.reset(ResetInfo(scene))
+            ...
+        pool.close()
+
+    A client is health-checked when it is returned, and closed after `max_episodes` episodes or if the episode failed or
+    the check does not pass. It is relaunched on its port by the next acquire(), so no client is launched after the last episode.
+    If the relaunch fails, the error is raised by that acquire() and the slot stays in the pool for the next one. All the clients share the INIT settings (camera resolution, field of view...)
+    and, unless env_kwargs gives one, a CommunicatorHub, so the grpc threads of the process are bounded by size.
+    """
+
+    def __init__(self, size: int, base_port: int = DEFAULT_GRPC_PORT, max_episodes: Optional[int] = None, **env_kwargs):
+        """
+        Args:
+            size (int): number of game clients. Client i listens on base_port + i.
+            base_port (int): port of the first client.
+            max_episodes (int, optional): relaunch a client after this many episodes, None to keep it as long as it is healthy.
+            env_kwargs: passed to Environment, e.g. env_path, the camera settings and the mock_options of a mock client.
+                run_options["port"] is set by the pool.
+        """
+        self.size = size
+        self.max_episodes = max_episodes
+        self._own_hub = "hub" not in env_kwargs
+        if self._own_hub:
+            env_kwargs["hub"] = CommunicatorHub(size)
+        self.env_kwargs = env_kwargs
+        self._idle: "queue.Queue[PooledEnvironment]" = queue.Queue()
+        self._leased: Dict[int, PooledEnvironment] = {}
+        self._lock = threading.Lock()
+        self._closed = False
+        self.launches = 0
+
+        # the clients are launched concurrently, the pool is warm when __init__ returns
+        ports = [base_port + i for i in range(size)]
+        with ThreadPoolExecutor(max_workers=size) as executor:
+            for pooled in executor.map(self._launch, ports):
+                self._idle.put(pooled)
+
+    def _launch(self, port: int) -> PooledEnvironment:
+        run_options = dict(self.env_kwargs.get("run_options", {}))
+        run_options["port"] = port
+        env_kwargs = dict(self.env_kwargs, run_options=run_options)
+        env = Environment(**env_kwargs)
+        with self._lock:
+            self.launches += 1
+        return PooledEnvironment(port, env)
+
+    def acquire(self, timeout: Optional[float] = None) -> Environment:
+        """Lease an idle environment, waiting up to timeout seconds (forever if None) for one to be released"""
+        if self._closed:
+            raise RuntimeError("The environment pool is closed.")
+        try:
+            pooled = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError(f"No environment of the pool was released in {timeout} seconds.")
+        if pooled.env is None:
+            try:
+                pooled = self._launch(pooled.port)
+            except BaseException:
+                # the slot is kept, the next acquire tries again
+                self._idle.put(pooled)
+                raise
+        with self._lock:
+            self._leased[id(pooled.env)] = pooled
+        return pooled.env
+
+    def release(self, env: Environment, failed: bool = False) -> None:
+        """
+        Give a leased environment back. It is closed, and relaunched by the next acquire(), if the episode failed, if it reached max_episodes or if it is unhealthy.
+
+        Args:
+            failed (bool): the episode failed, the client may be in any state.
+        """
+        with self._lock:
+            pooled = self._leased.pop(id(env))
+        pooled.episodes += 1
+        env.set_profiler(NULL_PROFILER)
+        if self._closed:
+            env.close()
+            return
+        if failed or (self.max_episodes is not None and pooled.episodes >= self.max_episodes) or not self.healthy(env):
+            pooled = self._recycle(pooled)
+        self._idle.put(pooled)
+        if self._closed:
+            # closed meanwhile
+            self._close_idle()
+
+    @contextmanager
+    def lease(self, timeout: Optional[float] = None):
+        env = self.acquire(timeout)
+        try:
+            yield env
+        except BaseException:
+            self.release(env, failed=True)
+            raise
+        self.release(env)
+
+    def healthy(self, env: Environment) -> bool:
+        """The client process is alive and answers an empty step"""
+        try:
+            env._poll_process()
+            env.step()
+            return True
+        except Exception as e:
+            log(f"Unhealthy game client: {e}")
+            return False
+
+    def _recycle(self, pooled: PooledEnvironment) -> PooledEnvironment:
+        """Close the client, the slot is relaunched when it is acquired"""
+        try:
+            pooled.env.close()
+        except Exception as e:
+            log(f"Failed to close the game client on port {pooled.port}: {e}")
+        return PooledEnvironment(pooled.port, None)
+
+    def _close_idle(self) -> None:
+        while True:
+            try:
+                pooled = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if pooled.env is not None:
+                pooled.env.close()
+
+    def close(self) -> None:
+        """Close the idle environments, the leased ones are closed when they are released"""
+        self._closed = True
+        self._close_idle()
+        if self._own_hub and not self._leased:
+            self.env_kwargs["hub"].close()
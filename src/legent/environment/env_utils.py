@@ -1,6 +1,7 @@
 import glob
 import os
 import subprocess
+import sys
 from sys import platform
 from typing import Optional, List
 from legent.utils.io import log, log_green, get_latest_folder
@@ -101,6 +102,23 @@ def launch_executable(file_name: str, args: List[str]) -> subprocess.Popen:
             raise Exception("EnvironmentException:\n" f"Error when trying to launch environment - make sure " f"permissions are set correctly. For example " f'"chmod -R 755 {launch_string}"') from perm
 
 
+def launch_mock_client(args: List[str]) -> subprocess.Popen:
+    """
+    Launches the python mock game client (legent.environment.mock_client) and returns the process handle for it.
+    :param args: List of string that will be passed as command line arguments, the same as for the game client.
+    """
+    package_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([package_root, env.get("PYTHONPATH", "")]).rstrip(os.pathsep)
+    return subprocess.Popen(
+        [sys.executable, "-m", "legent.environment.mock_client"] + args,
+        start_new_session=True,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
 def download_file(url, file_path):
     import requests
     from tqdm import tqdm
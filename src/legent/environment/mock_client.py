@@ -0,0 +1,213 @@
+"""
+A headless stand-in for the LEGENT game client, written in python.
+
+It connects to the python side (RpcCommunicator) through the same GetAction protocol as the Unity client, so the game loop,
+the communicator and the parallel runners can be run and load-tested on machines without the Unity binary or a GPU.
+The scene is not rendered: the images are synthetic, and the agent pose and instance positions are simulated from the scene JSON.
+
+Usage:
+    python -m legent.environment.mock_client --port 50051
+or Environment(env_path="mock"), which launches it as a subprocess.
+"""
+import argparse
+import io
+import json
+import math
+import time
+from typing import Dict, List
+
+import grpc
+import numpy as np
+
+from legent.protobuf.communicator_pb2 import ActionProto, ObservationProto
+from legent.protobuf.communicator_pb2_grpc import CommunicatorStub
+from legent.utils.config import DEFAULT_GRPC_PORT
+from legent.utils.math import in_view_frustum
+
+EYE_HEIGHT = 1.6  # height of the agent camera above the agent position
+WALK_STEP = 0.25  # meters moved per unit of move_forward/move_right without teleport
+FRAME_VARIANTS = 8  # number of precomputed frames, picked by the agent yaw so consecutive images differ
+
+
+def _xyz(v) -> Dict:
+    return {"x": float(v[0]), "y": float(v[1]), "z": float(v[2])}
+
+
+class MockGameClient:
+    def __init__(self, port: int = DEFAULT_GRPC_PORT, step_latency: float = 0, image_format: str = "PNG"):
+        """
+        Args:
+            port (int): port of the python side.
+            step_latency (float): seconds to sleep for every exchange, to simulate the rendering time of the game client.
+            image_format (str): format of the synthetic images, anything Pillow can save.
+        """
+        self.port = port
+        self.step_latency = step_latency
+        self.image_format = image_format
+
+        self.width, self.height = 448, 448
+        self.field_of_view = 120
+        self._frames: List[bytes] = []
+
+        self.instances = []
+        self.prefabs = []
+        self.hidden = set()
+        self.position = np.zeros(3)
+        self.yaw, self.pitch = 0.0, 0.0  # degrees, pitch > 0 looks downward
+        self.player = np.zeros(3)
+        self.bounds = None  # (min_xz, max_xz) the agent can walk in
+
+    # ---------- simulation ----------
+    @property
+    def forward(self) -> np.ndarray:
+        yaw, pitch = math.radians(self.yaw), math.radians(self.pitch)
+        return np.array([math.sin(yaw) * math.cos(pitch), -math.sin(pitch), math.cos(yaw) * math.cos(pitch)])
+
+    @property
+    def camera_position(self) -> np.ndarray:
+        return self.position + np.array([0, EYE_HEIGHT, 0])
+
+    def load_scene(self, scene: Dict) -> None:
+        self.instances = [np.array(instance["position"], dtype=float) for instance in scene["instances"]]
+        self.prefabs = [instance.get("prefab", "") for instance in scene["instances"]]
+        self.hidden = set()
+        self.position = np.array(scene["agent"]["position"], dtype=float)
+        self.yaw = float(scene["agent"].get("rotation", [0, 0, 0])[1])
+        self.pitch = 0.0
+        self.player = np.array(scene["player"]["position"], dtype=float)
+        floors = [polygon for room in scene.get("room_polygon", []) for polygon in room["polygon"]]
+        self.bounds = (np.min(floors, axis=0), np.max(floors, axis=0)) if floors else None
+
+    def move(self, forward: float, right: float) -> None:
+        yaw = math.radians(self.yaw)
+        direction = np.array([math.sin(yaw), 0, math.cos(yaw)])
+        right_direction = np.array([math.cos(yaw), 0, -math.sin(yaw)])
+        self.position = self.position + forward * direction + right * right_direction
+        if self.bounds is not None:
+            self.position[[0, 2]] = np.clip(self.position[[0, 2]], self.bounds[0], self.bounds[1])
+
+    def apply_action(self, action: ActionProto) -> None:
+        move_right, move_forward, rotate_right, rotate_down, jump, grab, teleport_forward, look_x, look_y = list(action.float_actions)[:9]
+        use_teleport, use_look_at = (list(action.int_actions) + [0, 0])[:2]
+        if use_look_at:
+            # turn to the image point, the image plane is at distance 1 from the camera
+            half_v = math.tan(math.radians(self.field_of_view / 2))
+            half_h = half_v * self.width / self.height
+            self.yaw += math.degrees(math.atan((look_x - 0.5) * 2 * half_h))
+            self.pitch += math.degrees(math.atan((look_y - 0.5) * 2 * half_v))
+        self.yaw = (self.yaw + rotate_right) % 360
+        self.pitch = float(np.clip(self.pitch + rotate_down, -90, 90))
+        if use_teleport:
+            self.move(teleport_forward, 0)
+        else:
+            self.move(move_forward * WALK_STEP, move_right * WALK_STEP)
+
+    def call_api(self, call: Dict):
+        api, args = call["api"], call["args"]
+        if api == "ObjectInView":
+            object_id = int(args)
+            if object_id in self.hidden:
+                return {"in_view": False}
+            in_view = in_view_frustum(
+                self.instances[object_id], self.camera_position, self.forward, self.field_of_view, self.width / self.height
+            )
+            return {"in_view": bool(in_view[0])}
+        elif api == "HideObject":
+            self.hidden.add(int(args))
+        elif api == "ShowObject":
+            self.hidden.discard(int(args))
+        return {}
+
+    def call_apis(self, api_calls: str) -> str:
+        calls = json.loads(api_calls)["calls"] if api_calls else []
+        returns = [self.call_api(call) for call in calls]
+        # one return per call when several APIs are called in one step
+        if not returns:
+            return ""
+        return json.dumps(returns[0] if len(returns) == 1 else returns)
+
+    # ---------- observations ----------
+    def _build_frames(self) -> None:
+        from PIL import Image
+
+        ys, xs = np.mgrid[0 : self.height, 0 : self.width]
+        base = np.stack([xs * 255 // max(self.width - 1, 1), ys * 255 // max(self.height - 1, 1), np.zeros_like(xs)], axis=-1)
+        self._frames = []
+        for i in range(FRAME_VARIANTS):
+            frame = base.copy()
+            frame[..., 2] = i * 255 // FRAME_VARIANTS
+            buffer = io.BytesIO()
+            Image.fromarray(frame.astype(np.uint8)).save(buffer, format=self.image_format)
+            self._frames.append(buffer.getvalue())
+
+    def image(self) -> bytes:
+        if not self._frames:
+            self._build_frames()
+        return self._frames[int(self.yaw // (360 / FRAME_VARIANTS)) % FRAME_VARIANTS]
+
+    def game_states(self) -> str:
+        instances = [
+            {"prefab": prefab, "position": _xyz(position), "forward": _xyz([0, 0, 1]), "is_hidden": i in self.hidden}
+            for i, (prefab, position) in enumerate(zip(self.prefabs, self.instances))
+        ]
+        yaw = math.radians(self.yaw)
+        return json.dumps(
+            {
+                "agent": {"position": _xyz(self.position), "forward": _xyz([math.sin(yaw), 0, math.cos(yaw)]), "rotation": _xyz([0, self.yaw, 0])},
+                "agent_camera": {"position": _xyz(self.camera_position), "forward": _xyz(self.forward)},
+                "player": {"position": _xyz(self.player), "forward": _xyz([0, 0, 1])},
+                "instances": instances,
+                "agent_grab_instance": -1,
+            }
+        )
+
+    def observation(self, api_returns: str = "") -> ObservationProto:
+        if self.step_latency:
+            time.sleep(self.step_latency)
+        return ObservationProto(type="STEP", image=self.image(), game_states=self.game_states(), api_returns=api_returns)
+
+    # ---------- protocol ----------
+    def handle(self, action: ActionProto) -> ObservationProto:
+        if action.type == "INIT":
+            config = json.loads(action.json_actions) if action.json_actions else {}
+            self.width = config.get("camera_resolution_width", self.width)
+            self.height = config.get("camera_resolution_height", self.height)
+            self.field_of_view = config.get("camera_field_of_view", self.field_of_view)
+            self._frames = []
+            return self.observation()
+        elif action.type == "RESET":
+            self.load_scene(json.loads(action.json_actions))
+            return self.observation(self.call_apis(action.api_calls))
+        self.apply_action(action)
+        return self.observation(self.call_apis(action.api_calls))
+
+    def run(self, connect_timeout: float = 600) -> None:
+        channel = grpc.insecure_channel(f"localhost:{self.port}", options=[("grpc.max_receive_message_length", -1), ("grpc.max_send_message_length", -1)])
+        grpc.channel_ready_future(channel).result(timeout=connect_timeout)
+        stub = CommunicatorStub(channel)
+        # the first observation only announces the client, the python side answers with INIT
+        obs = ObservationProto(type="STEP", game_states="{}")
+        try:
+            while True:
+                action = stub.GetAction(obs, wait_for_ready=True)
+                if action.type == "CLOSE":
+                    break
+                obs = self.handle(action)
+        except grpc.RpcError:
+            # the python side stops its server right after sending CLOSE
+            pass
+        finally:
+            channel.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=DEFAULT_GRPC_PORT, help="port of the python side")
+    parser.add_argument("--step_latency", type=float, default=0, help="seconds to sleep per exchange, simulates rendering")
+    parser.add_argument("--image_format", type=str, default="PNG", help="format of the synthetic images")
+    args, _ = parser.parse_known_args()
+    MockGameClient(args.port, args.step_latency, args.image_format).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,153 +1,265 @@
-from typing import Dict, NamedTuple, List
-from multiprocessing import Process, Pipe, Queue
-from multiprocessing.connection import Connection
-from queue import Empty as EmptyQueueException
-from legent.protobuf.communicator_pb2 import ActionProto, ObservationProto
+import multiprocessing
+import time
+import traceback
+from multiprocessing.connection import Connection, wait
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+
+from legent.action.action import Action, ResetInfo
+from legent.action.observation import Observation
 from legent.environment.env import Environment
 from legent.utils.config import DEFAULT_GRPC_PORT
 
-
-class EnvResponse(NamedTuple):
-    worker_id: int
-    observations: ObservationProto
+# Bytes per pixel of a frame slot, enough for RGBA images
+FRAME_CHANNELS = 4
 
 
 class EnvWorker:
-    def __init__(self, process: Process, worker_id: int, conn: Connection):
+    def __init__(self, process, worker_id: int, conn: Connection, shm: SharedMemory, frames: np.ndarray):
         self.process = process
         self.worker_id = worker_id
         self.conn = conn
+        self.shm = shm
+        # (ring_size, frame_bytes) view of the shared memory
+        self.frames = frames
         self.waiting_obs = False
         self.alive = True
 
-    def send(self, actions: ActionProto) -> None:
-        self.conn.send(actions)
+    def send(self, command: str, inputs=None) -> None:
+        self.conn.send((command, inputs))
 
-    def recv(self) -> EnvResponse:
-        return self.conn.recv()
+    def recv(self):
+        try:
+            return self.conn.recv()
+        except EOFError:
+            self.alive = False
+            self.waiting_obs = False
+            raise RuntimeError(f"Worker {self.worker_id} exited (exit code {self.process.exitcode}).")
 
 
-def worker(parent_conn: Connection, step_queue: Queue, worker_id: int, run_options: Dict) -> None:
+def worker(conn: Connection, worker_id: int, shm_name: str, ring_size: int, frame_bytes: int, env_kwargs: Dict) -> None:
+    # The workers share the resource tracker of the parent, which unlinks the shared memory
+    shm = SharedMemory(name=shm_name)
+    frames = np.ndarray((ring_size, frame_bytes), dtype=np.uint8, buffer=shm.buf)
+    env = None
     try:
-        # Each worker has its own Environment.
-        run_options["port"] = DEFAULT_GRPC_PORT + worker_id
-        env = Environment(file_name=run_options["file_name"], run_options=run_options)
+        env = Environment(**env_kwargs)
+        conn.send(("ready", None))
+        slot = 0
         while True:
-            # The parent_conn only needs to use recv() and does not need to send(), as return values are conveyed through the step_queue.
-            actions: ActionProto = parent_conn.recv()
-            if actions.type == "STEP" or actions.type == "RESET":
-                observations = env.step(actions)
-                step_queue.put(EnvResponse(worker_id, observations))
-            elif actions.type == "CLOSE":
+            command, inputs = conn.recv()
+            if command == "close":
                 break
-    except Exception as e:
-        raise
+            try:
+                obs = env.reset(inputs) if command == "reset" else env.step(inputs)
+                image = np.ascontiguousarray(obs.image)
+                if image.nbytes > frame_bytes:
+                    raise ValueError(f"The {image.shape} image does not fit in a frame slot of {frame_bytes} bytes.")
+                # The decoded frame is written into the next slot of the ring, only its metadata goes through the pipe
+                frames[slot, : image.nbytes] = image.reshape(-1).view(np.uint8)
+                conn.send(("obs", (obs.type, slot, image.shape, image.dtype.str, obs.text, obs.game_states, obs.api_returns)))
+                slot = (slot + 1) % ring_size
+            except Exception:
+                conn.send(("error", traceback.format_exc()))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    except Exception:
+        conn.send(("error", traceback.format_exc()))
     finally:
-        env.close()
-        parent_conn.close()
-        step_queue.put(EnvResponse(worker_id, ObservationProto(type="EXITED")))
-        step_queue.close()
+        del frames
+        shm.close()
+        if env is not None:
+            env.close()
+        conn.close()
 
 
 class ParallelEnvironment:
-    def __init__(self, file_name, num_envs: int = 1, run_options: Dict = {}):
-        run_options["file_name"] = file_name
+    """
+    num_envs environments stepped in parallel, each one in a worker process with its own game client on base_port + i.
+
+    Usage:
+        envs = ParallelEnvironment(4, env_path="auto", camera_resolution_width=2048, camera_resolution_height=1024)
+        obs = envs.reset({i: ResetInfo(scene) for i in range(4)})
+        envs.step_async({0: action_0, 2: action_2})
+        obs = envs.step_wait(timeout=60)  # {0: Observation, 2: Observation}
+        envs.close()
+
+    The workers decode the images and write them into shared memory rings of ring_size frames, so obs.image is a view
+    of the shared memory and is not copied. It is only valid until the worker has made ring_size more steps: copy it to keep it longer.
+    """
+
+    def __init__(
+        self,
+        num_envs: int = 1,
+        env_path: Optional[str] = None,
+        base_port: int = DEFAULT_GRPC_PORT,
+        ring_size: int = 2,
+        timeout: Optional[float] = None,
+        start_method: str = "spawn",
+        **env_kwargs,
+    ):
+        """
+        Args:
+            num_envs (int): number of environments.
+            env_path (str, optional): the game client each worker launches, see Environment.
+            base_port (int): the port of the game client of worker 0, worker i uses base_port + i.
+            ring_size (int): frames kept per worker in shared memory, i.e. for how many steps an observation image stays valid.
+            timeout (float, optional): default seconds step_wait() waits, None to wait forever. Also bounds the launch of the workers.
+            start_method (str): multiprocessing start method of the workers. The default "spawn" does not fork the gRPC state of the parent.
+            env_kwargs: passed to Environment, e.g. the camera settings. run_options["port"] is set per worker.
+        """
         self.num_envs = num_envs
+        self.ring_size = ring_size
+        self.timeout = timeout
+        width = env_kwargs.get("camera_resolution_width", 448)
+        height = env_kwargs.get("camera_resolution_height", 448)
+        self.frame_bytes = width * height * FRAME_CHANNELS
+        # observations that arrived before a step_wait() timed out
+        self._arrived: Dict[int, Observation] = {}
+        # a batch was sent and step_wait() has not returned all of it yet
+        self._in_flight = False
 
+        context = multiprocessing.get_context(start_method)
         self.env_workers: List[EnvWorker] = []
-        self.step_queue: Queue = Queue()
-        # create env workers
-        for worker_id in range(num_envs):
-            parent_conn, child_conn = Pipe()
-            child_process = Process(
-                target=worker,
-                args=(child_conn, self.step_queue, worker_id, run_options)
-            )
-            child_process.start()
-            env_worker = EnvWorker(child_process, worker_id, parent_conn)
-            self.env_workers.append(env_worker)
-        self.workers_alive = self.num_envs
-
-        self.actions = [None for i in range(num_envs)]
-        self.reset()
-        # welcome()
-
-    def check_waiting(self):
-        for worker_id in range(self.num_envs):
+        try:
+            for worker_id in range(num_envs):
+                run_options = dict(env_kwargs.get("run_options", {}))
+                run_options["port"] = base_port + worker_id
+                worker_kwargs = dict(env_kwargs, env_path=env_path, run_options=run_options)
+                shm = SharedMemory(create=True, size=ring_size * self.frame_bytes)
+                frames = np.ndarray((ring_size, self.frame_bytes), dtype=np.uint8, buffer=shm.buf)
+                parent_conn, child_conn = context.Pipe()
+                process = context.Process(
+                    target=worker,
+                    args=(child_conn, worker_id, shm.name, ring_size, self.frame_bytes, worker_kwargs),
+                    daemon=True,
+                )
+                process.start()
+                child_conn.close()
+                self.env_workers.append(EnvWorker(process, worker_id, parent_conn, shm, frames))
+            # the game clients are launched concurrently, wait for all of them
+            for env_worker in self.env_workers:
+                if timeout is not None and not env_worker.conn.poll(timeout):
+                    raise TimeoutError(f"Worker {env_worker.worker_id} did not start in {timeout} seconds.")
+                message, payload = env_worker.recv()
+                if message == "error":
+                    raise RuntimeError(f"Worker {env_worker.worker_id} failed to start:\n{payload}")
+        except BaseException:
+            self.close()
+            raise
+
+    def _send(self, command: str, inputs: Dict[int, Union[Action, ResetInfo, None]]) -> None:
+        # otherwise the observations kept by a timed out step_wait() would be returned as the ones of the new batch
+        if self._in_flight:
+            raise RuntimeError("The last batch is still in flight, call step_wait() until it returns before sending a new one.")
+        for worker_id in inputs:
             env_worker = self.env_workers[worker_id]
             if not env_worker.alive:
-                continue
-            if self.actions[worker_id] != None:
-                assert not env_worker.waiting_obs
-            else:
-                assert env_worker.waiting_obs
+                raise RuntimeError(f"Worker {worker_id} is not alive.")
+            if env_worker.waiting_obs:
+                raise RuntimeError(f"Worker {worker_id} is still waiting for the observation of its last step.")
+        for worker_id, worker_inputs in inputs.items():
+            self.env_workers[worker_id].send(command, worker_inputs)
+            self.env_workers[worker_id].waiting_obs = True
+        self._in_flight = bool(inputs)
 
-    def worker_act(self, worker_id: int, actions: ActionProto):
-        self.actions[worker_id] = actions
+    def step_async(self, actions: Union[Dict[int, Optional[Action]], List[Optional[Action]]]) -> None:
+        """
+        Send the actions to the workers without waiting for the observations.
 
-    def worker_reset(self, worker_id):
-        self.actions[worker_id] = ActionProto(type="RESET")
+        Args:
+            actions: worker_id -> action (None for an empty step), or a list with one action per worker.
+                The workers that are not included do not step.
+        """
+        if isinstance(actions, list):
+            actions = dict(enumerate(actions))
+        self._send("step", actions)
 
-    def worker_close(self, worker_id):
-        self.actions[worker_id] = ActionProto(type="CLOSE")
+    def reset_async(self, infos: Union[Dict[int, ResetInfo], List[ResetInfo]]) -> None:
+        """Send the scenes to load to the workers without waiting for the observations"""
+        if isinstance(infos, list):
+            infos = dict(enumerate(infos))
+        self._send("reset", infos)
 
-    def step(self) -> Dict[int, ObservationProto]:
+    def step_wait(self, timeout: Optional[float] = -1) -> Dict[int, Observation]:
         """
-        Step the environment. Execute actions on specified environments and return observations that have been completed up to now.
-
-        Note that the observations paired with the actions may not be included in the current returns (may be included in the next call or later).
-        The actions and observations should be externally paired by using the worker_id.
+        Block until all the workers that were sent a step or a reset have returned their observation.
 
         Args:
-            worker_actions (Dict[int, Dict]): A dictionary that maps worker_ids to actions. The worker_id-th environment will execute worker_actions[worker_id]. 
-                The worker_id that is not included indicates that no action should be executed, and the worker_id-th environment continues to wait for observations.
+            timeout (float, optional): seconds to wait, None to wait forever. Defaults to the timeout of the environment.
+                On timeout, TimeoutError is raised, the observations that arrived are kept for the next call,
+                and no new batch can be sent until a call returns (or raises another error).
 
         Returns:
-            Dict[int, ObservationProto]: A dictionary that maps worker_ids to observations. Worker_obs[worker_id] is the observations of worker_id-th environment.
-                Returning {} indicates that all environments have been closed.
+            Dict[int, Observation]: worker_id -> observation, for every worker that was waited for.
         """
-        self.check_waiting()
-
-        # Queue steps for any workers which aren't in the "waiting_obs" state.
-        for worker_id in range(self.num_envs):
-            env_worker = self.env_workers[worker_id]
-            if not env_worker.alive:
-                continue
-            if self.actions[worker_id] != None:
-                # assign action to env_worker according to worker_id
-                env_worker.send(self.actions[worker_id])
-                env_worker.waiting_obs = True
-        self.actions = [None for i in range(self.num_envs)]
-
-        worker_obs: Dict[int, ObservationProto] = {}
-        # Poll the step queue for completed steps from environment workers until we retrieve
-        # 1 or more, which we will then return as ObservationProto dict
-        while len(worker_obs) < 1:
-            try:
-                while True:
-                    step: EnvResponse = self.step_queue.get_nowait()
-                    assert step.worker_id not in worker_obs
-                    self.env_workers[step.worker_id].waiting_obs = False
-                    worker_obs[step.worker_id] = step.observations
-                    if step.observations.type == "EXITED":
-                        self.env_workers[step.worker_id].alive = False
-                        self.workers_alive -= 1
-                        if self.workers_alive == 0:
-                            return {}
-            except EmptyQueueException:
-                pass
+        if timeout == -1:
+            timeout = self.timeout
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        pending = {env_worker.conn: env_worker for env_worker in self.env_workers if env_worker.waiting_obs}
+        worker_obs, self._arrived = self._arrived, {}
+        errors = []
+        while pending:
+            remaining = None if deadline is None else max(deadline - time.perf_counter(), 0)
+            ready = wait(list(pending), remaining)
+            if not ready:
+                self._arrived = worker_obs
+                raise TimeoutError(f"Workers {sorted(w.worker_id for w in pending.values())} did not step in {timeout} seconds.")
+            for conn in ready:
+                env_worker = pending.pop(conn)
+                try:
+                    message, payload = env_worker.recv()
+                except RuntimeError as e:
+                    errors.append(str(e))
+                    continue
+                env_worker.waiting_obs = False
+                if message == "error":
+                    errors.append(f"Worker {env_worker.worker_id} failed:\n{payload}")
+                    continue
+                worker_obs[env_worker.worker_id] = self._read_observation(env_worker, payload)
+        self._in_flight = False
+        if errors:
+            raise RuntimeError("\n".join(errors))
         return worker_obs
 
-    def reset(self) -> None:
-        for worker_id in range(self.num_envs):
-            self.worker_reset(worker_id)
+    def _read_observation(self, env_worker: EnvWorker, payload) -> Observation:
+        obs_type, slot, shape, dtype, text, game_states, api_returns = payload
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        image = env_worker.frames[slot, :nbytes].view(dtype).reshape(shape)
+        return Observation.from_decoded(obs_type, image, text, game_states, api_returns)
+
+    def step(self, actions: Union[Dict[int, Optional[Action]], List[Optional[Action]]], timeout: Optional[float] = -1) -> Dict[int, Observation]:
+        self.step_async(actions)
+        return self.step_wait(timeout)
+
+    def reset(self, infos: Union[Dict[int, ResetInfo], List[ResetInfo]], timeout: Optional[float] = -1) -> Dict[int, Observation]:
+        self.reset_async(infos)
+        return self.step_wait(timeout)
 
     def close(self) -> None:
-        self.step_queue.close()
-        # Sanity check to kill zombie workers and report an issue if they occur.
-        if self.workers_alive > 0:
-            for env_worker in self.env_workers:
-                if env_worker.process.is_alive():
-                    env_worker.process.terminate()
-                    print("A SubprocessEnvManager worker did not shut down correctly so it was forcefully terminated.")
-        self.step_queue.join_thread()
+        """Close the workers and their game clients, and free the shared memory. The observation images become invalid"""
+        for env_worker in self.env_workers:
+            if env_worker.alive and env_worker.process.is_alive():
+                try:
+                    env_worker.send("close")
+                except (BrokenPipeError, OSError):
+                    pass
+        for env_worker in self.env_workers:
+            env_worker.process.join(timeout=300)
+            # Sanity check to kill zombie workers and report an issue if they occur.
+            if env_worker.process.is_alive():
+                env_worker.process.terminate()
+                print(f"Worker {env_worker.worker_id} did not shut down correctly so it was forcefully terminated.")
+            env_worker.alive = False
+            env_worker.conn.close()
+            env_worker.frames = None
+            try:
+                env_worker.shm.close()
+            except BufferError:
+                # observation images still reference the memory, it is freed when they are
+                pass
+            env_worker.shm.unlink()
+        self.env_workers = []
@@ -8,7 +8,7 @@ from shapely.geometry import Polygon
 
 from legent.scene_generation.doors import default_add_doors
 from legent.scene_generation.house import generate_house_structure
-from legent.scene_generation.objects import ObjectDB
+from legent.scene_generation.objects import ObjectDB, fit_rectangle
 from legent.scene_generation.room import Room
 from legent.scene_generation.room_spec import RoomSpec
 from legent.scene_generation.small_objects import add_small_objects
@@ -498,39 +498,40 @@ class HouseGenerator:
             x_margin = 2 * MARGIN["middle"]
             z_margin = 2 * MARGIN["middle"]
 
-        # NOTE: define the size filters
+        # NOTE: define the size filters, on the (not rotated, rotated) fit masks
         if anchor_delta in {1, 7}:
             # NOTE: should not be rotated
-            size_filter = lambda assets_df: (
-                (assets_df["xSize"] + x_margin < rect_x_length)
-                & (assets_df["zSize"] + z_margin < rect_z_length)
-            )
+            size_filter = lambda fits, fits_rotated: fits
             set_rotated = False
         elif anchor_delta in {3, 5}:
             # NOTE: must be rotated
-            size_filter = lambda assets_df: (
-                (assets_df["zSize"] + z_margin < rect_x_length)
-                & (assets_df["xSize"] + x_margin < rect_z_length)
-            )
+            size_filter = lambda fits, fits_rotated: fits_rotated
             set_rotated = True
         else:
             # NOTE: either rotated or not rotated works
-            size_filter = lambda assets_df: (
-                (
-                    (assets_df["xSize"] + x_margin < rect_x_length)
-                    & (assets_df["zSize"] + z_margin < rect_z_length)
-                )
-                | (
-                    (assets_df["zSize"] + z_margin < rect_x_length)
-                    & (assets_df["xSize"] + x_margin < rect_z_length)
-                )
-            )
-
+            size_filter = lambda fits, fits_rotated: fits | fits_rotated
+
+        # NOTE: both rotations of all the candidates are tested at once
+        group_fits = fit_rectangle(
+            spawnable_asset_groups["xSize"].to_numpy(dtype=float),
+            spawnable_asset_groups["zSize"].to_numpy(dtype=float),
+            rect_x_length,
+            rect_z_length,
+            x_margin,
+            z_margin,
+        )
         asset_group_candidates = spawnable_asset_groups[
-            spawnable_asset_groups[anchor_type] & size_filter(spawnable_asset_groups)
+            spawnable_asset_groups[anchor_type].to_numpy(dtype=bool) & size_filter(*group_fits)
         ]
+        asset_fits = odb.PREFAB_TABLE.fit_rectangle(
+            spawnable_assets["prefabRow"].to_numpy(),
+            rect_x_length,
+            rect_z_length,
+            x_margin,
+            z_margin,
+        )
         asset_candidates = spawnable_assets[
-            spawnable_assets[anchor_type] & size_filter(spawnable_assets)
+            spawnable_assets[anchor_type].to_numpy(dtype=bool) & size_filter(*asset_fits)
         ]
 
         if priority_asset_types:
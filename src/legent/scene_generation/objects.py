@@ -1,14 +1,18 @@
 import json
 import os
+import pickle
+import struct
 from collections import defaultdict
-from typing import Any, Dict, List, Tuple
+from typing import Any, Callable, Dict, List, Tuple
+import numpy as np
 from legent.environment.env_utils import get_default_env_data_path
+from legent.utils.config import OBJECT_DB_SNAPSHOT_PATH
+from legent.utils.io import log
 
 
 class ObjectDB:
     def __init__(self, PLACEMENT_ANNOTATIONS, OBJECT_DICT: Dict[str, List[str]], MY_OBJECTS: Dict[str, List[str]], OBJECT_TO_TYPE: Dict[str, str], PREFABS: Dict[str, Any], RECEPTACLES: Dict[str, Any], KINETIC_AND_INTERACTABLE_INFO: Dict[str, Any], ASSET_GROUPS: Dict[str, Any], FLOOR_ASSET_DICT: Dict, PRIORITY_ASSET_TYPES: Dict[str, List[str]]):
-        import pandas as pd
-        self.PLACEMENT_ANNOTATIONS: pd.DataFrame = PLACEMENT_ANNOTATIONS
+        self.PLACEMENT_ANNOTATIONS: "pd.DataFrame" = PLACEMENT_ANNOTATIONS
         self.OBJECT_DICT: Dict[str, List[str]] = OBJECT_DICT
         self.MY_OBJECTS: Dict[str, List[str]] = MY_OBJECTS
         self.OBJECT_TO_TYPE: Dict[str, str] = OBJECT_TO_TYPE
@@ -16,9 +20,110 @@ class ObjectDB:
         self.RECEPTACLES: Dict[str, Any] = RECEPTACLES
         self.KINETIC_AND_INTERACTABLE_INFO: Dict[str, Any] = KINETIC_AND_INTERACTABLE_INFO
         self.ASSET_GROUPS: Dict[str, Any] = ASSET_GROUPS
-        self.FLOOR_ASSET_DICT: Dict[Tuple[str, str], Tuple[Dict[str, Any], pd.DataFrame]] = FLOOR_ASSET_DICT
+        self.FLOOR_ASSET_DICT: Dict[Tuple[str, str], Tuple[Dict[str, Any], "pd.DataFrame"]] = FLOOR_ASSET_DICT
         self.PRIORITY_ASSET_TYPES: Dict[str, List[str]] = PRIORITY_ASSET_TYPES
-        
+        # The sizes of the prefabs as one (n, 3) array of x, y, z, row PREFAB_ROWS[name]
+        self.PREFAB_NAMES, self.PREFAB_SIZES = _get_prefab_sizes(PREFABS)
+        self.PREFAB_ROWS: Dict[str, int] = {name: row for row, name in enumerate(self.PREFAB_NAMES)}
+
+    def __getattr__(self, name: str) -> Any:
+        # The parts of a snapshot that are rarely used are only loaded when they are first accessed
+        lazy: Dict[str, Callable[[], Any]] = self.__dict__.get("_lazy", {})
+        if name in lazy:
+            value = lazy.pop(name)()
+            setattr(self, name, value)
+            return value
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+    @property
+    def PREFAB_TABLE(self) -> "PrefabTable":
+        if self.__dict__.get("_prefab_table") is None:
+            self._prefab_table = PrefabTable(self)
+        return self._prefab_table
+
+
+def fit_rectangle(x_sizes: np.ndarray, z_sizes: np.ndarray, rect_x_length: float, rect_z_length: float, x_margin: float = 0, z_margin: float = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """Masks of the footprints that fit in the rectangle, not rotated and rotated by 90 degrees, with the margins added to their x and z sizes"""
+    x = x_sizes + x_margin
+    z = z_sizes + z_margin
+    return (x < rect_x_length) & (z < rect_z_length), (z < rect_x_length) & (x < rect_z_length)
+
+
+class PrefabTable:
+    """
+    The prefab sizes and types as arrays with a row per prefab, so that a query over many prefabs (e.g. all the floor assets
+    of some types that fit a rectangle) is one vectorized operation instead of a loop over the PREFABS dicts.
+    The prefabs added to PREFABS after the table is built (e.g. the custom ones) get their rows when they are first looked up,
+    a prefab without a size raises KeyError.
+    """
+
+    def __init__(self, odb: ObjectDB):
+        self.odb = odb
+        self.names: List[str] = list(odb.PREFAB_NAMES)
+        self.rows: Dict[str, int] = dict(odb.PREFAB_ROWS)
+        # (n, 3) x, y, z
+        self.sizes: np.ndarray = odb.PREFAB_SIZES
+        # the asset type of a prefab is the OBJECT_DICT key listing it, types[row] its index in type_names (-1 for none)
+        # and type_positions[row] its position in the list, so the rows of a type can be given in the OBJECT_DICT order
+        self.type_names: List[str] = list(odb.OBJECT_DICT)
+        self.type_codes: Dict[str, int] = {name: code for code, name in enumerate(self.type_names)}
+        self.types = np.full(len(self.names), -1, dtype=np.int64)
+        self.type_positions = np.zeros(len(self.names), dtype=np.int64)
+        # the prefabs listed in OBJECT_DICT that have no row, per type, raised when the type is queried
+        self._missing: Dict[int, List[str]] = defaultdict(list)
+        for code, type_name in enumerate(self.type_names):
+            for position, name in enumerate(odb.OBJECT_DICT[type_name]):
+                row = self.rows.get(name)
+                if row is None:
+                    self._missing[code].append(name)
+                elif self.types[row] == -1:
+                    self.types[row] = code
+                    self.type_positions[row] = position
+                else:
+                    log(f"{name} is listed under the asset types {self.type_names[self.types[row]]} and {type_name}, its type is {self.type_names[self.types[row]]}")
+
+    def _add(self, names: List[str]) -> None:
+        prefabs = {name: self.odb.PREFABS[name] for name in names}
+        missing_size = [name for name, prefab in prefabs.items() if "size" not in prefab]
+        if missing_size:
+            raise KeyError(f"The prefabs {missing_size} have no size.")
+        sizes = _get_prefab_sizes(prefabs)[1]
+        self.rows.update({name: len(self.names) + i for i, name in enumerate(names)})
+        self.names += names
+        self.sizes = np.concatenate([self.sizes, sizes])
+        self.types = np.concatenate([self.types, np.full(len(names), -1, dtype=np.int64)])
+        self.type_positions = np.concatenate([self.type_positions, np.zeros(len(names), dtype=np.int64)])
+
+    def get_rows(self, names: List[str]) -> np.ndarray:
+        missing = list(dict.fromkeys(name for name in names if name not in self.rows))
+        if missing:
+            self._add(missing)
+        return np.fromiter((self.rows[name] for name in names), dtype=np.int64, count=len(names))
+
+    def rows_of_types(self, type_names: List[str]) -> np.ndarray:
+        """The rows of the prefabs of the asset types, by type in the given order and in the OBJECT_DICT order within a type"""
+        codes = np.array([self.type_codes[name] for name in type_names], dtype=np.int64)
+        for code in codes:
+            if self._missing.get(code):
+                raise KeyError(f"The prefabs {self._missing[code]} of {self.type_names[code]} are not in PREFABS or have no size.")
+        rows = np.flatnonzero(np.isin(self.types, codes))
+        # the rank of the type of every row in type_names
+        ranks = np.empty(len(self.type_names), dtype=np.int64)
+        ranks[codes] = np.arange(len(codes))
+        return rows[np.lexsort((self.type_positions[rows], ranks[self.types[rows]]))]
+
+    def fit_rectangle(self, rows: np.ndarray, rect_x_length: float, rect_z_length: float, x_margin: float = 0, z_margin: float = 0) -> Tuple[np.ndarray, np.ndarray]:
+        """Masks of the prefabs at rows that fit in the rectangle, not rotated and rotated by 90 degrees (see fit_rectangle)"""
+        sizes = self.sizes[rows]
+        return fit_rectangle(sizes[:, 0], sizes[:, 2], rect_x_length, rect_z_length, x_margin, z_margin)
+
+
+def _get_prefab_sizes(prefabs: Dict[str, Any]) -> Tuple[List[str], np.ndarray]:
+    """The names of the prefabs that have a size and their (n, 3) sizes. The others get no row in the PrefabTable"""
+    names = [name for name, prefab in prefabs.items() if "size" in prefab]
+    sizes = np.array([[prefabs[name]["size"][xyz] for xyz in "xyz"] for name in names], dtype=np.float64).reshape(-1, 3)
+    return names, sizes
+
 
 ENV_DATA_PATH = None
 def get_data_path():
@@ -97,18 +202,19 @@ def _get_floor_assets(
         odb.PLACEMENT_ANNOTATIONS["onFloor"]
         & (odb.PLACEMENT_ANNOTATIONS[f"in{room_type}s"] > 0)
     ]
+    # prefabRow is the row of the asset in odb.PREFAB_TABLE
+    table = odb.PREFAB_TABLE
+    rows = table.rows_of_types(list(floor_types.index))
+    sizes = table.sizes[rows]
     assets = pd.DataFrame(
-        [
-            {
-                "assetId": asset_name,
-                "assetType": asset_type,
-                "xSize": odb.PREFABS[asset_name]["size"]["x"],
-                "ySize": odb.PREFABS[asset_name]["size"]["y"],
-                "zSize": odb.PREFABS[asset_name]["size"]["z"],
-            }
-            for asset_type in floor_types.index
-            for asset_name in odb.OBJECT_DICT[asset_type]
-        ]
+        {
+            "assetId": [table.names[row] for row in rows],
+            "assetType": [table.type_names[code] for code in table.types[rows]],
+            "xSize": sizes[:, 0],
+            "ySize": sizes[:, 1],
+            "zSize": sizes[:, 2],
+            "prefabRow": rows,
+        }
     )
     assets: pd.DataFrame = pd.merge(assets, floor_types, on="assetType", how="left")
     assets.set_index("assetId", inplace=True)
@@ -133,25 +239,131 @@ def _get_receptacles():
     return json.load(open(filepath))
 
 
+PRIORITY_ASSET_TYPES = {
+    "Bedroom": ["bed", "pc_table"],
+    "LivingRoom": ["tv", "table", "sofa"],
+    "Kitchen": ["kitchen_table", "refrigerator","oven"],
+    "Bathroom": ["toilet","washing_machine"],
+}
+
+
+def _load_object_db():
+    """Build the ObjectDB from the data files"""
+    prefabs, kinetic_and_interactable_info = _get_prefabs()
+    return ObjectDB(
+        PLACEMENT_ANNOTATIONS=_get_place_annotations(),
+        OBJECT_DICT=_get_object_dict(),
+        MY_OBJECTS=_get_my_objects(),
+        OBJECT_TO_TYPE=_get_object_to_type(),
+        PREFABS=prefabs,
+        RECEPTACLES=_get_receptacles(),
+        KINETIC_AND_INTERACTABLE_INFO=kinetic_and_interactable_info,
+        ASSET_GROUPS=_get_asset_groups(),
+        FLOOR_ASSET_DICT=keydefaultdict(_get_default_floor_assets_from_key),
+        PRIORITY_ASSET_TYPES=PRIORITY_ASSET_TYPES,
+    )
+
+
+# A snapshot is one file: magic, header length, pickled header, then the sections from a 64-byte aligned offset.
+# The prefab sizes are a raw float64 array first (memory-mapped when loaded), the other sections are pickles.
+SNAPSHOT_MAGIC = b"LEGODB01"
+# Loaded with the snapshot, the others on first access. PLACEMENT_ANNOTATIONS is a DataFrame, so the processes that generate
+# rooms (see _get_floor_assets) still import pandas, when they generate the first one
+EAGER_SECTIONS = ["OBJECT_DICT", "MY_OBJECTS", "OBJECT_TO_TYPE", "PREFABS", "KINETIC_AND_INTERACTABLE_INFO", "PREFAB_NAMES"]
+LAZY_SECTIONS = ["PLACEMENT_ANNOTATIONS", "RECEPTACLES", "ASSET_GROUPS"]
+
+
+def _data_offset(header_length: int) -> int:
+    return -(-(len(SNAPSHOT_MAGIC) + 8 + header_length) // 64) * 64
+
+
+def _get_sources() -> Dict[str, Tuple[int, int]]:
+    """(mtime, size) of every data file the ObjectDB is built from, a snapshot is valid as long as they do not change"""
+    names = ["placement_annotations.csv", "object_dict.json", "my_objects.json", "object_name_to_type.json", "addressables.json", "receptacle.json"]
+    names += [os.path.join("asset_groups", name) for name in sorted(os.listdir(os.path.join(get_data_path(), "asset_groups")))]
+    sources = {}
+    for name in names:
+        stat = os.stat(os.path.join(get_data_path(), name))
+        sources[name] = (stat.st_mtime_ns, stat.st_size)
+    return sources
+
+
+def save_object_db_snapshot(odb: ObjectDB, path: str = OBJECT_DB_SNAPSHOT_PATH, sources: Dict = None) -> None:
+    sizes = np.ascontiguousarray(odb.PREFAB_SIZES, dtype=np.float64).tobytes()
+    sections = {name: pickle.dumps(getattr(odb, name), protocol=pickle.HIGHEST_PROTOCOL) for name in EAGER_SECTIONS + LAZY_SECTIONS}
+    # offsets from the start of the data
+    offsets, offset = {}, len(sizes)
+    for name, data in sections.items():
+        offsets[name] = (offset, len(data))
+        offset += len(data)
+    header = {
+        "sources": sources if sources is not None else _get_sources(),
+        "sizes": len(odb.PREFAB_NAMES),
+        "sections": offsets,
+    }
+    header_data = pickle.dumps(header, protocol=pickle.HIGHEST_PROTOCOL)
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(struct.pack("<Q", len(header_data)))
+        f.write(header_data)
+        f.write(b"\0" * (_data_offset(len(header_data)) - f.tell()))
+        f.write(sizes)
+        for data in sections.values():
+            f.write(data)
+    os.replace(tmp_path, path)
+
+
+def load_object_db_snapshot(path: str = OBJECT_DB_SNAPSHOT_PATH, check_sources: bool = True):
+    """The ObjectDB of the snapshot, None if there is none or it is out of date"""
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            return None
+        (header_length,) = struct.unpack("<Q", f.read(8))
+        header = pickle.loads(f.read(header_length))
+        if check_sources and header["sources"] != _get_sources():
+            return None
+        start = _data_offset(header_length)
+
+        # everything is read from this open file, a snapshot rebuilt meanwhile by another process replaces the path, not the file
+        sections = {}
+        for name in EAGER_SECTIONS + LAZY_SECTIONS:
+            offset, length = header["sections"][name]
+            f.seek(start + offset)
+            sections[name] = f.read(length)
+        count = header["sizes"]
+        sizes = np.memmap(f, dtype=np.float64, mode="r", offset=start, shape=(count, 3)) if count else np.zeros((0, 3))
+
+    odb = ObjectDB.__new__(ObjectDB)
+    for name in EAGER_SECTIONS:
+        setattr(odb, name, pickle.loads(sections.pop(name)))
+    # only the unpickling is deferred
+    odb._lazy = {name: (lambda data=data: pickle.loads(data)) for name, data in sections.items()}
+    odb.FLOOR_ASSET_DICT = keydefaultdict(_get_default_floor_assets_from_key)
+    odb.PRIORITY_ASSET_TYPES = PRIORITY_ASSET_TYPES
+    odb.PREFAB_SIZES = sizes
+    odb.PREFAB_ROWS = {name: row for row, name in enumerate(odb.PREFAB_NAMES)}
+    return odb
+
+
 DEFAULT_OBJECT_DB = None
 def get_default_object_db():
+    """The ObjectDB of the env data, from its snapshot at OBJECT_DB_SNAPSHOT_PATH, which is (re)built when the data changes"""
     global DEFAULT_OBJECT_DB
     if DEFAULT_OBJECT_DB is None:
-        DEFAULT_OBJECT_DB = ObjectDB(
-            PLACEMENT_ANNOTATIONS=_get_place_annotations(),
-            OBJECT_DICT=_get_object_dict(),
-            MY_OBJECTS=_get_my_objects(),
-            OBJECT_TO_TYPE=_get_object_to_type(),
-            PREFABS=_get_prefabs()[0],
-            RECEPTACLES=_get_receptacles(),
-            KINETIC_AND_INTERACTABLE_INFO=_get_prefabs()[1],
-            ASSET_GROUPS=_get_asset_groups(),
-            FLOOR_ASSET_DICT=keydefaultdict(_get_default_floor_assets_from_key),
-            PRIORITY_ASSET_TYPES={
-                "Bedroom": ["bed", "pc_table"],
-                "LivingRoom": ["tv", "table", "sofa"],
-                "Kitchen": ["kitchen_table", "refrigerator","oven"],
-                "Bathroom": ["toilet","washing_machine"],
-            },
-        )
+        try:
+            DEFAULT_OBJECT_DB = load_object_db_snapshot()
+        except Exception as e:
+            log(f"The ObjectDB snapshot {OBJECT_DB_SNAPSHOT_PATH} is unreadable and is rebuilt: {e}")
+        if DEFAULT_OBJECT_DB is None:
+            sources = _get_sources()
+            DEFAULT_OBJECT_DB = _load_object_db()
+            try:
+                save_object_db_snapshot(DEFAULT_OBJECT_DB, sources=sources)
+            except OSError as e:
+                log(f"Failed to save the ObjectDB snapshot: {e}")
     return DEFAULT_OBJECT_DB
@@ -18,6 +18,10 @@ DATASET_FOLDER = f"{resource_path}/dataset"
 MODEL_FOLDER = f"{resource_path}/models"
 EVAL_FOLDER = f"{resource_path}/eval"
 PACKED_FOLDER = f"{resource_path}/packed_scenes"
+# The measured mesh files (size, bounds, placeable surfaces), see legent.asset.mesh_index
+MESH_INDEX_PATH = os.environ.get("LEGENT_MESH_INDEX", f"{resource_path}/mesh_index.json")
+# The ObjectDB of the env data in one file, loaded at startup instead of the csv and json files
+OBJECT_DB_SNAPSHOT_PATH = os.environ.get("LEGENT_OBJECT_DB_SNAPSHOT", f"{resource_path}/object_db.snapshot")
 
 
 DEFAULT_GRPC_PORT = 50051
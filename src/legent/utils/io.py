@@ -3,9 +3,13 @@ import json
 from colorama import Fore, Style
 from datetime import datetime
 import os
+import io
+import queue
+import threading
 import zipfile
 from typing import List
 from legent.utils.config import PACKED_FOLDER
+from legent.utils.profiler import NULL_PROFILER
 
 
 def log(*args):
@@ -36,6 +40,16 @@ def store_json(obj, file):
         return json.dump(obj, f, ensure_ascii=False, indent=4)
 
 
+def get_center_mark_range(shape, mark_size=8):
+    """Rows and columns (start, end) of the red mark at the center of an image of the given shape"""
+    center = (shape[0] // 2, shape[1] // 2)
+    x_start = max(center[0] - mark_size // 2, 0)
+    x_end = min(center[0] + mark_size // 2, shape[0])
+    y_start = max(center[1] - mark_size // 2, 0)
+    y_end = min(center[1] + mark_size // 2, shape[1])
+    return (x_start, x_end), (y_start, y_end)
+
+
 def save_image(image, file, center_mark=False):
     from skimage.io import imsave
     import numpy as np
@@ -44,12 +58,7 @@ def save_image(image, file, center_mark=False):
         marked_image = np.copy(image)
 
         # Define the range of the center mark
-        mark_size = 8
-        center = (image.shape[0] // 2, image.shape[1] // 2)
-        x_start = max(center[0] - mark_size // 2, 0)
-        x_end = min(center[0] + mark_size // 2, image.shape[0])
-        y_start = max(center[1] - mark_size // 2, 0)
-        y_end = min(center[1] + mark_size // 2, image.shape[1])
+        (x_start, x_end), (y_start, y_end) = get_center_mark_range(image.shape)
 
         # Set the marked area to red
         marked_image[x_start:x_end, y_start:y_end] = [255, 0, 0]
@@ -58,6 +67,66 @@ def save_image(image, file, center_mark=False):
         imsave(file, image, check_contrast=False)
 
 
+def encode_image(image, format="JPEG", center_mark=False, size=None, **kwargs) -> bytes:
+    """
+    Encode an image array in memory. The center mark is drawn on the encoded copy, the array is left unchanged.
+
+    Args:
+        size: (width, height) to downscale the image to before encoding. None keeps the size of the array.
+        kwargs: passed to PIL Image.save, e.g. quality=85 for JPEG.
+    """
+    from PIL import Image
+
+    pil_image = Image.fromarray(image)
+    if pil_image.mode != "RGB":
+        pil_image = pil_image.convert("RGB")
+    if size is not None and tuple(size) != pil_image.size:
+        pil_image = pil_image.resize(tuple(size), Image.BILINEAR, reducing_gap=2.0)
+    if center_mark:
+        # drawn after the resize, so the mark has the same size in the image the model sees
+        (x_start, x_end), (y_start, y_end) = get_center_mark_range((pil_image.height, pil_image.width))
+        pil_image.paste((255, 0, 0), (y_start, x_start, y_end, x_end))
+    buffer = io.BytesIO()
+    pil_image.save(buffer, format=format, **kwargs)
+    return buffer.getvalue()
+
+
+class ImageWriter:
+    """Saves images with save_image in a background thread, so the caller waits neither for the encoding nor for the disk"""
+
+    def __init__(self):
+        self.profiler = NULL_PROFILER
+        self.__queue = queue.Queue()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def save(self, image, file, center_mark=False):
+        # the image must not be modified afterwards, it is written later
+        self.__queue.put((image, file, center_mark))
+
+    def __run(self):
+        while True:
+            item = self.__queue.get()
+            try:
+                if item is None:
+                    return
+                with self.profiler.span("io.save_image"):
+                    save_image(*item)
+            except Exception as e:
+                log(f"Failed to save image {item[1]}: {e}")
+            finally:
+                self.__queue.task_done()
+
+    def flush(self):
+        """Wait until all the images queued are written"""
+        self.__queue.join()
+
+    def close(self):
+        if self.__thread.is_alive():
+            self.__queue.put(None)
+            self.__thread.join()
+
+
 def load_json_from_toolkit(file):
     import pkg_resources
 
@@ -81,6 +81,45 @@ def distance(v1: np.ndarray, v2: np.ndarray) -> float:
     return float(np.linalg.norm(v1 - v2))
 
 
+def in_view_frustum(points: np.ndarray, camera_position: np.ndarray, camera_forward: np.ndarray, vertical_field_of_view: float, aspect: float, margin: float = 0, max_distance: float = None) -> np.ndarray:
+    """Check which points are inside the view frustum of a camera (without roll), all points at once.
+
+    Args:
+        points (np.ndarray): (N, 3) positions
+        camera_position (np.ndarray): 3D position of the camera
+        camera_forward (np.ndarray): 3D direction the camera looks at
+        vertical_field_of_view (float): vertical field of view in degrees
+        aspect (float): width / height of the camera image
+        margin (float, optional): degrees added to the half field of views, so objects whose center is slightly outside of the image are kept. Defaults to 0.
+        max_distance (float, optional): far plane of the frustum. Defaults to None (no far plane).
+
+    Returns:
+        np.ndarray: (N,) bool mask of the points in the frustum
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    forward = normalize(np.asarray(camera_forward, dtype=float))
+    right = np.cross(np.array([0, 1, 0]), forward)
+    if not np.any(right):  # looking straight up or down
+        right = np.array([1.0, 0, 0])
+    right = normalize(right)
+    up = np.cross(forward, right)
+
+    # coordinates of the points in the camera space
+    relative = points - np.asarray(camera_position, dtype=float)
+    local = relative @ np.column_stack((right, up, forward))
+    x, y, z = local[:, 0], local[:, 1], local[:, 2]
+
+    half_v = np.radians(vertical_field_of_view / 2)
+    half_h = np.arctan(np.tan(half_v) * aspect)
+    half_v = min(half_v + np.radians(margin), np.pi / 2)
+    half_h = min(half_h + np.radians(margin), np.pi / 2)
+    # compare angles rather than tangents, so margins up to 90 degrees stay well-defined
+    mask = (np.arctan2(np.abs(x), z) <= half_h) & (np.arctan2(np.abs(y), z) <= half_v)
+    if max_distance is not None:
+        mask &= np.linalg.norm(relative, axis=1) <= max_distance
+    return mask
+
+
 def convert_euler_angles(y0):
     """
     Convert euler angles from [180, y0, 180] to [0, y1, 0].
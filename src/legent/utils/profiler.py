@@ -0,0 +1,163 @@
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest-rank percentile of the values, q in [0, 100]"""
+    values = sorted(values)
+    if not values:
+        return 0.0
+    rank = max(math.ceil(q / 100 * len(values)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+class TraceWriter:
+    """
+    Collects the spans of all the profilers of a process and saves them in the Chrome Trace Event format,
+    viewable in chrome://tracing or https://ui.perfetto.dev. Every span is a complete event on the row of its thread,
+    tagged with the episode it belongs to, so the interleaving of concurrent episodes and the waits between the
+    main, executor and gRPC threads can be seen on one timeline.
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path (str): the json file save() writes the trace to.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._events = []
+        self._threads: Dict[int, str] = {}
+
+    def add(self, name: str, start: float, duration: float, episode: Optional[str] = None) -> None:
+        """Record a span of the calling thread. start is time.perf_counter()"""
+        thread = threading.current_thread()
+        event = {"name": name, "cat": name.split(".")[0], "ph": "X", "ts": start * 1e6, "dur": duration * 1e6, "pid": os.getpid(), "tid": thread.ident}
+        if episode is not None:
+            event["args"] = {"episode": episode}
+        with self._lock:
+            self._events.append(event)
+            self._threads.setdefault(thread.ident, thread.name)
+
+    def save(self) -> None:
+        with self._lock:
+            events = list(self._events)
+            threads = dict(self._threads)
+        metadata = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}} for tid, name in threads.items()]
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms"}, f)
+
+
+class Profiler:
+    """
+    Timing spans and payload sizes of the steps of an episode.
+
+    Spans are nested with `with profiler.span("env.step"):`, payload sizes are summed with `profiler.add("image_bytes", n)`.
+    end_step() returns (and writes to path, if given) one record per step with the total seconds and count of every span
+    and the payload sums of the step. close() writes a summary with the p50/p95 of every span.
+    A disabled profiler (NULL_PROFILER) costs nothing, so the instrumented code can always call it.
+    """
+
+    def __init__(self, path: Optional[str] = None, enabled: bool = True, tracer: Optional[TraceWriter] = None, episode: Optional[str] = None):
+        """
+        Args:
+            path (str, optional): JSONL file to write the step records and the summary to. Nothing is written if None.
+            enabled (bool): if False, span() and add() do nothing.
+            tracer (TraceWriter, optional): also send every span to this trace, shared by the episodes of the process.
+            episode (str, optional): the episode the spans are tagged with in the trace.
+        """
+        self.enabled = enabled
+        self.path = path
+        self.tracer = tracer
+        self.episode = episode
+        self._file = open(path, "w", encoding="utf-8") if path and enabled else None
+        self._lock = threading.Lock()
+        # every finished span of the episode: (name, start, duration, thread id), start is time.perf_counter()
+        self.events = []
+        self._step_spans: Dict[str, List[float]] = {}
+        self._step_payload: Dict[str, float] = {}
+        self._payload: Dict[str, float] = {}
+        self.steps = 0
+
+    @contextmanager
+    def span(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            with self._lock:
+                self.events.append((name, start, duration, threading.get_ident()))
+                self._step_spans.setdefault(name, []).append(duration)
+            if self.tracer is not None:
+                self.tracer.add(name, start, duration, self.episode)
+
+    def add(self, name: str, value: float) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self._step_payload[name] = self._step_payload.get(name, 0) + value
+            self._payload[name] = self._payload.get(name, 0) + value
+
+    def end_step(self, step: int, **kwargs) -> Optional[Dict]:
+        """Close the record of the step. kwargs: anything else to record for the step"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            spans, self._step_spans = self._step_spans, {}
+            payload, self._step_payload = self._step_payload, {}
+        record = {
+            "step": step,
+            "spans": {name: {"total": sum(durations), "count": len(durations)} for name, durations in spans.items()},
+            "payload": payload,
+        }
+        record.update(kwargs)
+        self.steps += 1
+        self._write(record)
+        return record
+
+    def summary(self) -> Dict:
+        """count, total, mean, p50 and p95 seconds of every span over the episode, and the payload sums"""
+        durations: Dict[str, List[float]] = {}
+        with self._lock:
+            for name, _, duration, _ in self.events:
+                durations.setdefault(name, []).append(duration)
+            payload = dict(self._payload)
+        spans = {
+            name: {
+                "count": len(values),
+                "total": sum(values),
+                "mean": sum(values) / len(values),
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+            }
+            for name, values in sorted(durations.items())
+        }
+        return {"steps": self.steps, "spans": spans, "payload": payload}
+
+    def _write(self, record: Dict) -> None:
+        if self._file is not None:
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+
+    def close(self) -> Optional[Dict]:
+        """Write the summary as the last line and close the file. Returns the summary"""
+        if not self.enabled:
+            return None
+        summary = self.summary()
+        if self._file is not None and not self._file.closed:
+            self._write({"summary": summary})
+            self._file.close()
+        return summary
+
+
+# The profiler of the code that is not profiled
+NULL_PROFILER = Profiler(enabled=False)
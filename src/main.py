@@ -1,9 +1,12 @@
 import argparse
+import os, re, sys
 from Game import *
 from Agent import *
 from prompt_config import *
 from config import *
 from BaseGame import *
+from legent import TraceWriter
+from ResponseCache import ResponseCache
 
 
 def parse_args():
@@ -17,7 +20,16 @@ def parse_args():
         "--scene_id", type=int, default=1, help="scene_id to load of level [level]"
     )
     parser.add_argument(
-        "--record_path", type=str, default=None, help="record path to load"
+        "--record_path", type=str, default=None,
+        help="replay the episode recorded in this dir (e.g. game_cache/level1-1/gpt-4o_t_1) instead of querying the model. "
+        "--level, --scene_id, --room_num and --hint must be the ones of the record"
+    )
+    parser.add_argument(
+        "--env_path", type=str, default=ENV_PATH, help='the game client to launch, "mock" for the python mock client'
+    )
+    parser.add_argument(
+        "--replay_resolution", type=int, nargs=2, default=None, metavar=("WIDTH", "HEIGHT"),
+        help="render the replayed episode at this camera resolution",
     )
     parser.add_argument(
         "--history_type",
@@ -29,32 +41,70 @@ def parse_args():
     parser.add_argument(
         "--max_history", default=None, type=int, help="max history length"
     )
+    parser.add_argument(
+        "--max_images", default=None, type=int, help="only the screenshots of the last max_images rounds are sent, older ones are replaced by a text"
+    )
     parser.add_argument("--max_retry", default=3, type=int, help="max retry times")
     parser.add_argument("--max_allowed_steps", default=20, type=int, help="max allowed steps to finish the task")
+    parser.add_argument(
+        "--profile", action="store_true", help="record the timings and payload sizes of every step into profile.jsonl in the record dir"
+    )
+    parser.add_argument(
+        "--bypass_cache", action="store_true", help="do not answer from the response cache (RESPONSE_CACHE_PATH in config.py), the responses are still stored"
+    )
+    parser.add_argument(
+        "--trace", type=str, default=None, help="save a chrome trace (chrome://tracing, Perfetto) of the episode to this json file"
+    )
 
     args = parser.parse_args()
     return args
 
 
-args = parse_args()
+def get_sys_prompt(hint, history_type):
+    if hint:
+        return PromptTemplate_Hint.SYS_PROMPT
+    if history_type == "key":
+        return PromptTemplate_Base.SYS_PROMPT_KEYONLY
+    return PromptTemplate_Base.SYS_PROMPT
 
-if args.hint:
-    agent_sys_prompt = PromptTemplate_Hint.SYS_PROMPT
-else:
-    if args.history_type == "key":
-        agent_sys_prompt = PromptTemplate_Base.SYS_PROMPT_KEYONLY
-    else:
-        agent_sys_prompt = PromptTemplate_Base.SYS_PROMPT
 
-agent = AgentPlayer(
-    system_prompt=agent_sys_prompt, model=args.model,
-    history_type=args.history_type, max_history=args.max_history,
-    max_retry=args.max_retry,
-)
-scene_path = f"../levels/scene_data/{args.level}/{args.scene_id}.json"
-level_data = f"../levels/{args.level}.json"
+def replay(args):
+    """Replay a recorded episode into level_replay-scene_id, exits with 1 if it does not match the record"""
+    model_dir = os.path.basename(os.path.normpath(args.record_path))
+    model, trial = re.match(r"(.+)_t_(\d+)$", model_dir).groups()
+    agent = ReplayAgentPlayer(args.model or model, resolution=args.replay_resolution)
+    tracer = TraceWriter(args.trace) if args.trace else None
+    game = ReplayGame(agent, f"../levels/scene_data/{args.level}/{args.scene_id}.json", f"../levels/{args.level}.json", args.level,
+                      room_num=args.room_num, scene_id=args.scene_id, hint=args.hint, record_path=args.record_path,
+                      suffix_level="replay", trial=int(trial), env_path=args.env_path, profile=args.profile, tracer=tracer)
+    result = game.main(args)
+    if tracer is not None:
+        tracer.save()
+    if not result["verified"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.record_path:
+        replay(args)
+        sys.exit(0)
+
+    agent = AgentPlayer(
+        system_prompt=get_sys_prompt(args.hint, args.history_type), model=args.model,
+        history_type=args.history_type, max_history=args.max_history,
+        max_retry=args.max_retry, max_images=args.max_images,
+        cache=ResponseCache(bypass=args.bypass_cache) if RESPONSE_CACHE_PATH else None,
+    )
+    scene_path = f"../levels/scene_data/{args.level}/{args.scene_id}.json"
+    level_data = f"../levels/{args.level}.json"
 
-game = Game(agent, scene_path, level_data, args.level, 
-            room_num = args.room_num, scene_id = args.scene_id, hint=args.hint)
+    tracer = TraceWriter(args.trace) if args.trace else None
+    game = Game(agent, scene_path, level_data, args.level, 
+                room_num = args.room_num, scene_id = args.scene_id, hint=args.hint, env_path=args.env_path, profile=args.profile, tracer=tracer)
+    # scoped to the run_id of the record dir, as in run_batch.py, so a new run of the setting is not a replay of the first one
+    agent.cache_namespace = f"t_{game.trial}"
 
-game.main(args)
+    game.main(args)
+    if tracer is not None:
+        tracer.save()
@@ -0,0 +1,239 @@
+"""
+A local stand-in for the LLM endpoint: an OpenAI-compatible /v1/chat/completions server answering with action JSON from a
+scripted policy, after a configurable latency. Use it to measure the runners' throughput and concurrency limits
+without Azure or vLLM capacity, e.g. with the mock game client:
+
+    python mock_llm_server.py --policy oracle --level_data ../levels/level3.json --latency lognormal:0.5,0.3
+    LLM_BASE_URL=http://localhost:8000/v1 python run_async.py --levels level3 --models mock --env_path mock
+
+policies:
+    random: explores with random moves, rotations and grabs
+    oracle: knows the solution of the level (--level_data): explores with grabs, uses the right key, reads the papers and
+            inputs the passwords found in the bag. It does not see, so it only solves the level if the items come into view
+    replay: the responses of a recorded episode (--record_path), by round. Only for the 'full' history type
+"""
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from Recorder import iter_records
+
+
+def get_text(message):
+    content = message.get("content", "")
+    if isinstance(content, str):
+        return content
+    return "\n".join(part.get("text", "") for part in content if part.get("type") == "text")
+
+
+def count_images(messages):
+    return sum(
+        part.get("type") == "image_url"
+        for message in messages if not isinstance(message.get("content", ""), str)
+        for part in message["content"]
+    )
+
+
+def get_round(messages):
+    """The round the request is for, the number of responses already in the conversation"""
+    return sum(message["role"] == "assistant" for message in messages)
+
+
+class RandomPolicy:
+    def __init__(self, seed=None):
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def __call__(self, messages):
+        with self.lock:
+            response = {"rotate_right": self.rng.choice([-90, -45, 45, 90, 180]), "grab": self.rng.random() < 0.5}
+            if self.rng.random() < 0.5:
+                response["move_forward"] = self.rng.choice([0.5, 1, 2])
+            if self.rng.random() < 0.2:
+                response["rotate_down"] = self.rng.choice([-20, 20])
+            if self.rng.random() < 0.2:
+                response["look_at"] = [round(self.rng.random(), 2), round(self.rng.random(), 2)]
+        response["rationale"] = "Exploring the room."
+        return response
+
+
+class OraclePolicy:
+    """Knows from the level JSON which key opens what and which paper holds which password"""
+    def __init__(self, level_data):
+        with open(level_data, "r", encoding="utf-8") as f:
+            room = json.load(f)["room"]
+        self.items = {item["id"]: item for item in room["items"]}
+        self.exit = room["exit"]
+        # the locks in the order they are to be opened: the boxes, then the exit
+        self.locks = [
+            (item_id, item["unlock_method"]) for item_id, item in self.items.items()
+            if item["type"] == "box" and item["unlock_method"]
+        ]
+        if self.exit["type"] in ["key", "password"]:
+            self.locks.append(("exit", {"type": self.exit["type"], "id": self.exit.get("unlock_item_id", None)}))
+        # the paper carrying each password
+        self.papers = {}
+        for item_id, item in self.items.items():
+            if item["type"] == "paper":
+                for content in item["contents"]:
+                    password_id = content if isinstance(content, str) else content.get("password_id", None)
+                    if password_id:
+                        self.papers[password_id] = item_id
+
+    def __call__(self, messages):
+        round_id = get_round(messages)
+        user_texts = [get_text(message) for message in messages if message["role"] == "user"]
+        bag = set(re.findall(r"- (?:item_)?id: (\w+)", user_texts[-1] if user_texts else ""))
+        passwords = re.findall(r"string of numbers (\d+)", "\n".join(user_texts))
+        read = set(re.findall(r'"read": "(\w+)"', "\n".join(get_text(m) for m in messages if m["role"] == "assistant")))
+
+        # explore: turn around in 8 rounds, then step forward
+        response = {"rotate_right": 45} if round_id % 9 != 8 else {"move_forward": 1}
+        for password_id, paper_id in self.papers.items():
+            if paper_id in bag and paper_id not in read:
+                response["read"] = paper_id
+                break
+        interactions = {"use_item_id": "", "input": ""}
+        for _, unlock in self.locks:
+            if unlock["type"] == "key" and unlock["id"] in bag:
+                interactions["use_item_id"] = unlock["id"]
+            elif unlock["type"] == "password" and passwords:
+                interactions["input"] = passwords[-1]
+        response.update(grab=True, interactions=interactions, rationale="Trying the items I have on what is in front of me.")
+        return response
+
+
+class ReplayPolicy:
+    def __init__(self, record_path):
+        self.responses = [record["response"] for record in iter_records(record_path) if "step" in record]
+
+    def __call__(self, messages):
+        round_id = get_round(messages)
+        if round_id < len(self.responses):
+            return self.responses[round_id]
+        return {"rotate_right": 90, "rationale": "The record is over."}
+
+
+def parse_latency(spec):
+    """fixed:s, uniform:low,high, normal:mean,std or lognormal:mu,sigma (of the log of seconds). Returns a sampler"""
+    name, _, params = spec.partition(":")
+    params = [float(p) for p in params.split(",")] if params else []
+    rng = random.Random()
+    if name == "fixed":
+        return lambda: params[0] if params else 0
+    if name == "uniform":
+        return lambda: rng.uniform(*params)
+    if name == "normal":
+        return lambda: max(rng.gauss(*params), 0)
+    if name == "lognormal":
+        return lambda: rng.lognormvariate(*params)
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+class MockLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, policy, latency="fixed:0", image_tokens=765, chars_per_token=4):
+        """
+        arg:
+        :policy: callable, messages -> the response dict
+        :latency: str, the distribution of the seconds a completion takes, see parse_latency
+        :image_tokens: int, prompt tokens counted per image
+        :chars_per_token: int, characters of text counted as one token
+        """
+        super().__init__(address, MockLLMHandler)
+        self.policy = policy
+        self.latency = parse_latency(latency)
+        self.image_tokens = image_tokens
+        self.chars_per_token = chars_per_token
+        self.requests = 0
+
+    def complete(self, request):
+        messages = request.get("messages", [])
+        if messages and messages[0]["role"] == "system":
+            content = json.dumps(self.policy(messages))
+        else:
+            # e.g. the startup check of AgentPlayer
+            content = "A duck."
+        time.sleep(self.latency())
+        self.requests += 1
+
+        prompt_tokens = sum(len(get_text(m)) for m in messages) // self.chars_per_token + self.image_tokens * count_images(messages)
+        completion_tokens = max(len(content) // self.chars_per_token, 1)
+        return {
+            "id": f"chatcmpl-mock-{self.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "mock"),
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def __reply(self, code, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self.__reply(200, {"object": "list", "data": [{"id": "mock", "object": "model", "owned_by": "mock"}]})
+        else:
+            self.__reply(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.__reply(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+        try:
+            self.__reply(200, self.server.complete(json.loads(body)))
+        except Exception as e:
+            self.__reply(500, {"error": {"message": repr(e)}})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="localhost")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--policy", type=str, default="random", choices=["random", "oracle", "replay"])
+    parser.add_argument("--level_data", type=str, default=None, help="the level JSON the oracle policy solves")
+    parser.add_argument("--record_path", type=str, default=None, help="the record dir the replay policy answers from")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the random policy")
+    parser.add_argument(
+        "--latency", type=str, default="fixed:0",
+        help="seconds per completion: fixed:s, uniform:low,high, normal:mean,std or lognormal:mu,sigma",
+    )
+    parser.add_argument("--image_tokens", type=int, default=765, help="prompt tokens counted per image")
+    parser.add_argument("--chars_per_token", type=int, default=4, help="characters of text counted as one token")
+    return parser.parse_args()
+
+
+def get_policy(args):
+    if args.policy == "oracle":
+        assert args.level_data, "The oracle policy needs --level_data"
+        return OraclePolicy(args.level_data)
+    if args.policy == "replay":
+        assert args.record_path, "The replay policy needs --record_path"
+        return ReplayPolicy(args.record_path)
+    return RandomPolicy(args.seed)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    server = MockLLMServer((args.host, args.port), get_policy(args), args.latency, args.image_tokens, args.chars_per_token)
+    print(f"Mock LLM server ({args.policy}) listening on http://{args.host}:{args.port}/v1")
+    server.serve_forever()
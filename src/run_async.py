@@ -0,0 +1,205 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from config import *
+from log_config import configure_logger
+from legent import EnvironmentPool, TraceWriter
+from legent.utils.config import DEFAULT_GRPC_PORT
+from ResponseCache import ResponseCache
+from run_batch import RESULT_FILE, get_run_dir, get_run_suffix_level, get_sweep
+
+logger = configure_logger(__name__)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--levels", type=str, nargs="+", required=True, help="level names")
+    parser.add_argument("--scene_ids", type=int, nargs="+", default=[1], help="scene_ids to load of each level")
+    parser.add_argument("--models", type=str, nargs="+", required=True, help="model names")
+    parser.add_argument(
+        "--hint_modes",
+        type=str,
+        nargs="+",
+        default=["base"],
+        choices=["base", "hint"],
+        help="run without (base) and/or with (hint) hints",
+    )
+    parser.add_argument(
+        "--history_types",
+        type=str,
+        nargs="+",
+        default=["full"],
+        help="history types, asserted in full, key, max",
+    )
+    parser.add_argument("--room_num", type=int, default=1, help="the number of rooms in every scene_id, as in main.py")
+    parser.add_argument("--trials", type=int, default=1, help="number of runs (run_id 1..trials) per setting")
+    parser.add_argument(
+        "--concurrency", type=int, default=16, help="number of episodes played at the same time in this process"
+    )
+    parser.add_argument(
+        "--base_port", type=int, default=DEFAULT_GRPC_PORT, help="the i-th Unity client listens on base_port + i"
+    )
+    parser.add_argument(
+        "--env_path", type=str, default=ENV_PATH, help='the game client to launch, "mock" for the python mock client'
+    )
+    parser.add_argument(
+        "--mock_step_latency", type=float, default=0, help="seconds the mock client (--env_path mock) sleeps per exchange, simulates rendering"
+    )
+    parser.add_argument(
+        "--max_history", default=None, type=int, help="max history length"
+    )
+    parser.add_argument(
+        "--max_images", default=None, type=int, help="only the screenshots of the last max_images rounds are sent, older ones are replaced by a text"
+    )
+    parser.add_argument("--max_retry", default=3, type=int, help="max retry times")
+    parser.add_argument("--max_allowed_steps", default=20, type=int, help="max allowed steps to finish the task")
+    parser.add_argument(
+        "--bypass_cache", action="store_true", help="do not answer from the response cache (RESPONSE_CACHE_PATH in config.py), the responses are still stored"
+    )
+    parser.add_argument(
+        "--recycle_after", default=None, type=int, help="relaunch a Unity client of the pool after this many episodes, by default only when it fails"
+    )
+    parser.add_argument(
+        "--trace", type=str, default=None, help="save a chrome trace of all the episodes (tagged by record dir) to this json file"
+    )
+
+    args = parser.parse_args()
+    return args
+
+
+async def play_episode(run, pool, tracer=None, cache=None):
+    from main import get_sys_prompt
+    from Agent import AsyncAgentPlayer
+    from Game import AsyncGame
+
+    loop = asyncio.get_running_loop()
+    start = time.time()
+    env = port = game = None
+    # until the episode ends, e.g. also when it is cancelled
+    failed = True
+    try:
+        # an episode leases a running Unity client and gives it back when it ends.
+        # A recycled client is relaunched here, a failed launch only fails this run
+        env = await loop.run_in_executor(None, pool.acquire)
+        port = env.port
+        # creating the agent blocks on the client test and the game on the scene reset
+        agent = await loop.run_in_executor(
+            None,
+            lambda: AsyncAgentPlayer(
+                system_prompt=get_sys_prompt(run["hint"], run["history_type"]), model=run["model"],
+                history_type=run["history_type"], max_history=run["max_history"],
+                max_retry=run["max_retry"], max_images=run["max_images"],
+                cache=cache, cache_namespace=f"t_{run['trial']}",
+            ),
+        )
+        game = await loop.run_in_executor(
+            None,
+            lambda: AsyncGame(
+                agent,
+                f"../levels/scene_data/{run['level']}/{run['scene_id']}.json",
+                f"../levels/{run['level']}.json",
+                run["level"],
+                scene_id=run["scene_id"],
+                hint=run["hint"],
+                suffix_level=get_run_suffix_level(run),
+                room_num=run["room_num"],
+                trial=run["trial"],
+                tracer=tracer,
+                env=env,
+            ),
+        )
+        result = await game.main(argparse.Namespace(max_allowed_steps=run["max_allowed_steps"]))
+        failed = False
+    except Exception:
+        return {"run": run, "port": port, "error": traceback.format_exc()}
+    finally:
+        # closes the record file and the room loader if the episode failed, a no-op if it ended
+        if game is not None:
+            try:
+                await loop.run_in_executor(None, game.close)
+            except Exception as e:
+                logger.error(f"Failed to close the episode on port {port}: {e}")
+        # health check, and relaunch if needed. An error here must not hide the result of the episode
+        if env is not None:
+            try:
+                await loop.run_in_executor(None, lambda: pool.release(env, failed=failed))
+            except Exception as e:
+                logger.error(f"Failed to release the game client on port {port}: {e}")
+
+    result.update({"run": run, "port": port, "time": time.time() - start})
+    with open(os.path.join(game.record_save_path, RESULT_FILE), "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=4)
+    return result
+
+
+async def main(args):
+    runs = get_sweep(args)
+    todo = [run for run in runs if not os.path.exists(os.path.join(get_run_dir(run), RESULT_FILE))]
+    logger.info(f"{len(runs)} runs in the sweep, {len(runs) - len(todo)} already completed, {len(todo)} to play.")
+    if not todo:
+        return
+
+    from Agent import get_encoding_profile, get_render_resolution
+
+    # the clients render at the resolution of the encoding profile of the model, the runs are played by resolution
+    # with a pool of clients each
+    runs_by_resolution = {}
+    for run in todo:
+        runs_by_resolution.setdefault(get_render_resolution(get_encoding_profile(run["model"])), []).append(run)
+
+    concurrency = min(args.concurrency, len(todo))
+    # every running episode blocks at most one thread (on its Unity client), so one thread per episode is enough
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+
+    tracer = TraceWriter(args.trace) if args.trace else None
+    # one cache for all the episodes of the process
+    cache = ResponseCache(bypass=args.bypass_cache) if RESPONSE_CACHE_PATH else None
+
+    start = time.time()
+    finished, failed = 0, 0
+    for (width, height), runs in runs_by_resolution.items():
+        size = min(concurrency, len(runs))
+        # the Unity clients are launched once and reset with the scene of every episode
+        logger.info(f"Launching {size} game clients at {width}x{height} for {len(runs)} episodes.")
+        pool = EnvironmentPool(
+            size, base_port=args.base_port, max_episodes=args.recycle_after, env_path=args.env_path,
+            camera_resolution_width=width, camera_resolution_height=height, camera_field_of_view=120,
+            mock_options={"step_latency": args.mock_step_latency},
+        )
+        # at most one episode per client, so acquiring one never blocks an executor thread for long
+        slots = asyncio.Semaphore(size)
+
+        async def play(run):
+            async with slots:
+                return await play_episode(run, pool, tracer, cache)
+
+        try:
+            for future in asyncio.as_completed([play(run) for run in runs]):
+                result = await future
+                run = result["run"]
+                name = f"{run['level']}-{run['scene_id']} {run['model']} hint={run['hint']} history={run['history_type']} t_{run['trial']}"
+                if "error" in result:
+                    failed += 1
+                    logger.error(f"{name} failed on port {result['port']}:\n{result['error']}")
+                else:
+                    finished += 1
+                    logger.info(f"{name} finished in {result['time']:.0f}s, steps: {result['steps']}, clear: {result['clear']}, cache hits: {result['cache_hits']}")
+                hours = (time.time() - start) / 3600
+                logger.info(
+                    f"Progress: {finished + failed}/{len(todo)} (failed: {failed}), {finished / hours:.2f} episodes per hour"
+                )
+        finally:
+            pool.close()
+        logger.info(f"{pool.launches} game client launches at {width}x{height} for {len(runs)} episodes.")
+    if tracer is not None:
+        tracer.save()
+        logger.info(f"Trace saved to {args.trace}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,210 @@
+import argparse
+import itertools
+import json
+import os
+import time
+import traceback
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from config import *
+from log_config import configure_logger
+from legent.utils.config import DEFAULT_GRPC_PORT
+
+logger = configure_logger(__name__)
+
+RESULT_FILE = "result.json" # written into the record dir once an episode is finished
+
+_worker_port = None
+_worker_cache = None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--levels", type=str, nargs="+", required=True, help="level names")
+    parser.add_argument("--scene_ids", type=int, nargs="+", default=[1], help="scene_ids to load of each level")
+    parser.add_argument("--models", type=str, nargs="+", required=True, help="model names")
+    parser.add_argument(
+        "--hint_modes",
+        type=str,
+        nargs="+",
+        default=["base"],
+        choices=["base", "hint"],
+        help="run without (base) and/or with (hint) hints",
+    )
+    parser.add_argument(
+        "--history_types",
+        type=str,
+        nargs="+",
+        default=["full"],
+        help="history types, asserted in full, key, max",
+    )
+    parser.add_argument("--room_num", type=int, default=1, help="the number of rooms in every scene_id, as in main.py")
+    parser.add_argument("--trials", type=int, default=1, help="number of runs (run_id 1..trials) per setting")
+    parser.add_argument("--num_workers", type=int, default=4, help="number of episodes played concurrently")
+    parser.add_argument(
+        "--base_port", type=int, default=DEFAULT_GRPC_PORT, help="worker i talks to its Unity client on base_port + i"
+    )
+    parser.add_argument(
+        "--env_path", type=str, default=ENV_PATH, help='the game client to launch, "mock" for the python mock client'
+    )
+    parser.add_argument(
+        "--mock_step_latency", type=float, default=0, help="seconds the mock client (--env_path mock) sleeps per exchange, simulates rendering"
+    )
+    parser.add_argument(
+        "--max_history", default=None, type=int, help="max history length"
+    )
+    parser.add_argument(
+        "--max_images", default=None, type=int, help="only the screenshots of the last max_images rounds are sent, older ones are replaced by a text"
+    )
+    parser.add_argument("--max_retry", default=3, type=int, help="max retry times")
+    parser.add_argument("--max_allowed_steps", default=20, type=int, help="max allowed steps to finish the task")
+    parser.add_argument(
+        "--bypass_cache", action="store_true", help="do not answer from the response cache (RESPONSE_CACHE_PATH in config.py), the responses are still stored"
+    )
+
+    args = parser.parse_args()
+    return args
+
+
+def get_suffix_level(hint, history_type, max_history=None, max_images=None):
+    """Settings other than the default one are recorded under their own level dir, e.g. level1_hint-3 or level1_h5_img2-3"""
+    suffix = []
+    if hint:
+        suffix.append("hint")
+    if history_type != "full":
+        suffix.append(history_type)
+    if max_history is not None:
+        suffix.append(f"h{max_history}")
+    if max_images is not None:
+        suffix.append(f"img{max_images}")
+    return "_".join(suffix)
+
+
+def get_run_suffix_level(run):
+    return get_suffix_level(run["hint"], run["history_type"], run["max_history"], run["max_images"])
+
+
+def get_run_dir(run):
+    from Game import get_record_level_name
+
+    level = get_record_level_name(
+        run["level"], run["scene_id"], room_num=run["room_num"], suffix_level=get_run_suffix_level(run)
+    )
+    return os.path.join(GAME_CACHE_DIR, level, f"{run['model']}_t_{run['trial']}")
+
+
+def get_sweep(args):
+    runs = []
+    for level, scene_id, model, hint_mode, history_type, trial in itertools.product(
+        args.levels, args.scene_ids, args.models, args.hint_modes, args.history_types, range(1, args.trials + 1)
+    ):
+        runs.append(
+            {
+                "level": level,
+                "scene_id": scene_id,
+                "model": model,
+                "hint": hint_mode == "hint",
+                "history_type": history_type,
+                "trial": trial,
+                "room_num": args.room_num,
+                "env_path": args.env_path,
+                "mock_step_latency": args.mock_step_latency,
+                "max_history": args.max_history,
+                "max_images": args.max_images,
+                "max_retry": args.max_retry,
+                "max_allowed_steps": args.max_allowed_steps,
+            }
+        )
+    return runs
+
+
+def init_worker(port_queue, bypass_cache=False):
+    # every worker process owns one port for its whole life, so the Unity clients never collide
+    global _worker_port, _worker_cache
+    _worker_port = port_queue.get()
+    if RESPONSE_CACHE_PATH:
+        from ResponseCache import ResponseCache
+
+        _worker_cache = ResponseCache(bypass=bypass_cache)
+
+
+def play_episode(run):
+    from main import get_sys_prompt
+    from Agent import AgentPlayer
+    from Game import Game
+
+    start = time.time()
+    game = None
+    try:
+        agent = AgentPlayer(
+            system_prompt=get_sys_prompt(run["hint"], run["history_type"]), model=run["model"],
+            history_type=run["history_type"], max_history=run["max_history"],
+            max_retry=run["max_retry"], max_images=run["max_images"],
+            cache=_worker_cache, cache_namespace=f"t_{run['trial']}",
+        )
+        game = Game(
+            agent,
+            f"../levels/scene_data/{run['level']}/{run['scene_id']}.json",
+            f"../levels/{run['level']}.json",
+            run["level"],
+            scene_id=run["scene_id"],
+            hint=run["hint"],
+            suffix_level=get_run_suffix_level(run),
+            room_num=run["room_num"],
+            port=_worker_port,
+            trial=run["trial"],
+            env_path=run["env_path"],
+            mock_options={"step_latency": run["mock_step_latency"]},
+        )
+        result = game.main(argparse.Namespace(max_allowed_steps=run["max_allowed_steps"]))
+    except Exception:
+        return {"run": run, "port": _worker_port, "error": traceback.format_exc()}
+    finally:
+        # release the port for the next episode of this worker, a no-op if the episode ended
+        if game is not None:
+            try:
+                game.close()
+            except Exception as e:
+                logger.error(f"Failed to close the episode on port {_worker_port}: {e}")
+
+    result.update({"run": run, "port": _worker_port, "time": time.time() - start})
+    with open(os.path.join(game.record_save_path, RESULT_FILE), "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=4)
+    return result
+
+
+def main(args):
+    runs = get_sweep(args)
+    todo = [run for run in runs if not os.path.exists(os.path.join(get_run_dir(run), RESULT_FILE))]
+    logger.info(f"{len(runs)} runs in the sweep, {len(runs) - len(todo)} already completed, {len(todo)} to play.")
+    if not todo:
+        return
+
+    num_workers = min(args.num_workers, len(todo))
+    port_queue = mp.Queue()
+    for i in range(num_workers):
+        port_queue.put(args.base_port + i)
+
+    start = time.time()
+    finished, failed = 0, 0
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=init_worker, initargs=(port_queue, args.bypass_cache)) as executor:
+        futures = [executor.submit(play_episode, run) for run in todo]
+        for future in as_completed(futures):
+            result = future.result()
+            run = result["run"]
+            name = f"{run['level']}-{run['scene_id']} {run['model']} hint={run['hint']} history={run['history_type']} t_{run['trial']}"
+            if "error" in result:
+                failed += 1
+                logger.error(f"{name} failed on port {result['port']}:\n{result['error']}")
+            else:
+                finished += 1
+                logger.info(f"{name} finished in {result['time']:.0f}s, steps: {result['steps']}, clear: {result['clear']}, cache hits: {result['cache_hits']}")
+            hours = (time.time() - start) / 3600
+            logger.info(
+                f"Progress: {finished + failed}/{len(todo)} (failed: {failed}), {finished / hours:.2f} episodes per hour"
+            )
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,49 @@
+"""
+Round-trip latency of RpcCommunicator.exchange against the python mock client, without the image decoding of Environment.step.
+
+    cd src/scripts
+    python benchmark_exchange.py --steps 500 --width 2048 --height 1024
+"""
+import sys
+import time
+import argparse
+
+sys.path.append("..")
+
+from legent import Action, Environment, ResetInfo
+from legent.utils.profiler import percentile
+from utils import format_scene
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--scene", type=str, default="../../levels/scene_data/level1/1.json", help="scene to load")
+parser.add_argument("--steps", type=int, default=500, help="number of exchanges measured")
+parser.add_argument("--warmup", type=int, default=20, help="number of exchanges before measuring")
+parser.add_argument("--width", type=int, default=2048, help="camera resolution width")
+parser.add_argument("--height", type=int, default=1024, help="camera resolution height")
+parser.add_argument("--port", type=int, default=50099)
+args = parser.parse_args()
+
+env = Environment(
+    env_path="mock", run_options={"port": args.port}, camera_resolution_width=args.width, camera_resolution_height=args.height
+)
+try:
+    env.reset(ResetInfo(format_scene(args.scene)))
+    communicator = env._communicator
+    action = Action()
+    action.rotate_right = 45
+    inputs = action.build()
+    durations = []
+    image_bytes = 0
+    for i in range(args.warmup + args.steps):
+        start = time.perf_counter()
+        obs = communicator.exchange(inputs, env._poll_process)
+        if i >= args.warmup:
+            durations.append(time.perf_counter() - start)
+            image_bytes += len(obs.image)
+    print(f"{args.steps} exchanges, {image_bytes / args.steps / 1024:.0f} KB images")
+    print(
+        f"mean {sum(durations) / len(durations) * 1000:.3f} ms, p50 {percentile(durations, 50) * 1000:.3f} ms, "
+        f"p95 {percentile(durations, 95) * 1000:.3f} ms, {len(durations) / sum(durations):.0f} exchanges per second"
+    )
+finally:
+    env.close()
@@ -0,0 +1,28 @@
+"""
+Measure the mesh files of the prefabs in parallel into the mesh index (legent.asset.mesh_index), so that scene generation
+never parses a mesh it has already measured. Only the new and changed files are measured.
+
+    cd src/scripts
+    python build_mesh_index.py ../../prefabs --surfaces
+"""
+import sys
+import argparse
+
+sys.path.append("..")
+
+from legent import MeshIndex
+from legent.utils.config import MESH_INDEX_PATH
+
+parser = argparse.ArgumentParser()
+parser.add_argument("roots", type=str, nargs="+", help="dirs of mesh files")
+parser.add_argument("--surfaces", action="store_true", help="also compute the placeable surfaces, much slower than the sizes")
+parser.add_argument("--workers", type=int, default=None, help="number of processes, the number of CPUs by default")
+parser.add_argument("--index", type=str, default=MESH_INDEX_PATH, help="the json file of the index")
+args = parser.parse_args()
+
+index = MeshIndex(args.index)
+for root in args.roots:
+    count = index.build(root, args.surfaces, args.workers)
+    print(f"{root}: {count} mesh files measured")
+index.flush()
+print(f"Index saved to {index.path}")
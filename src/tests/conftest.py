@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules of src are imported as top-level ones, as when running from src
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
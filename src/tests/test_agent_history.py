@@ -0,0 +1,61 @@
+import pytest
+
+from Agent import AgentPlayer
+
+
+class OfflineAgentPlayer(AgentPlayer):
+    def _create_client(self):
+        return None
+
+    def _test_client(self):
+        pass
+
+
+def play(agent, rounds, key_rounds):
+    """Play text-only rounds as the game does, and return the messages sent at every round"""
+    sent = []
+    for round_id in range(rounds):
+        agent.step_meta_info.append({"key_step": round_id in key_rounds})
+        agent.add_problem(f"prompt {round_id}")
+        sent.append(agent.get_interactions())
+        agent.add_response(f"response {round_id}")
+    return sent
+
+
+def assert_alternate(messages):
+    roles = [message["role"] for message in messages]
+    assert roles[0] == "system"
+    assert roles[1::2] == ["user"] * len(roles[1::2])
+    assert roles[2::2] == ["assistant"] * len(roles[2::2])
+    assert roles[-1] == "user"
+
+
+def texts(message):
+    return [part["text"] for part in message["content"]]
+
+
+@pytest.mark.parametrize("max_history", [None, 1, 2])
+def test_key_history_alternates(max_history):
+    agent = OfflineAgentPlayer("system", "gpt-4o", history_type="key", max_history=max_history)
+    for messages in play(agent, 12, key_rounds={0, 3, 4, 8}):
+        assert_alternate(messages)
+        # the task and the first view are always sent
+        assert "prompt 0" in texts(messages[1])
+        if max_history:
+            assert len([message for message in messages if message["role"] == "assistant"]) <= max_history
+
+
+def test_key_history_keeps_the_key_rounds():
+    agent = OfflineAgentPlayer("system", "gpt-4o", history_type="key")
+    messages = play(agent, 6, key_rounds={0, 3})[-1]
+    responses = [texts(message)[0] for message in messages if message["role"] == "assistant"]
+    assert responses == ["After 1 rounds, you got response 0", "After 4 rounds, you got response 3"]
+    # the result of round 3 and the current prompt are merged into one turn
+    assert any(text == "prompt 4" for text in texts(messages[-1]))
+    assert any(text == "prompt 5" for text in texts(messages[-1]))
+
+
+def test_key_history_does_not_modify_the_interactions():
+    agent = OfflineAgentPlayer("system", "gpt-4o", history_type="key")
+    play(agent, 6, key_rounds={0})
+    assert [len(message["content"]) for message in agent.interactions[::2]] == [1, 1, 1, 1, 1, 1]
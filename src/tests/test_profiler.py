@@ -0,0 +1,22 @@
+import pytest
+
+from legent.utils.profiler import percentile
+
+
+@pytest.mark.parametrize(
+    "n, q, expected",
+    [
+        (1, 50, 1), (1, 95, 1),
+        (2, 50, 1), (2, 95, 2),
+        (6, 50, 3), (6, 95, 6),
+        (20, 50, 10), (20, 95, 19), (20, 100, 20), (20, 0, 1),
+    ],
+)
+def test_percentile_nearest_rank(n, q, expected):
+    # the values 1..n shuffled, the nearest rank is ceil(q/100*n)
+    values = list(range(n, 0, -1))
+    assert percentile(values, q) == expected
+
+
+def test_percentile_empty():
+    assert percentile([], 50) == 0.0
@@ -7,14 +7,16 @@ from legent import get_mesh_size
 from config import *
 
 
+def resolve_prefab_paths(text):
+    """Replace {__PREFAB_DIR__} by PREFAB_DIR and normalize the separators of the paths in a scene JSON text"""
+    _scene = text.replace(r"{__PREFAB_DIR__}", PREFAB_DIR)
+    return _scene.replace("\\", "/").replace("//", "/")
+
 def format_scene(scene_path):
     with open(scene_path, "r", encoding="utf-8") as f:
         _ori_scene = f.read()
-        
-    _scene = _ori_scene.replace(r"{__PREFAB_DIR__}", PREFAB_DIR)
-    _scene = _scene.replace("\\", "/").replace("//", "/")
     
-    return json.loads(_scene)
+    return json.loads(resolve_prefab_paths(_ori_scene))
 
 def get_scale(prefab, target_size_y):
     __origin_size = get_mesh_size(prefab)